@@ -1,13 +1,28 @@
-from agent.orchestrator import StatefulAgent
-from agent.planner import TaskPlanner
-from agent.executor import ActionExecutor
-from agent.memory import StateManager
-from agent.tracer import DecisionTracer
-
-__all__ = [
-    'StatefulAgent',
-    'TaskPlanner',
-    'ActionExecutor',
-    'StateManager',
-    'DecisionTracer'
-]
+import importlib
+
+# submodules are imported on first attribute access (PEP 562), so importing one
+# part of the package (agent.batch, agent.records, ...) doesn't pull in the rest
+_EXPORTS = {
+    'StatefulAgent': 'agent.orchestrator',
+    'TaskPlanner': 'agent.planner',
+    'AsyncTaskPlanner': 'agent.planner',
+    'ActionExecutor': 'agent.executor',
+    'AsyncActionExecutor': 'agent.executor',
+    'StateManager': 'agent.memory',
+    'DecisionTracer': 'agent.tracer'
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module 'agent' has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
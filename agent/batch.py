@@ -0,0 +1,180 @@
+import contextlib
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from typing import Dict, List, Any, Callable, Iterator
+
+
+def load_task_specs(path: str) -> List[Dict]:
+    # one JSON object per line: {"task": "...", "context": {...}, "id": optional}.
+    # blank lines and lines starting with # are skipped
+    specs = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            spec = json.loads(line)
+            task = spec.get("task") or spec.get("task_description")
+            if not task:
+                raise ValueError(f"{path}:{line_no}: task spec has no 'task'")
+            specs.append({
+                "id": spec.get("id", len(specs) + 1),
+                "task": task,
+                "context": spec.get("context") or {}
+            })
+    return specs
+
+
+# per worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(shard_ids, batch_dir: str, agent_kwargs: Dict, provider_factory: Callable):
+    from agent.orchestrator import StatefulAgent
+
+    shard = shard_ids.get()
+    shard_dir = os.path.join(batch_dir, f"shard_{shard:02d}")
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # agent output is noisy, each shard keeps its own log instead of sharing stdout
+    log = open(os.path.join(shard_dir, "agent.log"), 'a', encoding='utf-8', buffering=1)
+    with contextlib.redirect_stdout(log):
+        agent = StatefulAgent(provider=provider_factory() if provider_factory else None,
+                              storage_dir=os.path.join(shard_dir, "storage"),
+                              output_dir=os.path.join(shard_dir, "outputs"),
+                              **agent_kwargs)
+    _worker.update(shard=shard, agent=agent, log=log)
+
+
+def _run_spec(index: int, spec: Dict) -> Dict:
+    agent, log = _worker["agent"], _worker["log"]
+    record = {"index": index, "id": spec["id"], "task": spec["task"],
+              "task_type": spec["context"].get("task_type", "general"),
+              "shard": _worker["shard"], "session_id": agent.session_id}
+
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(log):
+            summary = agent.run_task(spec["task"], spec["context"])
+    except Exception as e:
+        record.update(status="failed", error=str(e), seconds=time.perf_counter() - start)
+        return record
+
+    record.update(
+        status="completed" if summary["failed_steps"] == 0 else "partial",
+        goal=summary["goal"],
+        total_steps=summary["total_steps"],
+        successful_steps=summary["successful_steps"],
+        failed_steps=summary["failed_steps"],
+        success_rate=summary["success_rate"],
+        seconds=time.perf_counter() - start,
+        # the decision trace stays in the shard's storage, it's too big to repeat per line
+        results=summary["results"]
+    )
+    return record
+
+
+class BatchRunner:
+    # runs many independent tasks across processes. every worker builds its own
+    # StatefulAgent on a storage shard under batch_dir, so workers never share
+    # state files. results are written to the output file in input order as soon
+    # as each one (and everything before it) is done
+    def __init__(self, workers: int = None, batch_dir: str = "batch_runs",
+                 agent_kwargs: Dict = None, provider_factory: Callable = None,
+                 max_pending: int = None):
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_dir = batch_dir
+        self.agent_kwargs = agent_kwargs or {}
+        # provider objects hold locks and clients, so workers build their own.
+        # must be a module-level callable so it can be pickled
+        self.provider_factory = provider_factory
+        # tasks submitted ahead of the slowest unfinished one
+        self.max_pending = max_pending or self.workers * 2
+
+    def run(self, specs: List[Dict], output_path: str) -> Dict[str, Any]:
+        os.makedirs(self.batch_dir, exist_ok=True)
+        if os.path.dirname(output_path):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        started_at = datetime.now().isoformat()
+        start = time.perf_counter()
+        records = []
+        with open(output_path, 'w', encoding='utf-8') as out:
+            for record in self.iter_results(specs):
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                records.append({k: v for k, v in record.items() if k != "results"})
+
+        summary = self._summarize(records, started_at, time.perf_counter() - start)
+        summary["output_path"] = output_path
+        with open(os.path.join(self.batch_dir, "summary.json"), 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def iter_results(self, specs: List[Dict]) -> Iterator[Dict]:
+        workers = max(1, min(self.workers, len(specs)))
+        ctx = multiprocessing.get_context()
+        shard_ids = ctx.Queue()
+        for shard in range(workers):
+            shard_ids.put(shard)
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                                 initargs=(shard_ids, self.batch_dir, self.agent_kwargs,
+                                           self.provider_factory)) as pool:
+            submitted = {}
+            done = {}
+            next_submit = 0
+            next_emit = 0
+            while next_emit < len(specs):
+                while next_submit < len(specs) and next_submit - next_emit < self.max_pending:
+                    future = pool.submit(_run_spec, next_submit, specs[next_submit])
+                    submitted[future] = next_submit
+                    next_submit += 1
+
+                finished, _ = wait(list(submitted), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index = submitted.pop(future)
+                    try:
+                        done[index] = future.result()
+                    except Exception as e:
+                        # the worker process itself died
+                        done[index] = {"index": index, "id": specs[index]["id"],
+                                       "task": specs[index]["task"], "status": "failed",
+                                       "error": f"worker crashed: {str(e)}"}
+
+                while next_emit in done:
+                    yield done.pop(next_emit)
+                    next_emit += 1
+
+    def _summarize(self, records: List[Dict], started_at: str, elapsed: float) -> Dict[str, Any]:
+        by_status = {}
+        by_type = {}
+        by_shard = {}
+        for record in records:
+            by_status[record["status"]] = by_status.get(record["status"], 0) + 1
+            by_type[record.get("task_type", "general")] = by_type.get(record.get("task_type", "general"), 0) + 1
+            if "shard" in record:
+                by_shard[record["shard"]] = by_shard.get(record["shard"], 0) + 1
+
+        ran = [r for r in records if "success_rate" in r]
+        durations = sorted(r["seconds"] for r in records if "seconds" in r)
+        return {
+            "started_at": started_at,
+            "elapsed_seconds": elapsed,
+            "workers": self.workers,
+            "total_tasks": len(records),
+            "tasks_per_second": len(records) / elapsed if elapsed else 0.0,
+            "by_status": by_status,
+            "by_task_type": by_type,
+            "tasks_per_shard": {str(k): v for k, v in sorted(by_shard.items())},
+            "total_steps": sum(r["total_steps"] for r in ran),
+            "successful_steps": sum(r["successful_steps"] for r in ran),
+            "mean_success_rate": sum(r["success_rate"] for r in ran) / len(ran) if ran else 0.0,
+            "median_task_seconds": durations[len(durations) // 2] if durations else 0.0,
+            "failed_tasks": [{"id": r["id"], "error": r.get("error")}
+                             for r in records if r["status"] == "failed"]
+        }
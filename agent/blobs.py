@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Any
+
+from agent.metrics import MetricsRegistry
+from agent.records import Record, dumps
+
+
+# a reference is a one-key object, {"$blob": "<sha256 of the JSON>"}
+BLOB_KEY = "$blob"
+
+
+def is_ref(value) -> bool:
+    return isinstance(value, dict) and len(value) == 1 and BLOB_KEY in value
+
+
+class BlobStore:
+    # content-addressed JSON values under storage/blobs/<2 hex>/<rest>. pack()
+    # swaps any string, list or object whose JSON is at least min_size bytes for a
+    # reference to its hash, inner parts first, so the same analysis text or plan
+    # steps logged to the trace, state and memory is written once. blobs are zlib
+    # compressed unless compress=False, and are never rewritten once they exist
+    def __init__(self, storage_dir: str = "storage", min_size: int = 1024, compress: bool = True,
+                 cache_entries: int = 256, metrics: MetricsRegistry = None):
+        self.root = os.path.join(storage_dir, "blobs")
+        self.min_size = min_size
+        self.compress = compress
+        self.cache_entries = cache_entries
+        self.metrics = metrics
+
+        self.stats = {"stored": 0, "deduplicated": 0, "bytes_written": 0, "bytes_deduplicated": 0}
+        # digests known to be on disk, and recently read or written values
+        self._known = set()
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def pack(self, value: Any) -> Any:
+        # value itself may come back as a reference
+        if isinstance(value, str):
+            if len(value) < self.min_size:
+                return value
+            return self._put(dumps(value), value)
+        if isinstance(value, (Mapping, list)):
+            value = self.externalize(value)
+            encoded = dumps(value)
+            if len(encoded) >= self.min_size:
+                return self._put(encoded, value)
+        return value
+
+    def externalize(self, value: Any) -> Any:
+        # like pack, but a top level object or list stays inline so its small
+        # fields (ids, status) can still be read without loading anything
+        if isinstance(value, Mapping):
+            return {k: self.pack(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.pack(v) for v in value]
+        return self.pack(value)
+
+    def resolve(self, value: Any) -> Any:
+        # references anywhere in value replaced by what they point to
+        if isinstance(value, dict):
+            if is_ref(value):
+                return self.resolve(self.get(value[BLOB_KEY]))
+            return {k: self.resolve(v) for k, v in value.items()}
+        if isinstance(value, Record):
+            return type(value)({k: self.resolve(v) for k, v in value.items()})
+        if isinstance(value, list):
+            return [self.resolve(v) for v in value]
+        return value
+
+    def get(self, digest: str) -> Any:
+        with self._lock:
+            if digest in self._cache:
+                self._cache.move_to_end(digest)
+                return self._cache[digest]
+
+        path = self._path(digest)
+        if os.path.exists(path + ".z"):
+            with open(path + ".z", 'rb') as f:
+                value = json.loads(zlib.decompress(f.read()))
+        else:
+            with open(path, 'rb') as f:
+                value = json.loads(f.read())
+
+        with self._lock:
+            self._known.add(digest)
+            self._remember(digest, value)
+        return value
+
+    def _put(self, encoded: str, value: Any) -> Dict[str, str]:
+        data = encoded.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        ref = {BLOB_KEY: digest}
+        path = self._path(digest)
+
+        with self._lock:
+            known = digest in self._known
+            self._remember(digest, value)
+        if known or os.path.exists(path) or os.path.exists(path + ".z"):
+            with self._lock:
+                self._known.add(digest)
+                self.stats["deduplicated"] += 1
+                self.stats["bytes_deduplicated"] += len(data)
+            return ref
+
+        start = time.perf_counter()
+        if self.compress:
+            data = zlib.compress(data, 6)
+            path += ".z"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique temp name, two threads may write the same blob at once
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._known.add(digest)
+            self.stats["stored"] += 1
+            self.stats["bytes_written"] += len(data)
+        if self.metrics:
+            self.metrics.observe("agent_storage_save_seconds", time.perf_counter() - start, store="blobs")
+            self.metrics.inc("agent_storage_bytes_written", len(data), store="blobs")
+        return ref
+
+    def _remember(self, digest: str, value: Any):
+        # caller holds the lock
+        self._cache[digest] = value
+        self._cache.move_to_end(digest)
+        while len(self._cache) > self.cache_entries:
+            self._cache.popitem(last=False)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:])
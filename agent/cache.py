@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from agent.metrics import MetricsRegistry
+
+
+# timestamps and timestamped filenames leak into prompts through step results,
+# they shouldn't make otherwise identical prompts miss
+_VOLATILE = re.compile(r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?|\d{8}_\d{6}(_[0-9a-f]{8})?")
+
+
+class ResponseCache:
+    # two tier cache for model responses: in-memory LRU in front of files under storage/
+    def __init__(self, storage_dir: str = "storage", max_memory_entries: int = 256,
+                 max_disk_bytes: int = 100 * 1024 * 1024, ttl_seconds: float = 7 * 24 * 3600,
+                 bypass: bool = False, metrics: MetricsRegistry = None):
+        self.cache_dir = os.path.join(storage_dir, "llm_cache")
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl_seconds = ttl_seconds
+        # bypass skips lookups but still stores the fresh responses
+        self.bypass = bypass
+        self.metrics = metrics
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        # summed on the first write, a large cache directory shouldn't slow startup
+        self._disk_bytes = None
+
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0,
+                      "bypassed": 0, "evictions": 0, "expired": 0}
+
+    def make_key(self, model_name: str, prompt: str) -> str:
+        normalized = _VOLATILE.sub("<ts>", " ".join(prompt.split()))
+        return hashlib.sha256(f"{model_name}\n{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, model_name: str, prompt: str) -> Optional[str]:
+        if self.bypass:
+            self._count("bypassed")
+            return None
+
+        key = self.make_key(model_name, prompt)
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry["created_at"] <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return entry["text"]
+                del self._memory[key]
+
+        entry = self._read_disk(key)
+        if entry is None:
+            self._count("misses")
+            return None
+        if now - entry["created_at"] > self.ttl_seconds:
+            self._remove_disk(key)
+            self._count("expired")
+            self._count("misses")
+            return None
+
+        with self._lock:
+            self._remember(key, entry)
+            self.stats["disk_hits"] += 1
+        return entry["text"]
+
+    def put(self, model_name: str, prompt: str, text: str):
+        key = self.make_key(model_name, prompt)
+        entry = {"model": model_name, "created_at": time.time(), "text": text}
+
+        with self._lock:
+            self._remember(key, entry)
+
+        path = self._path(key)
+        data = json.dumps(entry).encode("utf-8")
+        previous = os.path.getsize(path) if os.path.exists(path) else 0
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self.metrics:
+            self.metrics.inc("agent_storage_bytes_written", len(data), store="cache")
+
+        with self._lock:
+            if self._disk_bytes is None:
+                # the first scan already sees the file just written
+                self._disk_usage()
+            else:
+                self._disk_bytes += len(data) - previous
+            over_budget = self._disk_bytes > self.max_disk_bytes
+        if over_budget:
+            self._evict_disk()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            for name in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, name))
+            self._disk_bytes = 0
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            lookups = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            return {
+                **self.stats,
+                "hit_rate": hits / lookups if lookups else 0,
+                "memory_entries": len(self._memory),
+                "disk_bytes": self._disk_usage()
+            }
+
+    def _disk_usage(self) -> int:
+        # caller holds the lock
+        if self._disk_bytes is None:
+            self._disk_bytes = sum(os.path.getsize(os.path.join(self.cache_dir, name))
+                                   for name in os.listdir(self.cache_dir))
+        return self._disk_bytes
+
+    def _remember(self, key: str, entry: Dict):
+        # caller holds the lock
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[Dict]:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _remove_disk(self, key: str):
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes -= size
+
+    def _evict_disk(self):
+        # drop least recently written files until we're back under 90% of the budget
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        target = self.max_disk_bytes * 0.9
+        evicted = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+
+        with self._lock:
+            self._disk_bytes = total
+            self.stats["evictions"] += evicted
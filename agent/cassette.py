@@ -0,0 +1,257 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Iterator, AsyncIterator
+
+from agent.models import ModelProvider
+
+
+# a cassette is JSON lines: a header, then one entry per provider call in the
+# order they finished. entries are keyed by the sha256 of the normalized prompt,
+# prompts themselves aren't kept. paths ending in .gz are gzip compressed
+CASSETTE_VERSION = 1
+
+# parts of a prompt that differ between two runs of the same task: earlier step
+# results carry output file paths, timestamps and session ids
+_VOLATILE = [
+    (re.compile(r'("\w*path"\s*:\s*)"[^"]*"'), r'\1"<path>"'),
+    (re.compile(r"\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}:\d{2}(\.\d+)?"), "<time>"),
+    (re.compile(r"\d{8}_\d{6}(_[0-9a-f]{8})?"), "<time>"),
+    (re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"), "<uuid>")
+]
+
+
+class CassetteMissError(LookupError):
+    # not retryable, a prompt that was never recorded won't appear on a retry
+    pass
+
+
+class ReplayedError(RuntimeError):
+    # stands in for an error the provider raised while recording, with the same
+    # status code so the governor retries it the same way
+    def __init__(self, message: str, code: int = None):
+        super().__init__(message)
+        self.code = code
+
+
+def prompt_key(prompt: str) -> str:
+    for pattern, placeholder in _VOLATILE:
+        prompt = pattern.sub(placeholder, prompt)
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+def _open(path: str, mode: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def load_cassette(path: str) -> List[Dict]:
+    # header first. a torn last line (or gzip member) from a crash is dropped
+    entries = []
+    with _open(path, "r") as f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                entries.append(json.loads(line))
+        except EOFError:
+            pass
+    if not entries or entries[0].get("cassette") != CASSETTE_VERSION:
+        raise ValueError(f"{path} is not a cassette")
+    return entries
+
+
+class RecordingProvider(ModelProvider):
+    # passes every call through to provider and appends the response, how long
+    # it took and, for streams, time to first chunk and chunk sizes. each call is
+    # written as soon as it finishes, so a crashed run still leaves a cassette
+    def __init__(self, provider: ModelProvider, path: str):
+        self.provider = provider
+        self.model_name = provider.model_name
+        self.path = path
+        self.calls = 0
+        self._lock = threading.Lock()
+        with _open(path, "w") as f:
+            f.write(json.dumps({"cassette": CASSETTE_VERSION, "model": self.model_name,
+                                "recorded_at": datetime.now().isoformat()}) + "\n")
+
+    def generate(self, prompt: str) -> str:
+        start = time.perf_counter()
+        try:
+            text = self.provider.generate(prompt)
+        except Exception as e:
+            self._record_error(prompt, e, time.perf_counter() - start)
+            raise
+        self._record(prompt, {"response": text, "seconds": time.perf_counter() - start})
+        return text
+
+    async def agenerate(self, prompt: str) -> str:
+        start = time.perf_counter()
+        try:
+            text = await self.provider.agenerate(prompt)
+        except Exception as e:
+            self._record_error(prompt, e, time.perf_counter() - start)
+            raise
+        self._record(prompt, {"response": text, "seconds": time.perf_counter() - start})
+        return text
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        start = time.perf_counter()
+        chunks, ttft = [], None
+        try:
+            for chunk in self.provider.stream(prompt):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            self._record_error(prompt, e, time.perf_counter() - start)
+            raise
+        self._record_stream(prompt, chunks, time.perf_counter() - start, ttft)
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        start = time.perf_counter()
+        chunks, ttft = [], None
+        try:
+            async for chunk in self.provider.astream(prompt):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                chunks.append(chunk)
+                yield chunk
+        except Exception as e:
+            self._record_error(prompt, e, time.perf_counter() - start)
+            raise
+        self._record_stream(prompt, chunks, time.perf_counter() - start, ttft)
+
+    def _record_stream(self, prompt: str, chunks: List[str], seconds: float, ttft: float):
+        self._record(prompt, {"response": "".join(chunks), "seconds": seconds,
+                              "ttft": ttft or 0.0, "chunks": [len(c) for c in chunks]})
+
+    def _record_error(self, prompt: str, error: Exception, seconds: float):
+        code = getattr(error, "code", None)
+        self._record(prompt, {"error": str(error), "error_type": type(error).__name__,
+                              "code": code if isinstance(code, int) else None, "seconds": seconds})
+
+    def _record(self, prompt: str, entry: Dict):
+        entry = {"key": prompt_key(prompt), "prompt_chars": len(prompt), **entry}
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self.calls += 1
+            with _open(self.path, "a") as f:
+                f.write(line)
+
+
+class ReplayProvider(ModelProvider):
+    # serves the responses of a recorded run without calling any model. repeated
+    # prompts get their recordings in the order they were made (errors included),
+    # then the last good response again. latency_scale=1.0 sleeps the recorded
+    # latencies, 0 replays as fast as possible. a prompt that was never recorded
+    # raises CassetteMissError, or with strict=False takes the next unused
+    # recording in call order, for runs whose prompts drift slightly
+    def __init__(self, path: str, latency_scale: float = 0.0, strict: bool = True):
+        entries = load_cassette(path)
+        self.path = path
+        self.model_name = entries[0].get("model")
+        self.latency_scale = latency_scale
+        self.strict = strict
+
+        self._pending = {}
+        self._last = {}
+        self._order = deque()
+        for entry in entries[1:]:
+            self._pending.setdefault(entry["key"], deque()).append(entry)
+            self._order.append(entry)
+        self._used = set()
+        self.stats = {"recorded": len(entries) - 1, "replayed": 0, "repeated": 0, "misses": 0}
+        self._lock = threading.Lock()
+
+    def generate(self, prompt: str) -> str:
+        entry = self._next(prompt)
+        time.sleep(entry["seconds"] * self.latency_scale)
+        return self._response(entry)
+
+    async def agenerate(self, prompt: str) -> str:
+        entry = self._next(prompt)
+        await asyncio.sleep(entry["seconds"] * self.latency_scale)
+        return self._response(entry)
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        entry = self._next(prompt)
+        first, gap = self._stream_delays(entry)
+        time.sleep(first)
+        for i, chunk in enumerate(self._chunks(entry)):
+            if i and gap:
+                time.sleep(gap)
+            yield chunk
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        entry = self._next(prompt)
+        first, gap = self._stream_delays(entry)
+        await asyncio.sleep(first)
+        for i, chunk in enumerate(self._chunks(entry)):
+            if i and gap:
+                await asyncio.sleep(gap)
+            yield chunk
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats)
+
+    def _next(self, prompt: str) -> Dict:
+        key = prompt_key(prompt)
+        with self._lock:
+            pending = self._pending.get(key)
+            while pending:
+                entry = pending.popleft()
+                if id(entry) in self._used:
+                    continue
+                return self._take(key, entry)
+            if key in self._last:
+                self.stats["repeated"] += 1
+                return self._last[key]
+
+            self.stats["misses"] += 1
+            if not self.strict:
+                while self._order:
+                    entry = self._order.popleft()
+                    if id(entry) not in self._used:
+                        return self._take(key, entry)
+        raise CassetteMissError(f"No recording for prompt {key[:12]} ({len(prompt)} chars) in {self.path}")
+
+    def _take(self, key: str, entry: Dict) -> Dict:
+        # caller holds the lock
+        self._used.add(id(entry))
+        self.stats["replayed"] += 1
+        if "error" not in entry:
+            self._last[key] = entry
+        return entry
+
+    def _response(self, entry: Dict) -> str:
+        if "error" in entry:
+            raise ReplayedError(f"{entry['error_type']}: {entry['error']}", code=entry.get("code"))
+        return entry["response"]
+
+    def _chunks(self, entry: Dict) -> Iterator[str]:
+        text = self._response(entry)
+        sizes = entry.get("chunks") or [len(text)]
+        offset = 0
+        for size in sizes:
+            yield text[offset:offset + size]
+            offset += size
+        if offset < len(text):
+            yield text[offset:]
+
+    def _stream_delays(self, entry: Dict):
+        # time to first chunk, then the rest of the recorded time spread evenly
+        if not self.latency_scale:
+            return 0.0, 0.0
+        ttft = entry.get("ttft", entry["seconds"])
+        gaps = max(len(entry.get("chunks") or ()) - 1, 1)
+        return ttft * self.latency_scale, (entry["seconds"] - ttft) / gaps * self.latency_scale
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from agent.metrics import MetricsRegistry
+from agent.records import to_json
+
+
+class TaskCheckpoint:
+    # one task run on disk: task.json holds the task, context and plan, and every
+    # completed step gets its own step_<n>.json. each file is written to a temp
+    # file and renamed, so a crash leaves either the old checkpoint or the new one
+    def __init__(self, directory: str, metrics: MetricsRegistry = None):
+        self.directory = directory
+        self.run_id = os.path.basename(directory)
+        self.metrics = metrics
+
+    def save_task(self, task: str, context: Dict = None, plan: Dict = None):
+        self._write("task.json", {
+            "task": task,
+            "context": context or {},
+            "plan": plan,
+            "updated_at": datetime.now().isoformat()
+        })
+
+    def save_step(self, position: int, result: Dict):
+        self._write(f"step_{position:04d}.json", result)
+
+    def load(self) -> Dict:
+        with open(os.path.join(self.directory, "task.json"), 'r') as f:
+            state = json.load(f)
+
+        results = []
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.startswith("step_") and name.endswith(".json")):
+                continue
+            with open(os.path.join(self.directory, name), 'r') as f:
+                result = json.load(f)
+            if self._still_valid(result):
+                results.append(result)
+        state["results"] = results
+        return state
+
+    def finish(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        try:
+            # drop the session directory too once its last run is done
+            os.rmdir(os.path.dirname(self.directory))
+        except OSError:
+            pass
+
+    def _still_valid(self, result: Dict) -> bool:
+        # a step whose output file has since been deleted has to run again
+        if result.get("status") != "completed":
+            return False
+        filepath = (result.get("result") or {}).get("filepath")
+        return not filepath or os.path.exists(filepath)
+
+    def _write(self, name: str, data: Dict):
+        start = time.perf_counter()
+        path = os.path.join(self.directory, name)
+        tmp_path = path + ".tmp"
+        payload = json.dumps(data, indent=2, default=to_json)
+        with open(tmp_path, 'w') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        if self.metrics:
+            self.metrics.observe("agent_storage_save_seconds", time.perf_counter() - start, store="checkpoint")
+            self.metrics.inc("agent_storage_bytes_written", len(payload), store="checkpoint")
+
+
+class CheckpointStore:
+    # checkpoints/<session_id>/<run_id>/ for every task that hasn't finished yet.
+    # a run's directory is removed once the task has been recorded in memory
+    def __init__(self, storage_dir: str = "storage", metrics: MetricsRegistry = None):
+        self.root = os.path.join(storage_dir, "checkpoints")
+        self.metrics = metrics
+
+    def begin(self, session_id: str, task: str, context: Dict = None) -> TaskCheckpoint:
+        # run ids sort by start time, several tasks can share a session
+        run_id = f"{datetime.now().strftime('%Y%m%d%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+        directory = os.path.join(self.root, session_id, run_id)
+        os.makedirs(directory, exist_ok=True)
+        checkpoint = TaskCheckpoint(directory, metrics=self.metrics)
+        checkpoint.save_task(task, context)
+        return checkpoint
+
+    def list_runs(self, session_id: str) -> List[str]:
+        session_dir = os.path.join(self.root, session_id)
+        if not os.path.isdir(session_dir):
+            return []
+        return sorted(name for name in os.listdir(session_dir)
+                      if os.path.exists(os.path.join(session_dir, name, "task.json")))
+
+    def get(self, session_id: str, run_id: str = None) -> Optional[TaskCheckpoint]:
+        # the most recent unfinished run unless one is named
+        runs = self.list_runs(session_id)
+        if run_id is None:
+            run_id = runs[-1] if runs else None
+        if run_id not in runs:
+            return None
+        return TaskCheckpoint(os.path.join(self.root, session_id, run_id), metrics=self.metrics)
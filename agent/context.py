@@ -0,0 +1,137 @@
+import json
+from typing import Dict, List, Any, Tuple
+
+from agent.records import to_json
+
+
+# result fields that hold whole model outputs
+_BODY_FIELDS = ("findings", "calculations", "output", "summary", "content_preview", "preview")
+# result fields that change from run to run, they'd only break prompt caching
+_VOLATILE_FIELDS = ("timestamp", "time_to_first_token")
+
+
+class ContextBuilder:
+    # builds the context handed to the executor for one step, keeping it under a
+    # token budget. direct dependency results go in first, then the steps they
+    # depended on, then the rest of the completed steps newest first. large model
+    # outputs are cut down to a summary, or to the file path when one was written
+    def __init__(self, max_tokens: int = 6000, chars_per_token: int = 4,
+                 max_field_chars: int = 600):
+        self.max_tokens = max_tokens
+        self.chars_per_token = chars_per_token
+        self.max_field_chars = max_field_chars
+
+    def estimate_tokens(self, obj: Any) -> int:
+        return self._size(obj) // self.chars_per_token + 1
+
+    def build(self, step: Dict, context: Dict, results: List[Dict],
+              completed: List[Dict]) -> Tuple[Dict, Dict]:
+        dependencies = step.get("dependencies", [])
+        by_id = {r["step_id"]: r for r in results}
+
+        # what the executor used to get: every dependency result and step as-is
+        naive = {**(context or {}), "previous_steps": list(completed)}
+        if dependencies:
+            naive["dependency_results"] = {d: by_id[d] for d in dependencies if d in by_id}
+        bytes_before = self._size(naive)
+
+        exec_context = dict(context or {})
+        budget = self.max_tokens * self.chars_per_token - self._size(exec_context)
+        summarized = 0
+        dropped = 0
+
+        dep_results = {}
+        for dep_id in dependencies:
+            if dep_id not in by_id:
+                continue
+            compact, was_summarized = self._compact_result(by_id[dep_id])
+            size = self._size(compact)
+            if size > budget:
+                dropped += 1
+                continue
+            dep_results[dep_id] = compact
+            budget -= size
+            summarized += was_summarized
+        if dependencies:
+            exec_context["dependency_results"] = dep_results
+
+        previous_steps = []
+        for prev in self._rank_steps(dependencies, completed):
+            size = self._size(prev)
+            if size > budget:
+                # fall back to just what the step was, without the long description
+                prev = {"id": prev.get("id"), "action": prev.get("action")}
+                size = self._size(prev)
+                if size > budget:
+                    dropped += 1
+                    continue
+                summarized += 1
+            previous_steps.append(prev)
+            budget -= size
+        # keep plan order in the prompt, ranking only decides what survives
+        order = {s.get("id"): n for n, s in enumerate(completed)}
+        previous_steps.sort(key=lambda s: order.get(s.get("id"), 0))
+        exec_context["previous_steps"] = previous_steps
+
+        bytes_after = self._size(exec_context)
+        report = {
+            "bytes_before": bytes_before,
+            "bytes_after": bytes_after,
+            "tokens_before": bytes_before // self.chars_per_token,
+            "tokens_after": bytes_after // self.chars_per_token,
+            "trimmed_bytes": bytes_before - bytes_after,
+            "trimmed_tokens": (bytes_before - bytes_after) // self.chars_per_token,
+            "summarized_items": summarized,
+            "dropped_items": dropped
+        }
+        return exec_context, report
+
+    def _rank_steps(self, dependencies: List, completed: List[Dict]) -> List[Dict]:
+        by_id = {s.get("id"): s for s in completed}
+
+        # direct dependencies, then their dependencies, breadth first
+        ranked, seen = [], set()
+        frontier = list(dependencies)
+        while frontier:
+            next_frontier = []
+            for step_id in frontier:
+                if step_id in seen or step_id not in by_id:
+                    continue
+                seen.add(step_id)
+                ranked.append(by_id[step_id])
+                next_frontier.extend(by_id[step_id].get("dependencies", []))
+            frontier = next_frontier
+
+        for prev in reversed(completed):
+            if prev.get("id") not in seen:
+                ranked.append(prev)
+        return ranked
+
+    def _compact_result(self, result: Dict) -> Tuple[Dict, bool]:
+        # drop volatile fields and shorten big bodies. outputs that were saved to a
+        # file only keep the path and a short preview, the file has the rest
+        compact = {k: v for k, v in result.items() if k not in _VOLATILE_FIELDS}
+        body = result.get("result")
+        if not isinstance(body, dict):
+            return compact, False
+
+        summarized = False
+        limit = 200 if body.get("filepath") else self.max_field_chars
+        new_body = {}
+        for key, value in body.items():
+            if key in _VOLATILE_FIELDS:
+                continue
+            if key == "findings" and "summary" in body and len(value) > limit:
+                # analysis results already carry their own summary
+                summarized = True
+                continue
+            if key in _BODY_FIELDS and isinstance(value, str) and len(value) > limit:
+                value = value[:limit] + f"... [{len(value) - limit} more chars]"
+                summarized = True
+            new_body[key] = value
+        compact["result"] = new_body
+        return compact, summarized
+
+    def _size(self, obj: Any) -> int:
+        # executor prompts embed the context with indent=2, measure it the same way
+        return len(json.dumps(obj, indent=2, default=to_json))
@@ -1,46 +1,160 @@
 import os
 import json
+import asyncio
+import contextlib
+import time
+import uuid
 from typing import Dict, Any, Callable
 from datetime import datetime
-import google.generativeai as genai
+
+from agent.cache import ResponseCache
+from agent.models import ModelProvider, GeminiProvider, ModelClient
+from agent.metrics import MetricsRegistry
+from agent.governor import RequestGovernor
+from agent.records import StepResult, to_json
+from agent.microbatch import StepBatcher, BatchItem
+
+
+# what each short-answer action type asks for, in its own prompt and in a batch
+INSTRUCTIONS = {
+    "analyze_data": "Provide structured analysis with key findings, insights, and recommendations.",
+    "research": "Provide comprehensive research findings with sources and key points.",
+    "calculate_metrics": "Provide calculated metrics with formulas and interpretations.",
+    "generic": "Provide a detailed execution result.",
+    "interpret_metrics": "Explain what these numbers mean for the task, point out anything unusual, "
+                         "and recommend what to track next. Do not recalculate them."
+}
+# action types that can share a model call, the ones whose output is a short answer
+BATCH_ACTIONS = ("analyze_data", "calculate_metrics")
+# how metrics steps are answered: "model" has the model do the arithmetic,
+# "narrate" computes the numbers locally and has the model interpret them, and
+# "fast" computes them locally with no model call at all
+CALCULATION_MODES = ("model", "narrate", "fast")
 
 
 class ActionExecutor:
-    def __init__(self, api_key: str = None, output_dir: str = "outputs"):
-        self.api_key = api_key or os.getenv("GEMINI_API_KEY")
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel('models/gemini-2.5-flash')
+    def __init__(self, api_key: str = None, output_dir: str = "outputs",
+                 cache: ResponseCache = None, provider: ModelProvider = None,
+                 metrics: MetricsRegistry = None, governor: RequestGovernor = None,
+                 stream: bool = False, client: ModelClient = None, batch_steps: bool = False,
+                 batch_window: float = 0.02, max_batch: int = 4, calculation_mode: str = "narrate"):
+        if calculation_mode not in CALCULATION_MODES:
+            raise ValueError(f"Unknown calculation mode: {calculation_mode}")
+        self.provider = client.provider if client else provider or GeminiProvider(api_key=api_key)
+        self.metrics = metrics
+        self.client = client or ModelClient(self.provider, cache=cache, metrics=metrics, governor=governor)
         self.output_dir = output_dir
+        # stream file outputs to disk chunk by chunk instead of waiting for the whole response
+        self.stream = stream
+        # steps of BATCH_ACTIONS running at the same time share one model call
+        self.batcher = StepBatcher(self.client, window=batch_window, max_batch=max_batch,
+                                   metrics=metrics) if batch_steps else None
+        self.calculation_mode = calculation_mode
+        self._metrics_engine = None
         os.makedirs(output_dir, exist_ok=True)
 
+        # each action type is a prompt builder plus a handler that turns the
+        # model output into a result, so sync and async share everything but the call
+        self.prompt_builders = {
+            "create_document": self._create_document_prompt,
+            "analyze_data": self._analyze_data_prompt,
+            "generate_content": self._generate_content_prompt,
+            "research": self._research_prompt,
+            "calculate_metrics": self._calculate_metrics_prompt,
+            "generic": self._generic_prompt
+        }
+
         self.action_handlers = {
             "create_document": self._create_document,
             "analyze_data": self._analyze_data,
             "generate_content": self._generate_content,
             "research": self._research,
-            "calculate_metrics": self._calculate_metrics
+            "calculate_metrics": self._calculate_metrics,
+            "generic": self._generic_execute
+        }
+
+        # action types whose output goes to a file can be streamed there instead
+        self.stream_handlers = {
+            "create_document": self._open_document,
+            "generate_content": self._open_generated_content
+        }
+
+        # action types answered without the model in fast calculation mode
+        self.local_handlers = {
+            "calculate_metrics": self._calculate_metrics_locally
         }
 
     def execute_step(self, step: Dict, context: Dict = None) -> Dict[str, Any]:
         action = step.get("action", "").lower()
         description = step.get("description", "")
+        context = context or {}
 
         # figure out what kind of action this is
         action_type = self._determine_action_type(action, description)
 
         # run the appropriate handler
-        if action_type in self.action_handlers:
-            result = self.action_handlers[action_type](step, context or {})
-        else:
-            result = self._generic_execute(step, context or {})
-
-        return {
-            "step_id": step.get("id"),
-            "action": action,
-            "status": "completed",
-            "result": result,
-            "timestamp": datetime.now().isoformat()
-        }
+        start = time.perf_counter()
+        try:
+            if self.calculation_mode == "fast" and action_type in self.local_handlers:
+                result = self.local_handlers[action_type](step, context)
+            elif self.stream and action_type in self.stream_handlers:
+                prompt = self.prompt_builders[action_type](step, context)
+                result = self._stream_to_file(step, context, prompt, action_type)
+            else:
+                prompt = self.prompt_builders[action_type](step, context)
+                if self.batcher and action_type in BATCH_ACTIONS:
+                    text = self.batcher.generate(self._batch_item(step, context, prompt, action_type))
+                else:
+                    text = self._generate(prompt, action_type)
+                result = self.action_handlers[action_type](step, context, text)
+        except Exception:
+            self._record_step(action_type, start, "failed")
+            raise
+        self._record_step(action_type, start, "completed")
+
+        return self._step_result(step, action, action_type, result)
+
+    def _generate(self, prompt: str, action_type: str = "generic") -> str:
+        return self.client.generate(prompt, action_type=action_type)
+
+    def _batch_item(self, step: Dict, context: Dict, prompt: str, action_type: str) -> BatchItem:
+        if action_type != "calculate_metrics":
+            return BatchItem(step, prompt, INSTRUCTIONS[action_type], context, action_type)
+        # metrics steps only ever see the user data, same as in their own prompt
+        data = context.get("user_data", {})
+        computed = self._computed_metrics(context)
+        if not computed:
+            return BatchItem(step, prompt, INSTRUCTIONS[action_type], data, action_type)
+        return BatchItem(step, prompt, INSTRUCTIONS["interpret_metrics"],
+                         {"available_data": data, **computed}, action_type)
+
+    def _stream_to_file(self, step: Dict, context: Dict, prompt: str, action_type: str) -> Dict:
+        output = self.stream_handlers[action_type](step, context)
+        try:
+            for chunk in self.client.stream(prompt, action_type=action_type):
+                output.write(chunk)
+        except BaseException:
+            output.abort()
+            raise
+        return output.close()
+
+    def _record_step(self, action_type: str, start: float, status: str):
+        if not self.metrics:
+            return
+        self.metrics.observe("agent_step_seconds", time.perf_counter() - start,
+                             action_type=action_type, status=status)
+        if status == "failed":
+            self.metrics.inc("agent_step_failures", action_type=action_type)
+
+    def _step_result(self, step: Dict, action: str, action_type: str, result: Dict) -> StepResult:
+        return StepResult(
+            step_id=step.get("id"),
+            action=action,
+            action_type=action_type,
+            status="completed",
+            result=result,
+            timestamp=datetime.now().isoformat()
+        )
 
     def _determine_action_type(self, action: str, description: str) -> str:
         text = (action + " " + description).lower()
@@ -58,21 +172,24 @@ class ActionExecutor:
         else:
             return "generic"
 
-    def _create_document(self, step: Dict, context: Dict) -> Dict:
-        prompt = f"""Create a professional document based on this requirement:
+    def _create_document_prompt(self, step: Dict, context: Dict) -> str:
+        return f"""Create a professional document based on this requirement:
 
 Task: {step.get('action')}
 Details: {step.get('description')}
 
-Context: {json.dumps(context, indent=2)}
+Context: {json.dumps(context, indent=2, default=to_json)}
 
 Generate a well-structured document with appropriate sections and content."""
 
-        response = self.model.generate_content(prompt)
-        content = response.text
+    def _document_path(self, step: Dict) -> str:
+        return self._output_path("document", step.get('id', 'unknown'), ".md")
+
+    def _open_document(self, step: Dict, context: Dict) -> "StreamedOutput":
+        return StreamedOutput(self._document_path(step), "document", "content_preview", 200)
 
-        filename = f"document_{step.get('id', 'unknown')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.md"
-        filepath = os.path.join(self.output_dir, filename)
+    def _create_document(self, step: Dict, context: Dict, content: str) -> Dict:
+        filepath = self._document_path(step)
 
         with open(filepath, 'w', encoding='utf-8') as f:
             f.write(content)
@@ -83,40 +200,48 @@ Generate a well-structured document with appropriate sections and content."""
             "content_preview": content[:200] + "..." if len(content) > 200 else content
         }
 
-    def _analyze_data(self, step: Dict, context: Dict) -> Dict:
-        prompt = f"""Perform analysis based on this requirement:
+    def _analyze_data_prompt(self, step: Dict, context: Dict) -> str:
+        return f"""Perform analysis based on this requirement:
 
 Task: {step.get('action')}
 Details: {step.get('description')}
 
-Data context: {json.dumps(context, indent=2)}
+Data context: {json.dumps(context, indent=2, default=to_json)}
 
-Provide structured analysis with key findings, insights, and recommendations."""
-
-        response = self.model.generate_content(prompt)
-        analysis = response.text
+{INSTRUCTIONS['analyze_data']}"""
 
+    def _analyze_data(self, step: Dict, context: Dict, analysis: str) -> Dict:
         return {
             "type": "analysis",
             "findings": analysis,
             "summary": analysis[:300] + "..." if len(analysis) > 300 else analysis
         }
 
-    def _generate_content(self, step: Dict, context: Dict) -> Dict:
-        prompt = f"""Generate content for:
+    def _generate_content_prompt(self, step: Dict, context: Dict) -> str:
+        return f"""Generate content for:
 
 Task: {step.get('action')}
 Requirements: {step.get('description')}
 
-Context: {json.dumps(context, indent=2)}
+Context: {json.dumps(context, indent=2, default=to_json)}
 
 Create high-quality, relevant content that meets the requirements."""
 
-        response = self.model.generate_content(prompt)
-        content = response.text
+    def _generated_content_path(self, step: Dict) -> str:
+        return self._output_path("generated", step.get('id', 'content'), ".txt")
+
+    def _output_path(self, prefix: str, step_id: Any, extension: str) -> str:
+        # step ids repeat across tasks, the random suffix keeps tasks running at
+        # the same time from writing (or aborting) each other's files
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"{prefix}_{step_id}_{stamp}_{uuid.uuid4().hex[:8]}{extension}"
+        return os.path.join(self.output_dir, filename)
 
-        filename = f"generated_{step.get('id', 'content')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        filepath = os.path.join(self.output_dir, filename)
+    def _open_generated_content(self, step: Dict, context: Dict) -> "StreamedOutput":
+        return StreamedOutput(self._generated_content_path(step), "generated_content", "preview", 250)
+
+    def _generate_content(self, step: Dict, context: Dict, content: str) -> Dict:
+        filepath = self._generated_content_path(step)
 
         with open(filepath, 'w', encoding='utf-8') as f:
             f.write(content)
@@ -127,59 +252,209 @@ Create high-quality, relevant content that meets the requirements."""
             "preview": content[:250] + "..." if len(content) > 250 else content
         }
 
-    def _research(self, step: Dict, context: Dict) -> Dict:
-        prompt = f"""Research and compile information on:
+    def _research_prompt(self, step: Dict, context: Dict) -> str:
+        return f"""Research and compile information on:
 
 Topic: {step.get('action')}
 Focus: {step.get('description')}
 
-Context: {json.dumps(context, indent=2)}
-
-Provide comprehensive research findings with sources and key points."""
+Context: {json.dumps(context, indent=2, default=to_json)}
 
-        response = self.model.generate_content(prompt)
-        research_output = response.text
+{INSTRUCTIONS['research']}"""
 
+    def _research(self, step: Dict, context: Dict, research_output: str) -> Dict:
         return {
             "type": "research",
             "findings": research_output
         }
 
-    def _calculate_metrics(self, step: Dict, context: Dict) -> Dict:
+    def _calculate_metrics_prompt(self, step: Dict, context: Dict) -> str:
         data = context.get("user_data", {})
-
-        prompt = f"""Calculate relevant metrics based on:
+        computed = self._computed_metrics(context)
+        if computed:
+            return f"""Interpret these metrics, calculated from the data below:
 
 Task: {step.get('action')}
 Details: {step.get('description')}
 
-Available data: {json.dumps(data, indent=2)}
+Available data: {json.dumps(data, indent=2, default=to_json)}
+
+Calculated metrics: {json.dumps(computed, indent=2)}
+
+{INSTRUCTIONS['interpret_metrics']}"""
 
-Provide calculated metrics with formulas and interpretations."""
+        return f"""Calculate relevant metrics based on:
 
-        response = self.model.generate_content(prompt)
-        metrics_output = response.text
+Task: {step.get('action')}
+Details: {step.get('description')}
+
+Available data: {json.dumps(data, indent=2, default=to_json)}
 
+{INSTRUCTIONS['calculate_metrics']}"""
+
+    def _calculate_metrics(self, step: Dict, context: Dict, metrics_output: str) -> Dict:
         return {
             "type": "metrics",
             "calculations": metrics_output,
-            "data_used": data
+            "data_used": context.get("user_data", {}),
+            **self._computed_metrics(context)
+        }
+
+    def _calculate_metrics_locally(self, step: Dict, context: Dict) -> Dict:
+        computed = self._computed_metrics(context)
+        if computed:
+            lines = [self._metrics_engine.describe(computed["metrics"])]
+            lines += [f"Warning: {warning}" for warning in computed.get("metric_warnings", [])]
+            text = "\n".join(lines)
+        else:
+            text = "No metrics could be calculated from the available data."
+        return {
+            "type": "metrics",
+            "calculations": text,
+            "data_used": context.get("user_data", {}),
+            **computed
         }
 
-    def _generic_execute(self, step: Dict, context: Dict) -> Dict:
-        prompt = f"""Execute this task step:
+    def _computed_metrics(self, context: Dict) -> Dict:
+        # standard SaaS metrics worked out from user_data (and each of its
+        # "cohorts", in the same pass). {} in model mode or when nothing applies
+        data = context.get("user_data")
+        if self.calculation_mode == "model" or not isinstance(data, dict):
+            return {}
+        if self._metrics_engine is None:
+            # numpy is only imported once a metrics step runs
+            from agent.saas_metrics import SaaSMetricsEngine
+            self._metrics_engine = SaaSMetricsEngine()
+
+        cohorts = [c for c in data.get("cohorts") or [] if isinstance(c, dict)]
+        rows = self._metrics_engine.compute_many([data] + cohorts)
+        if not any(rows):
+            return {}
+        computed = {"metrics": rows[0]}
+        if cohorts:
+            computed["cohort_metrics"] = rows[1:]
+        warnings = self._metrics_engine.warnings(rows[0])
+        if warnings:
+            computed["metric_warnings"] = warnings
+        return computed
+
+    def _generic_prompt(self, step: Dict, context: Dict) -> str:
+        return f"""Execute this task step:
 
 Action: {step.get('action')}
 Description: {step.get('description')}
 
-Context: {json.dumps(context, indent=2)}
-
-Provide a detailed execution result."""
+Context: {json.dumps(context, indent=2, default=to_json)}
 
-        response = self.model.generate_content(prompt)
-        result = response.text
+{INSTRUCTIONS['generic']}"""
 
+    def _generic_execute(self, step: Dict, context: Dict, result: str) -> Dict:
         return {
             "type": "generic",
             "output": result
         }
+
+
+class StreamedOutput:
+    # an output file being written as the model streams it. only the preview is
+    # kept in memory, and the result matches what the non-streaming handler returns
+    def __init__(self, filepath: str, result_type: str, preview_key: str, preview_chars: int):
+        self.filepath = filepath
+        self.result_type = result_type
+        self.preview_key = preview_key
+        self.preview_chars = preview_chars
+
+        self.preview = ""
+        self.chars = 0
+        self.ttft = None
+        self._start = time.perf_counter()
+        self._file = open(filepath, 'w', encoding='utf-8')
+
+    def write(self, chunk: str):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self._start
+        self._file.write(chunk)
+        # flushed per chunk so someone tailing the file sees it grow
+        self._file.flush()
+        self.chars += len(chunk)
+        if len(self.preview) <= self.preview_chars:
+            self.preview += chunk[:self.preview_chars + 1 - len(self.preview)]
+
+    def close(self) -> Dict:
+        self._file.close()
+        preview = self.preview[:self.preview_chars] + "..." if self.chars > self.preview_chars else self.preview
+        return {
+            "type": self.result_type,
+            "filepath": self.filepath,
+            self.preview_key: preview,
+            "chars_written": self.chars,
+            "time_to_first_token": self.ttft
+        }
+
+    def abort(self):
+        # a half-written file would look like a finished output
+        self._file.close()
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+
+class AsyncActionExecutor(ActionExecutor):
+    # same handlers, but the model call is awaited so many steps can share one loop
+    def __init__(self, api_key: str = None, output_dir: str = "outputs",
+                 max_concurrency: int = 8, semaphore: asyncio.Semaphore = None,
+                 cache: ResponseCache = None, provider: ModelProvider = None,
+                 metrics: MetricsRegistry = None, governor: RequestGovernor = None,
+                 stream: bool = False, client: ModelClient = None, batch_steps: bool = False,
+                 batch_window: float = 0.02, max_batch: int = 4, calculation_mode: str = "narrate"):
+        super().__init__(api_key=api_key, output_dir=output_dir, cache=cache,
+                         provider=provider, metrics=metrics, governor=governor, stream=stream,
+                         client=client, batch_steps=batch_steps, batch_window=batch_window,
+                         max_batch=max_batch, calculation_mode=calculation_mode)
+        # pass a shared semaphore to cap model calls across several executors
+        self.semaphore = semaphore or asyncio.Semaphore(max_concurrency)
+
+    async def aexecute_step(self, step: Dict, context: Dict = None) -> Dict[str, Any]:
+        action = step.get("action", "").lower()
+        description = step.get("description", "")
+        context = context or {}
+
+        action_type = self._determine_action_type(action, description)
+
+        start = time.perf_counter()
+        try:
+            if self.calculation_mode == "fast" and action_type in self.local_handlers:
+                result = self.local_handlers[action_type](step, context)
+            elif self.stream and action_type in self.stream_handlers:
+                prompt = self.prompt_builders[action_type](step, context)
+                result = await self._astream_to_file(step, context, prompt, action_type)
+            else:
+                prompt = self.prompt_builders[action_type](step, context)
+                if self.batcher and action_type in BATCH_ACTIONS:
+                    text = await self.batcher.agenerate(self._batch_item(step, context, prompt, action_type),
+                                                        semaphore=self.semaphore)
+                else:
+                    text = await self._agenerate(prompt, action_type)
+                # output files are small local writes, not worth a thread hop
+                result = self.action_handlers[action_type](step, context, text)
+        except Exception:
+            self._record_step(action_type, start, "failed")
+            raise
+        self._record_step(action_type, start, "completed")
+
+        return self._step_result(step, action, action_type, result)
+
+    async def _agenerate(self, prompt: str, action_type: str = "generic") -> str:
+        return await self.client.agenerate(prompt, semaphore=self.semaphore, action_type=action_type)
+
+    async def _astream_to_file(self, step: Dict, context: Dict, prompt: str, action_type: str) -> Dict:
+        output = self.stream_handlers[action_type](step, context)
+        chunks = self.client.astream(prompt, semaphore=self.semaphore, action_type=action_type)
+        try:
+            # aclosing releases the semaphore right away if writing the file fails
+            async with contextlib.aclosing(chunks):
+                async for chunk in chunks:
+                    output.write(chunk)
+        except BaseException:
+            output.abort()
+            raise
+        return output.close()
@@ -0,0 +1,347 @@
+import asyncio
+import concurrent.futures
+import random
+import threading
+import time
+from typing import Callable, Awaitable, Iterator, AsyncIterator
+
+from agent.metrics import MetricsRegistry, estimate_tokens, CHARS_PER_TOKEN
+
+
+# HTTP statuses and google.api_core exception names worth retrying
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable",
+                   "InternalServerError", "DeadlineExceeded", "GatewayTimeout", "Aborted"}
+# the ones that mean we are sending too much
+CONGESTION_CODES = {429}
+CONGESTION_NAMES = {"ResourceExhausted", "TooManyRequests"}
+
+
+class DeadlineExceededError(TimeoutError):
+    pass
+
+
+class _AbandonedCallError(DeadlineExceededError):
+    # a blocking call that timed out but is still running in the pool. it keeps
+    # its concurrency slot until it really finishes
+    pass
+
+
+# what next() returns for an exhausted stream
+_END = object()
+
+
+def _status_code(error: Exception):
+    code = getattr(error, "code", None)
+    if callable(code):
+        # grpc style errors expose code() instead of an int
+        return None
+    return code
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    return _status_code(error) in RETRYABLE_CODES or type(error).__name__ in RETRYABLE_NAMES
+
+
+def is_congestion(error: Exception) -> bool:
+    if isinstance(error, TimeoutError):
+        return True
+    return _status_code(error) in CONGESTION_CODES or type(error).__name__ in CONGESTION_NAMES
+
+
+class TokenBucket:
+    # refills at rate_per_minute, holds at most one minute's worth. reserve() takes
+    # the amount up front and returns how long the caller must wait for it, which
+    # lets the balance go negative so big requests queue behind each other
+    def __init__(self, rate_per_minute: float):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = rate_per_minute
+        self.tokens = rate_per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def charge(self, amount: float):
+        # settle the difference once the real size is known
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RequestGovernor:
+    # shared by every model call of an agent. calls are admitted by requests- and
+    # tokens-per-minute buckets and an adaptive concurrency limit: each success
+    # raises the limit by 1/limit, each rate limit or timeout halves it (AIMD).
+    # retryable errors are retried with full-jitter exponential backoff until
+    # max_retries or the call's deadline runs out
+    def __init__(self, rpm: float = None, tpm: float = None, max_concurrency: int = 8,
+                 min_concurrency: int = 1, initial_concurrency: int = None,
+                 max_retries: int = 4, base_delay: float = 0.5, max_delay: float = 30.0,
+                 timeout: float = 120.0, deadline: float = 300.0,
+                 expected_response_tokens: int = 1000, metrics: MetricsRegistry = None,
+                 seed: int = None):
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(initial_concurrency or max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # per attempt, and for the whole call including retries
+        self.timeout = timeout
+        self.deadline = deadline
+        self.expected_response_tokens = expected_response_tokens
+        self.metrics = metrics
+
+        self.in_flight = 0
+        self.stats = {"calls": 0, "retries": 0, "throttled_seconds": 0.0,
+                      "rate_limited": 0, "timeouts": 0, "gave_up": 0}
+        self._rng = random.Random(seed)
+        self._cond = threading.Condition()
+        # blocking provider calls run here so a stuck request can be abandoned
+        self._pool = None
+
+    def call(self, fn: Callable[[str], str], prompt: str, action_type: str = "generic") -> str:
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            self._throttle_sync(prompt, action_type)
+            self._acquire_sync(deadline)
+            timeout = self._attempt_timeout(deadline)
+            try:
+                text = self._run_with_timeout(fn, (prompt,), time.monotonic() + timeout, timeout)
+            except Exception as e:
+                self._release(e, free=not isinstance(e, _AbandonedCallError))
+                delay = self._next_delay(e, attempt, deadline, action_type)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._release(None)
+            self._settle(text)
+            return text
+
+    async def acall(self, fn: Callable[[str], Awaitable[str]], prompt: str,
+                    action_type: str = "generic") -> str:
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            await self._throttle_async(prompt, action_type)
+            await self._acquire_async(deadline)
+            try:
+                timeout = self._attempt_timeout(deadline)
+                text = await asyncio.wait_for(fn(prompt), timeout=timeout)
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    e = DeadlineExceededError(f"Model call timed out after {timeout:.1f}s")
+                self._release(e)
+                delay = self._next_delay(e, attempt, deadline, action_type)
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self._release(None)
+            self._settle(text)
+            return text
+
+    def stream(self, fn: Callable[[str], Iterator[str]], prompt: str,
+               action_type: str = "generic") -> Iterator[str]:
+        # a stream is only retried if it fails before the first chunk, after that
+        # the caller already has part of the output. the attempt timeout covers the
+        # whole stream, chunks are pulled on the pool so a stalled one can be abandoned
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            self._throttle_sync(prompt, action_type)
+            self._acquire_sync(deadline)
+            timeout = self._attempt_timeout(deadline)
+            until = time.monotonic() + timeout
+            chars = 0
+            chunks = None
+            try:
+                chunks = iter(fn(prompt))
+                while True:
+                    chunk = self._run_with_timeout(next, (chunks, _END), until, timeout)
+                    if chunk is _END:
+                        break
+                    chars += len(chunk)
+                    yield chunk
+            except Exception as e:
+                self._release(e, free=not isinstance(e, _AbandonedCallError))
+                if chars:
+                    raise
+                time.sleep(self._next_delay(e, attempt, deadline, action_type))
+                attempt += 1
+                continue
+            except BaseException:
+                # generator closed early by the consumer, says nothing about the model
+                self._release(adjust=False)
+                if hasattr(chunks, "close"):
+                    chunks.close()
+                raise
+            self._release(None)
+            self._settle_chars(chars)
+            return
+
+    async def astream(self, fn: Callable[[str], AsyncIterator[str]], prompt: str,
+                      action_type: str = "generic") -> AsyncIterator[str]:
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            await self._throttle_async(prompt, action_type)
+            await self._acquire_async(deadline)
+            timeout = self._attempt_timeout(deadline)
+            until = time.monotonic() + timeout
+            chars = 0
+            try:
+                chunks = fn(prompt).__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(),
+                                                       timeout=max(0.0, until - time.monotonic()))
+                    except StopAsyncIteration:
+                        break
+                    except asyncio.TimeoutError:
+                        raise DeadlineExceededError(f"Model call timed out after {timeout:.1f}s")
+                    chars += len(chunk)
+                    yield chunk
+            except Exception as e:
+                self._release(e)
+                if chars:
+                    raise
+                await asyncio.sleep(self._next_delay(e, attempt, deadline, action_type))
+                attempt += 1
+                continue
+            except BaseException:
+                # closed early or cancelled
+                self._release(adjust=False)
+                raise
+            self._release(None)
+            self._settle_chars(chars)
+            return
+
+    def get_stats(self):
+        with self._cond:
+            return {**self.stats, "concurrency_limit": self.limit, "in_flight": self.in_flight}
+
+    def _throttle_sync(self, prompt: str, action_type: str):
+        wait = self._reserve(prompt)
+        if wait > 0:
+            self._record_throttle(wait, action_type)
+            time.sleep(wait)
+
+    async def _throttle_async(self, prompt: str, action_type: str):
+        wait = self._reserve(prompt)
+        if wait > 0:
+            self._record_throttle(wait, action_type)
+            await asyncio.sleep(wait)
+
+    def _reserve(self, prompt: str) -> float:
+        wait = 0.0
+        if self.request_bucket:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket:
+            tokens = estimate_tokens(prompt) + self.expected_response_tokens
+            wait = max(wait, self.token_bucket.reserve(tokens))
+        return wait
+
+    def _settle(self, text: str):
+        self._settle_chars(len(text))
+
+    def _settle_chars(self, chars: int):
+        # the reservation assumed expected_response_tokens, charge the difference
+        if self.token_bucket:
+            self.token_bucket.charge(chars // CHARS_PER_TOKEN - self.expected_response_tokens)
+
+    def _acquire_sync(self, deadline: float):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceededError("Deadline passed waiting for a model call slot")
+                self._cond.wait(timeout=remaining)
+            self.in_flight += 1
+            self.stats["calls"] += 1
+
+    async def _acquire_async(self, deadline: float):
+        # the condition belongs to threads, so the event loop polls for a free slot
+        while True:
+            with self._cond:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    self.stats["calls"] += 1
+                    return
+            if time.monotonic() >= deadline:
+                raise DeadlineExceededError("Deadline passed waiting for a model call slot")
+            await asyncio.sleep(0.01)
+
+    def _release(self, error: Exception = None, adjust: bool = True, free: bool = True):
+        # adjust=False frees the slot without counting an outcome (a call the caller
+        # gave up on), free=False counts the outcome but keeps the slot taken
+        with self._cond:
+            if free:
+                self.in_flight -= 1
+            if adjust and error is None:
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            elif adjust and is_congestion(error):
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self.stats["timeouts" if isinstance(error, TimeoutError) else "rate_limited"] += 1
+            self._cond.notify_all()
+
+    def _next_delay(self, error: Exception, attempt: int, deadline: float, action_type: str) -> float:
+        # re-raises when the error isn't worth retrying or there's no time left
+        delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = getattr(error, "retry_after", None)
+        if isinstance(retry_after, (int, float)):
+            delay = max(delay, retry_after)
+
+        if (not is_retryable(error) or attempt >= self.max_retries
+                or time.monotonic() + delay >= deadline):
+            with self._cond:
+                self.stats["gave_up"] += is_retryable(error)
+            raise error
+
+        with self._cond:
+            self.stats["retries"] += 1
+        if self.metrics:
+            self.metrics.inc("agent_llm_retries", action_type=action_type)
+        return delay
+
+    def _attempt_timeout(self, deadline: float) -> float:
+        return min(self.timeout, max(0.0, deadline - time.monotonic()))
+
+    def _run_with_timeout(self, fn: Callable, args: tuple, until: float, timeout: float):
+        # fn(*args) on the pool, abandoned at until. timeout is only for the message
+        with self._cond:
+            if self._pool is None:
+                # slots are held until abandoned calls finish, so in-flight calls
+                # never outnumber max_concurrency
+                self._pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_concurrency, thread_name_prefix="model-call")
+        future = self._pool.submit(fn, *args)
+        try:
+            return future.result(timeout=max(0.0, until - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            # the provider call can't be interrupted. it finishes in the background
+            # and only then gives its slot back
+            if not future.cancel():
+                future.add_done_callback(lambda f: self._release(adjust=False))
+                raise _AbandonedCallError(f"Model call timed out after {timeout:.1f}s")
+            raise DeadlineExceededError(f"Model call timed out after {timeout:.1f}s")
+
+    def _record_throttle(self, wait: float, action_type: str):
+        with self._cond:
+            self.stats["throttled_seconds"] += wait
+        if self.metrics:
+            self.metrics.observe("agent_llm_throttle_seconds", wait, action_type=action_type)
@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Any, Callable
+
+from agent.metrics import MetricsRegistry
+from agent.records import dumps, to_json
+
+
+FSYNC_POLICIES = ("always", "interval", "never")
+
+
+def apply_op(data: Dict, op: Dict):
+    kind = op["op"]
+    if kind == "set":
+        data[op["key"]] = op["value"]
+    elif kind == "append":
+        data.setdefault(op["key"], []).append(op["value"])
+    elif kind == "set_item":
+        data.setdefault(op["key"], {})[op["field"]] = op["value"]
+    elif kind == "del_item":
+        data.get(op["key"], {}).pop(op["field"], None)
+    elif kind == "update_item":
+        # a few fields of a large item, without writing the whole item again
+        item = data.get(op["key"], {}).get(op["field"])
+        if item is not None:
+            item.update(op["value"])
+    else:
+        raise ValueError(f"Unknown journal op: {kind}")
+
+
+class Journal:
+    # JSON snapshot plus an append-only JSONL log of changes made since it was written.
+    # every op carries a sequence number and the snapshot records the last one it
+    # contains, so a crash between snapshot and truncate never replays an op twice
+    def __init__(self, snapshot_path: str, default: Callable[[], Dict],
+                 fsync: str = "interval", fsync_interval: float = 1.0,
+                 compact_every: int = 200, indent: int = None,
+                 metrics: MetricsRegistry = None, store: str = None):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got {fsync!r}")
+
+        self.snapshot_path = snapshot_path
+        self.journal_path = os.path.splitext(snapshot_path)[0] + ".wal.jsonl"
+        self.default = default
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.indent = indent
+        self.metrics = metrics
+        self.store = store or os.path.basename(snapshot_path)
+
+        self.seq = 0
+        self.ops_since_snapshot = 0
+        self.bytes_written = 0
+        self._last_fsync = time.time()
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict:
+        data = self.default()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                data = json.load(f)
+        self.seq = data.pop("_journal_seq", 0)
+
+        if not os.path.exists(self.journal_path):
+            return data
+
+        good_offset = 0
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                # a missing newline or bad JSON is a torn write from a crash,
+                # everything after it is unreliable
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    op = json.loads(line)
+                except ValueError:
+                    break
+                good_offset += len(line)
+                if op["seq"] <= self.seq:
+                    continue
+                apply_op(data, op)
+                self.seq = op["seq"]
+                self.ops_since_snapshot += 1
+
+        # drop the torn tail so new appends start on a clean line
+        if good_offset < os.path.getsize(self.journal_path):
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(good_offset)
+
+        return data
+
+    def append(self, op: Dict[str, Any], data: Dict):
+        # data is the live structure the op was already applied to, used for compaction
+        start = time.perf_counter()
+        with self._lock:
+            self.seq += 1
+            line = dumps({"seq": self.seq, **op}) + "\n"
+
+            if self._file is None:
+                self._file = open(self.journal_path, 'a', encoding='utf-8')
+            self._file.write(line)
+            self._file.flush()
+            self.bytes_written += len(line)
+            self._maybe_fsync()
+
+            self.ops_since_snapshot += 1
+            if self.ops_since_snapshot >= self.compact_every:
+                self._snapshot(data)
+        self._record_write(start, len(line))
+
+    def snapshot(self, data: Dict):
+        start = time.perf_counter()
+        with self._lock:
+            self._snapshot(data)
+        self._record_write(start, 0)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._file = None
+
+    def _record_write(self, start: float, size: int):
+        if not self.metrics:
+            return
+        self.metrics.observe("agent_storage_save_seconds", time.perf_counter() - start, store=self.store)
+        if size:
+            self.metrics.inc("agent_storage_bytes_written", size, store=self.store)
+
+    def _maybe_fsync(self):
+        if self.fsync == "always":
+            os.fsync(self._file.fileno())
+        elif self.fsync == "interval":
+            now = time.time()
+            if now - self._last_fsync >= self.fsync_interval:
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+
+    def _snapshot(self, data: Dict):
+        # caller holds the lock. write to a temp file and rename so a crash leaves
+        # either the old or the new snapshot, then start an empty journal
+        tmp_path = self.snapshot_path + ".tmp"
+        payload = json.dumps({**data, "_journal_seq": self.seq}, indent=self.indent, default=to_json)
+        with open(tmp_path, 'w') as f:
+            f.write(payload)
+            f.flush()
+            if self.fsync != "never":
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.bytes_written += len(payload)
+        if self.metrics:
+            self.metrics.inc("agent_storage_bytes_written", len(payload), store=self.store)
+
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.journal_path, 'w', encoding='utf-8')
+        self.ops_since_snapshot = 0
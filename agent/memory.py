@@ -1,60 +1,147 @@
-import json
 import os
+import threading
 from datetime import datetime
 from typing import Dict, List, Any, Optional
 
+from agent.journal import Journal
+from agent.storage import MemoryBackend, JsonMemoryBackend, SQLiteMemoryBackend
+from agent.metrics import MetricsRegistry
+from agent.records import TaskRecord
+from agent.blobs import BlobStore
+
+
+def _default_state() -> Dict:
+    # task progress lives under runs, keyed by checkpoint run id, so tasks
+    # running at the same time in one session don't overwrite each other
+    return {
+        "runs": {},
+        "session_id": None
+    }
+
 
 class StateManager:
-    # handles both current session state and long term memory
-    def __init__(self, storage_dir="storage"):
+    # handles both current session state and long term memory.
+    # session state changes are appended to a journal next to agent_state.json and
+    # folded back into it every compact_every changes. long term memory lives in a
+    # pluggable backend: "json" (journaled long_term_memory.json) or "sqlite".
+    # with a blob store, large state values, plans and step results are kept
+    # there and records only hold references, resolved again when read
+    def __init__(self, storage_dir="storage", fsync: str = "interval", compact_every: int = 200,
+                 backend="json", metrics: MetricsRegistry = None, blobs: BlobStore = None):
         self.storage_dir = storage_dir
+        self.metrics = metrics
+        self.blobs = blobs
         self.state_file = os.path.join(storage_dir, "agent_state.json")
-        self.memory_file = os.path.join(storage_dir, "long_term_memory.json")
 
         # make sure storage directory exists
         os.makedirs(storage_dir, exist_ok=True)
 
+        self.state_journal = Journal(self.state_file, _default_state, fsync=fsync,
+                                     compact_every=compact_every, indent=2,
+                                     metrics=metrics, store="state")
         self.current_state = self._load_state()
-        self.long_term = self._load_memory()
+        self._state_lock = threading.Lock()
+
+        # long term memory and the similarity index are opened on first use,
+        # a CLI call or batch worker that never gets to planning never reads them
+        self._backend_options = (backend, fsync, compact_every)
+        self._backend = None
+        self._similarity = None
+        self._load_lock = threading.RLock()
+
+    @property
+    def backend(self) -> MemoryBackend:
+        if self._backend is None:
+            with self._load_lock:
+                if self._backend is None:
+                    self._backend = self._make_backend(*self._backend_options)
+        return self._backend
+
+    @property
+    def similarity(self):
+        if self._similarity is None:
+            with self._load_lock:
+                if self._similarity is None:
+                    # numpy is most of the import time, leave it until the index is needed
+                    from agent.similarity import SimilarityIndex
+                    similarity = SimilarityIndex(self.storage_dir, metrics=self.metrics)
+                    self._backfill_similarity(similarity)
+                    self._similarity = similarity
+        return self._similarity
+
+    def _make_backend(self, backend, fsync: str, compact_every: int) -> MemoryBackend:
+        if isinstance(backend, MemoryBackend):
+            return backend
+        if backend == "json":
+            return JsonMemoryBackend(self.storage_dir, fsync=fsync, compact_every=compact_every,
+                                     metrics=self.metrics)
+        if backend == "sqlite":
+            return SQLiteMemoryBackend(self.storage_dir, metrics=self.metrics)
+        raise ValueError(f"Unknown memory backend: {backend}")
+
+    def _backfill_similarity(self, similarity):
+        # memory written before the index existed gets indexed once
+        from agent.similarity import task_text
+        if len(similarity):
+            return
+        tasks = [self._resolve_task(t) for t in self.backend.query_tasks()]
+        similarity.add_many([(t["task_id"], task_text(t), t.get("type"))
+                                  for t in reversed(tasks)])
 
     def _load_state(self) -> Dict:
-        if os.path.exists(self.state_file):
-            with open(self.state_file, 'r') as f:
-                return json.load(f)
-        return {
-            "current_task": None,
-            "plan": [],
-            "completed_steps": [],
-            "pending_steps": [],
-            "context": {},
-            "session_id": None
-        }
-
-    def _load_memory(self) -> Dict:
-        if os.path.exists(self.memory_file):
-            with open(self.memory_file, 'r') as f:
-                return json.load(f)
-        return {
-            "past_tasks": [],
-            "learned_patterns": {},
-            "user_preferences": {},
-            "decisions": []
-        }
+        return self.state_journal.load()
 
     def save_state(self):
-        with open(self.state_file, 'w') as f:
-            json.dump(self.current_state, f, indent=2)
+        # full snapshot, normal updates only append to the journal
+        self.state_journal.snapshot(self.current_state)
 
-    def save_memory(self):
-        with open(self.memory_file, 'w') as f:
-            json.dump(self.long_term, f, indent=2)
+    def flush(self):
+        self.state_journal.close()
+        if self._backend is not None:
+            self._backend.flush()
 
     def update_state(self, key: str, value: Any):
-        self.current_state[key] = value
-        self.save_state()
+        if self.blobs:
+            value = self.blobs.pack(value)
+        with self._state_lock:
+            self.current_state[key] = value
+            self.state_journal.append({"op": "set", "key": key, "value": value}, self.current_state)
 
     def get_state(self, key: str) -> Any:
-        return self.current_state.get(key)
+        value = self.current_state.get(key)
+        return self.blobs.resolve(value) if self.blobs else value
+
+    def start_run(self, run_id: str, task: str, context: Dict = None, plan: Dict = None):
+        run = {"task": task, "context": context or {}, "plan": plan,
+               "completed_steps": [], "pending_steps": (plan or {}).get("steps", [])}
+        if self.blobs:
+            run = {key: self.blobs.pack(value) for key, value in run.items()}
+        with self._state_lock:
+            self.current_state.setdefault("runs", {})[run_id] = run
+            self.state_journal.append({"op": "set_item", "key": "runs", "field": run_id, "value": run},
+                                      self.current_state)
+
+    def update_run(self, run_id: str, **fields):
+        if self.blobs:
+            fields = {key: self.blobs.pack(value) for key, value in fields.items()}
+        with self._state_lock:
+            run = self.current_state.setdefault("runs", {}).get(run_id)
+            if run is None:
+                return
+            run.update(fields)
+            self.state_journal.append({"op": "update_item", "key": "runs", "field": run_id,
+                                       "value": fields}, self.current_state)
+
+    def get_run(self, run_id: str) -> Optional[Dict]:
+        run = self.current_state.get("runs", {}).get(run_id)
+        return self.blobs.resolve(run) if self.blobs else run
+
+    def end_run(self, run_id: str):
+        # finished runs are in long term memory, only unfinished ones stay here
+        with self._state_lock:
+            self.current_state.get("runs", {}).pop(run_id, None)
+            self.state_journal.append({"op": "del_item", "key": "runs", "field": run_id},
+                                      self.current_state)
 
     def record_decision(self, decision: str, reasoning: str, context: Dict):
         decision_record = {
@@ -63,36 +150,68 @@ class StateManager:
             "reasoning": reasoning,
             "context": context
         }
-        self.long_term["decisions"].append(decision_record)
-        self.save_memory()
+        if self.blobs:
+            self.backend.add_decision({**decision_record, "context": self.blobs.externalize(context)})
+        else:
+            self.backend.add_decision(decision_record)
         return decision_record
 
     def store_user_preference(self, key: str, value: Any):
-        self.long_term["user_preferences"][key] = value
-        self.save_memory()
+        self.backend.set_preference(key, value)
 
     def get_user_preference(self, key: str) -> Optional[Any]:
-        return self.long_term["user_preferences"].get(key)
-
-    def add_completed_task(self, task_info: Dict):
-        task_record = {
-            **task_info,
-            "completed_at": datetime.now().isoformat()
-        }
-        self.long_term["past_tasks"].append(task_record)
-        self.save_memory()
-
-    def get_relevant_past_tasks(self, task_type: str) -> List[Dict]:
-        return [t for t in self.long_term["past_tasks"]
-                if t.get("type") == task_type]
+        return self.backend.get_preference(key)
+
+    def add_completed_task(self, task_info: Dict) -> int:
+        # opened (and backfilled) before the new task is in the backend, or it would be indexed twice
+        similarity = self.similarity
+        from agent.similarity import task_text
+        task_record = TaskRecord(task_info, completed_at=datetime.now().isoformat())
+        text = task_text(task_record)
+        if self.blobs:
+            # each result stays an object so backends can still read its step_id and status
+            task_record["plan"] = self.blobs.externalize(task_record.get("plan"))
+            task_record["results"] = [self.blobs.externalize(r) for r in task_record.get("results", [])]
+        task_id = self.backend.add_task(task_record)
+        similarity.add(task_id, text, task_record.get("type"))
+        return task_id
+
+    def get_relevant_past_tasks(self, task_type: str, limit: int = None) -> List[Dict]:
+        # oldest first with their step results, as always. with limit, the latest
+        # ones. query_past_tasks is the cheaper newest-first query without results
+        tasks = self.query_past_tasks(task_type=task_type, limit=limit, include_results=True)
+        tasks.reverse()
+        return tasks
+
+    def count_past_tasks(self, task_type: str = None) -> int:
+        return self.similarity.count(task_type)
+
+    def find_similar_tasks(self, text: str, k: int = 3, task_type: str = None,
+                           min_score: float = 0.2) -> List[Dict]:
+        # past task summaries most like text, best first, each with its "similarity"
+        matches = self.similarity.search(text, k=k, task_type=task_type, min_score=min_score)
+        scores = dict(matches)
+        tasks = [self._resolve_task(t) for t in self.backend.get_tasks([task_id for task_id, _ in matches])]
+        return [{**task, "similarity": round(scores[task["task_id"]], 3)} for task in tasks]
+
+    def query_past_tasks(self, task_type: str = None, session_id: str = None,
+                         since: str = None, until: str = None, limit: int = None,
+                         include_results: bool = False) -> List[Dict]:
+        tasks = self.backend.query_tasks(task_type=task_type, session_id=session_id,
+                                         since=since, until=until, limit=limit,
+                                         include_results=include_results)
+        return [self._resolve_task(t) for t in tasks]
+
+    def load_task_results(self, task_id: int) -> List[Dict]:
+        results = self.backend.load_task_results(task_id)
+        return [self.blobs.resolve(r) for r in results] if self.blobs else results
+
+    def _resolve_task(self, task: TaskRecord) -> TaskRecord:
+        # a copy, the json backend hands out its stored records
+        if not self.blobs:
+            return task
+        return self.blobs.resolve(TaskRecord.from_dict(task))
 
     def clear_session(self):
-        self.current_state = {
-            "current_task": None,
-            "plan": [],
-            "completed_steps": [],
-            "pending_steps": [],
-            "context": {},
-            "session_id": None
-        }
+        self.current_state = _default_state()
         self.save_state()
@@ -0,0 +1,152 @@
+import os
+import threading
+from typing import Dict, List, Tuple
+
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+STORAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+# name -> (type, help, buckets). counters are exported with a _total suffix
+STANDARD_METRICS = {
+    "agent_planning_seconds": ("histogram", "Time to produce a plan, including the model call", LATENCY_BUCKETS),
+    "agent_step_seconds": ("histogram", "Time to execute one plan step", LATENCY_BUCKETS),
+    "agent_step_failures": ("counter", "Plan steps that raised", None),
+    "agent_llm_request_seconds": ("histogram", "Model call latency, cache hits excluded", LATENCY_BUCKETS),
+    "agent_llm_prompt_chars": ("counter", "Characters sent to the model", None),
+    "agent_llm_prompt_tokens": ("counter", "Estimated tokens sent to the model", None),
+    "agent_llm_response_chars": ("counter", "Characters received from the model", None),
+    "agent_llm_response_tokens": ("counter", "Estimated tokens received from the model", None),
+    "agent_llm_retries": ("counter", "Model calls retried after a retryable error", None),
+    "agent_llm_failures": ("counter", "Model calls that failed for good", None),
+    "agent_llm_ttft_seconds": ("histogram", "Time to the first streamed chunk of a model response", LATENCY_BUCKETS),
+    "agent_llm_throttle_seconds": ("histogram", "Time model calls waited on rate limits", LATENCY_BUCKETS),
+    "agent_route_calls": ("counter", "Routed model calls by action type, tier and result", None),
+    "agent_route_seconds": ("histogram", "Latency of successful routed model calls", LATENCY_BUCKETS),
+    "agent_cache_lookups": ("counter", "Response cache lookups by result", None),
+    "agent_plan_memo_lookups": ("counter", "Plan memo lookups by result (exact, near, miss)", None),
+    "agent_batched_steps": ("counter", "Step model calls by batching result (batched, fallback, alone)", None),
+    "agent_storage_save_seconds": ("histogram", "Time spent writing state, memory or trace", STORAGE_BUCKETS),
+    "agent_storage_bytes_written": ("counter", "Bytes written to storage files, by store", None)
+}
+
+
+# rough, but good enough to compare handlers
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN
+
+
+class MetricsRegistry:
+    # counters and histograms keyed by label set, exported as OpenMetrics text.
+    # default_labels (e.g. session) are added to every sample
+    def __init__(self, default_labels: Dict[str, str] = None):
+        self.default_labels = dict(default_labels or {})
+        self._values = {name: {} for name in STANDARD_METRICS}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self._check(name, "counter")
+        key = self._key(labels)
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        _, _, buckets = self._check(name, "histogram")
+        key = self._key(labels)
+        with self._lock:
+            series = self._values[name]
+            state = series.get(key)
+            if state is None:
+                state = series[key] = {"buckets": [0] * len(buckets), "count": 0, "sum": 0.0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["count"] += 1
+            state["sum"] += value
+
+    def total(self, name: str) -> float:
+        # a counter summed over all its label sets
+        with self._lock:
+            return sum(self._values[name].values())
+
+    def get(self, name: str, **labels):
+        with self._lock:
+            value = self._values[name].get(self._key(labels))
+        if isinstance(value, dict):
+            return {"count": value["count"], "sum": value["sum"]}
+        return value
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in STANDARD_METRICS.items():
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"# HELP {name} {help_text}")
+                for key, value in sorted(self._values[name].items()):
+                    if kind == "counter":
+                        lines.append(f"{name}_total{self._format(key)} {value}")
+                        continue
+                    for bound, count in zip(buckets, value["buckets"]):
+                        lines.append(f"{name}_bucket{self._format(key, ('le', str(bound)))} {count}")
+                    lines.append(f"{name}_bucket{self._format(key, ('le', '+Inf'))} {value['count']}")
+                    lines.append(f"{name}_count{self._format(key)} {value['count']}")
+                    lines.append(f"{name}_sum{self._format(key)} {value['sum']}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: str):
+        # rename into place so a scraper never reads half a file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port: int = 9464, host: str = "127.0.0.1"):
+        # only runs with --metrics-port, so http.server stays off the startup path
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "application/openmetrics-text; version=1.0.0; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server = None
+
+    def _check(self, name: str, kind: str) -> Tuple:
+        spec = STANDARD_METRICS.get(name)
+        if spec is None or spec[0] != kind:
+            raise ValueError(f"Unknown {kind} metric: {name}")
+        return spec
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        merged = {**self.default_labels, **labels}
+        return tuple(sorted((k, str(v)) for k, v in merged.items()))
+
+    def _format(self, key: Tuple, extra: Tuple = None) -> str:
+        pairs: List[Tuple] = list(key) + ([extra] if extra else [])
+        if not pairs:
+            return ""
+        escaped = [(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                   for k, v in pairs]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import re
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Any
+
+from agent.metrics import MetricsRegistry
+from agent.records import to_json
+
+
+BATCH_HEADER = "You are completing several independent task steps in one response."
+# an answer starts with a line holding only its marker
+_MARKER = re.compile(r"^<<<STEP (\d+)>>>[ \t]*$", re.M)
+
+
+class BatchItem:
+    __slots__ = ("step", "prompt", "instruction", "context", "action_type", "future", "taken")
+
+    def __init__(self, step: Dict, prompt: str, instruction: str, context: Any, action_type: str,
+                 future=None):
+        self.step = step
+        # the prompt the step would get on its own, for the cache and the fallback
+        self.prompt = prompt
+        self.instruction = instruction
+        self.context = context
+        self.action_type = action_type
+        self.future = future
+        self.taken = False
+
+
+def build_batch_prompt(items: List[BatchItem]) -> str:
+    # steps of one task mostly share a context, so each distinct one is written once
+    contexts = {}
+    for item in items:
+        contexts.setdefault(json.dumps(item.context, indent=2, default=to_json), len(contexts) + 1)
+
+    parts = [BATCH_HEADER, ""]
+    for text, number in contexts.items():
+        parts += [f"Context {number}:", text, ""]
+    for n, item in enumerate(items, 1):
+        number = contexts[json.dumps(item.context, indent=2, default=to_json)]
+        parts += [f"## Step {n}",
+                  f"Task: {item.step.get('action')}",
+                  f"Details: {item.step.get('description')}",
+                  f"Uses: context {number}",
+                  item.instruction,
+                  ""]
+    parts.append(f"Answer all {len(items)} steps in order. Begin each answer with a line containing "
+                 f"only <<<STEP n>>>, where n is the step number, and write nothing before the "
+                 f"first of these lines.")
+    return "\n".join(parts)
+
+
+def split_batch_response(text: str, count: int) -> Dict[int, str]:
+    # step number -> answer. steps that are missing or empty are left out
+    parts = _MARKER.split(text)
+    answers = {}
+    for i in range(1, len(parts) - 1, 2):
+        n, body = int(parts[i]), parts[i + 1].strip()
+        if 1 <= n <= count and body and n not in answers:
+            answers[n] = body
+    return answers
+
+
+class StepBatcher:
+    # packs concurrent model calls for small steps into one request. the scheduler
+    # only runs steps side by side once their dependencies are done, so whatever
+    # arrives together is ready and independent. the first caller waits up to
+    # window seconds for up to max_batch - 1 others, sends one delimited prompt and
+    # splits the answer. a step whose answer is missing, or whose batch call
+    # failed, is called on its own, and a step with nothing to share the call with
+    # goes out as usual. every answer is cached under the step's own prompt, so a
+    # rerun hits the cache either way
+    def __init__(self, client, window: float = 0.02, max_batch: int = 4,
+                 metrics: MetricsRegistry = None):
+        self.client = client
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.metrics = metrics
+
+        self._pending = []
+        self._leading = False
+        self._changed = threading.Condition()
+        # async callers are collected the same way, with a loop timer instead of a leader
+        self._apending = []
+        self._atimer = None
+        self._atasks = set()
+
+    def generate(self, item: BatchItem) -> str:
+        cached = self.client.lookup(item.prompt, item.action_type)
+        if cached is not None:
+            return cached
+
+        item.future = Future()
+        batch = None
+        with self._changed:
+            self._pending.append(item)
+            self._changed.notify_all()
+            while not item.taken:
+                if not self._leading and self._pending[0] is item:
+                    batch = self._collect()
+                    break
+                self._changed.wait()
+
+        if batch is not None:
+            self._run(batch)
+        answer = item.future.result()
+        if answer is None:
+            # already looked up in the cache above
+            answer = self.client.generate(item.prompt, action_type=item.action_type, cache=False)
+            self.client.remember(item.prompt, answer, item.action_type)
+        return answer
+
+    async def agenerate(self, item: BatchItem, semaphore: asyncio.Semaphore = None) -> str:
+        cached = self.client.lookup(item.prompt, item.action_type)
+        if cached is not None:
+            return cached
+
+        loop = asyncio.get_running_loop()
+        item.future = loop.create_future()
+        self._apending.append(item)
+        if len(self._apending) >= self.max_batch:
+            self._aflush(semaphore)
+        elif self._atimer is None:
+            self._atimer = loop.call_later(self.window, self._aflush, semaphore)
+
+        answer = await item.future
+        if answer is None:
+            answer = await self.client.agenerate(item.prompt, semaphore=semaphore,
+                                                 action_type=item.action_type, cache=False)
+            self.client.remember(item.prompt, answer, item.action_type)
+        return answer
+
+    def _collect(self) -> List[BatchItem]:
+        # caller holds the lock and leads the next batch
+        self._leading = True
+        deadline = time.monotonic() + self.window
+        while len(self._pending) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._changed.wait(remaining)
+        batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        for item in batch:
+            item.taken = True
+        # whoever is first of the rest leads the one after
+        self._leading = False
+        self._changed.notify_all()
+        return batch
+
+    def _run(self, batch: List[BatchItem]):
+        if len(batch) == 1:
+            self._resolve(batch, None)
+            return
+        try:
+            text = self.client.generate(build_batch_prompt(batch), action_type="batch", cache=False)
+        except Exception:
+            # a failed batch call says nothing about the steps, each gets its own call
+            text = None
+        self._resolve(batch, text)
+
+    def _aflush(self, semaphore: asyncio.Semaphore):
+        if self._atimer is not None:
+            self._atimer.cancel()
+            self._atimer = None
+        batch, self._apending = self._apending[:self.max_batch], self._apending[self.max_batch:]
+        if self._apending:
+            self._atimer = asyncio.get_running_loop().call_later(self.window, self._aflush, semaphore)
+        task = asyncio.ensure_future(self._arun(batch, semaphore))
+        # the loop only keeps weak references to tasks
+        self._atasks.add(task)
+        task.add_done_callback(self._atasks.discard)
+
+    async def _arun(self, batch: List[BatchItem], semaphore: asyncio.Semaphore):
+        if len(batch) == 1:
+            self._resolve(batch, None)
+            return
+        try:
+            text = await self.client.agenerate(build_batch_prompt(batch), semaphore=semaphore,
+                                               action_type="batch", cache=False)
+        except Exception:
+            text = None
+        self._resolve(batch, text)
+
+    def _resolve(self, batch: List[BatchItem], text: str):
+        # None tells a step to make its own call
+        answers = split_batch_response(text, len(batch)) if text is not None else {}
+        for n, item in enumerate(batch, 1):
+            answer = answers.get(n)
+            if answer is not None:
+                self.client.remember(item.prompt, answer, item.action_type)
+            if len(batch) == 1:
+                result = "alone"
+            else:
+                result = "batched" if answer is not None else "fallback"
+            self._count(item, result)
+            # an awaiting step may have been cancelled meanwhile
+            if not item.future.done():
+                item.future.set_result(answer)
+
+    def _count(self, item: BatchItem, result: str):
+        if self.metrics:
+            self.metrics.inc("agent_batched_steps", action_type=item.action_type, result=result)
@@ -0,0 +1,416 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from typing import Dict, Iterator, AsyncIterator, Tuple
+
+from agent.cache import ResponseCache
+from agent.metrics import MetricsRegistry, estimate_tokens, CHARS_PER_TOKEN
+from agent.governor import RequestGovernor
+from agent.routing import ModelRouter, ModelTier
+
+
+DEFAULT_MODEL = 'models/gemini-2.5-flash'
+# streamed responses longer than this are written out but not cached, so a huge
+# document never has to sit in memory in one piece
+MAX_CACHED_STREAM_CHARS = 1024 * 1024
+
+
+class ModelProvider:
+    # the only thing planner and executor need from a model
+    model_name = None
+
+    def generate(self, prompt: str) -> str:
+        raise NotImplementedError
+
+    async def agenerate(self, prompt: str) -> str:
+        raise NotImplementedError
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        yield self.generate(prompt)
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        yield await self.agenerate(prompt)
+
+
+class GeminiProvider(ModelProvider):
+    # the SDK takes seconds to import, so it's only imported and configured on the
+    # first call. runs that never reach the model (stub, replay, resume of a
+    # finished plan) don't pay for it at all
+    def __init__(self, api_key: str = None, model_name: str = DEFAULT_MODEL):
+        self.api_key = api_key or os.getenv("GEMINI_API_KEY")
+        if not self.api_key:
+            raise ValueError("GEMINI_API_KEY not found")
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    import google.generativeai as genai
+                    genai.configure(api_key=self.api_key)
+                    self._model = genai.GenerativeModel(self.model_name)
+        return self._model
+
+    def generate(self, prompt: str) -> str:
+        return self.model.generate_content(prompt).text
+
+    async def agenerate(self, prompt: str) -> str:
+        response = await self.model.generate_content_async(prompt)
+        return response.text
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        for chunk in self.model.generate_content(prompt, stream=True):
+            yield chunk.text
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        response = await self.model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            yield chunk.text
+
+
+class StubProviderError(RuntimeError):
+    # raised for injected failures, code mimics the HTTP status a real provider would give
+    def __init__(self, message: str, code: int = 500):
+        super().__init__(message)
+        self.code = code
+
+
+_STUB_ACTIONS = [
+    ("Research market landscape", "Investigate competitors and positioning"),
+    ("Create feature specification document", "Write the feature spec"),
+    ("Calculate success metrics", "Measure baseline usage metrics"),
+    ("Analyze launch risks", "Assess risks and mitigations"),
+    ("Generate announcement content", "Produce the launch announcement"),
+    ("Coordinate rollout", "Plan the rollout schedule")
+]
+
+
+class StubProvider(ModelProvider):
+    # offline stand-in for load tests and benchmarks. output is a pure function of the
+    # prompt, latency and failures come from a seeded RNG.
+    # latency is (kind, *params): ("fixed", s), ("uniform", lo, hi),
+    # ("lognormal", median, sigma) or ("exponential", mean)
+    def __init__(self, model_name: str = "stub", latency: Tuple = ("fixed", 0.0),
+                 failure_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 responses: Dict[str, str] = None, template: str = None,
+                 output_chars: int = 1200, plan_width: int = 3, plan_depth: int = 2,
+                 chunk_size: int = 80, chunk_delay: float = 0.0, seed: int = None):
+        self.model_name = model_name
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        # prompt substring -> canned response, checked before anything else
+        self.responses = responses or {}
+        # formatted with {first_line}, {prompt_hash} and {prompt_chars}
+        self.template = template
+        self.output_chars = output_chars
+        self.plan_width = plan_width
+        self.plan_depth = plan_depth
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def generate(self, prompt: str) -> str:
+        time.sleep(self._roll())
+        return self.respond(prompt)
+
+    async def agenerate(self, prompt: str) -> str:
+        await asyncio.sleep(self._roll())
+        return self.respond(prompt)
+
+    def stream(self, prompt: str) -> Iterator[str]:
+        time.sleep(self._roll())
+        text = self.respond(prompt)
+        for i in range(0, len(text), self.chunk_size):
+            if i and self.chunk_delay:
+                time.sleep(self.chunk_delay)
+            yield text[i:i + self.chunk_size]
+
+    async def astream(self, prompt: str) -> AsyncIterator[str]:
+        await asyncio.sleep(self._roll())
+        text = self.respond(prompt)
+        for i in range(0, len(text), self.chunk_size):
+            if i and self.chunk_delay:
+                await asyncio.sleep(self.chunk_delay)
+            yield text[i:i + self.chunk_size]
+
+    def respond(self, prompt: str) -> str:
+        for needle, response in self.responses.items():
+            if needle in prompt:
+                return response
+        if prompt.startswith("You are a task planning assistant"):
+            return "```json\n" + json.dumps(self.make_plan(prompt), indent=2) + "\n```"
+        if prompt.startswith("You are completing several independent task steps"):
+            # a micro-batch: one delimited answer per step section
+            sections = re.findall(r"^## Step (\d+)\n(.*?)(?=^## Step |\Z)", prompt, re.S | re.M)
+            return "\n".join(f"<<<STEP {n}>>>\n{self.respond(body)}" for n, body in sections)
+        if prompt.startswith("Refine this task step"):
+            return json.dumps({"action": "Refined step", "description": "Refined description",
+                               "expected_output": "Refined output"})
+
+        first_line = prompt.strip().splitlines()[0] if prompt.strip() else ""
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+        if self.template:
+            return self.template.format(first_line=first_line, prompt_hash=digest,
+                                        prompt_chars=len(prompt))
+        header = f"# Stub output {digest}\n\n{first_line}\n\n"
+        filler = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. "
+        body = (filler * (self.output_chars // len(filler) + 1))[:max(0, self.output_chars - len(header))]
+        return header + body
+
+    def make_plan(self, prompt: str) -> Dict:
+        # one root step, then plan_depth layers of plan_width steps that each
+        # depend on every step of the layer before
+        task = re.search(r"Task:\s*(.*)", prompt)
+        steps = [{"id": 1, "action": _STUB_ACTIONS[0][0], "description": _STUB_ACTIONS[0][1],
+                  "expected_output": "Research notes", "dependencies": []}]
+        previous = [1]
+        for _ in range(self.plan_depth):
+            layer = []
+            for _ in range(self.plan_width):
+                step_id = len(steps) + 1
+                action, description = _STUB_ACTIONS[1 + (step_id - 2) % (len(_STUB_ACTIONS) - 1)]
+                steps.append({"id": step_id, "action": action, "description": description,
+                              "expected_output": f"Output of step {step_id}",
+                              "dependencies": list(previous)})
+                layer.append(step_id)
+            previous = layer
+        return {
+            "goal": task.group(1).strip() if task else "Complete the task",
+            "steps": steps,
+            "success_criteria": "All steps completed"
+        }
+
+    def _roll(self) -> float:
+        # returns the latency for one call, or raises an injected failure
+        with self._lock:
+            self.calls += 1
+            roll = self._rng.random()
+            delay = self._sample_latency()
+        if roll < self.rate_limit_rate:
+            raise StubProviderError("Stub rate limit exceeded", code=429)
+        if roll < self.rate_limit_rate + self.failure_rate:
+            raise StubProviderError("Stub model failure", code=500)
+        return delay
+
+    def _sample_latency(self) -> float:
+        kind, *params = self.latency
+        if kind == "fixed":
+            return params[0]
+        if kind == "uniform":
+            return self._rng.uniform(params[0], params[1])
+        if kind == "lognormal":
+            return self._rng.lognormvariate(math.log(params[0]), params[1])
+        if kind == "exponential":
+            return self._rng.expovariate(1.0 / params[0]) if params[0] > 0 else 0.0
+        raise ValueError(f"Unknown latency distribution: {kind}")
+
+
+class ModelClient:
+    # what planner and executor call: the response cache in front of a provider,
+    # with latency and size metrics labelled by action type. with a governor,
+    # calls are rate limited and retried on quota and transient errors. with a
+    # router, each call goes to the model tier it picks instead of provider, and
+    # is cached under that model
+    def __init__(self, provider: ModelProvider, cache: ResponseCache = None,
+                 metrics: MetricsRegistry = None, governor: RequestGovernor = None,
+                 router: ModelRouter = None):
+        self.provider = provider
+        self.cache = cache
+        self.metrics = metrics
+        self.governor = governor
+        self.router = router
+
+    @property
+    def model_name(self) -> str:
+        return self.provider.model_name
+
+    def generate(self, prompt: str, action_type: str = "generic", cache: bool = True) -> str:
+        # cache=False for prompts not worth keeping, e.g. batches whose makeup changes every run
+        tier, provider = self._route(prompt, action_type)
+        cached = self._cached(provider, prompt, action_type) if cache else None
+        if cached is not None:
+            return cached
+
+        start = time.perf_counter()
+        try:
+            if self.governor:
+                text = self.governor.call(provider.generate, prompt, action_type)
+            else:
+                text = provider.generate(prompt)
+        except Exception:
+            self._record_failure(action_type, tier, time.perf_counter() - start)
+            raise
+        self._record_call(prompt, text, time.perf_counter() - start, action_type, tier)
+        if cache:
+            self._store(provider, prompt, text)
+        return text
+
+    async def agenerate(self, prompt: str, semaphore: asyncio.Semaphore = None,
+                        action_type: str = "generic", cache: bool = True) -> str:
+        tier, provider = self._route(prompt, action_type)
+        cached = self._cached(provider, prompt, action_type) if cache else None
+        if cached is not None:
+            return cached
+
+        if semaphore:
+            await semaphore.acquire()
+        start = time.perf_counter()
+        try:
+            if self.governor:
+                text = await self.governor.acall(provider.agenerate, prompt, action_type)
+            else:
+                text = await provider.agenerate(prompt)
+        except Exception:
+            self._record_failure(action_type, tier, time.perf_counter() - start)
+            raise
+        finally:
+            if semaphore:
+                semaphore.release()
+        self._record_call(prompt, text, time.perf_counter() - start, action_type, tier)
+        if cache:
+            self._store(provider, prompt, text)
+        return text
+
+    def stream(self, prompt: str, action_type: str = "generic") -> Iterator[str]:
+        tier, provider = self._route(prompt, action_type)
+        cached = self._cached(provider, prompt, action_type)
+        if cached is not None:
+            yield cached
+            return
+
+        if self.governor:
+            chunks = self.governor.stream(provider.stream, prompt, action_type)
+        else:
+            chunks = provider.stream(prompt)
+        collector = _StreamCollector(self.cache is not None)
+        start = time.perf_counter()
+        try:
+            for chunk in chunks:
+                collector.add(chunk, start, self.metrics, action_type)
+                yield chunk
+        except Exception:
+            self._record_failure(action_type, tier, time.perf_counter() - start)
+            raise
+        self._finish_stream(provider, prompt, collector, time.perf_counter() - start, action_type, tier)
+
+    async def astream(self, prompt: str, semaphore: asyncio.Semaphore = None,
+                      action_type: str = "generic") -> AsyncIterator[str]:
+        tier, provider = self._route(prompt, action_type)
+        cached = self._cached(provider, prompt, action_type)
+        if cached is not None:
+            yield cached
+            return
+
+        if semaphore:
+            await semaphore.acquire()
+        try:
+            if self.governor:
+                chunks = self.governor.astream(provider.astream, prompt, action_type)
+            else:
+                chunks = provider.astream(prompt)
+            collector = _StreamCollector(self.cache is not None)
+            start = time.perf_counter()
+            try:
+                async for chunk in chunks:
+                    collector.add(chunk, start, self.metrics, action_type)
+                    yield chunk
+            except Exception:
+                self._record_failure(action_type, tier, time.perf_counter() - start)
+                raise
+        finally:
+            if semaphore:
+                semaphore.release()
+        self._finish_stream(provider, prompt, collector, time.perf_counter() - start, action_type, tier)
+
+    def lookup(self, prompt: str, action_type: str = "generic"):
+        # the cached response for prompt, or None
+        return self._cached(self._route(prompt, action_type)[1], prompt, action_type)
+
+    def remember(self, prompt: str, text: str, action_type: str = "generic"):
+        # cache text as the response to prompt without calling the model
+        self._store(self._route(prompt, action_type)[1], prompt, text)
+
+    def _route(self, prompt: str, action_type: str):
+        # (tier, provider), tier is None without a router
+        if not self.router:
+            return None, self.provider
+        tier = self.router.choose(action_type, prompt)
+        return tier, tier.provider
+
+    def _finish_stream(self, provider: ModelProvider, prompt: str, collector: "_StreamCollector",
+                       seconds: float, action_type: str, tier: ModelTier = None):
+        if tier is not None:
+            self.router.record(action_type, tier, seconds, ok=True)
+        if self.metrics:
+            self.metrics.observe("agent_llm_request_seconds", seconds, action_type=action_type)
+            self.metrics.inc("agent_llm_prompt_chars", len(prompt), action_type=action_type)
+            self.metrics.inc("agent_llm_prompt_tokens", estimate_tokens(prompt), action_type=action_type)
+            self.metrics.inc("agent_llm_response_chars", collector.chars, action_type=action_type)
+            self.metrics.inc("agent_llm_response_tokens", collector.chars // CHARS_PER_TOKEN,
+                             action_type=action_type)
+        if collector.chunks is not None:
+            self._store(provider, prompt, "".join(collector.chunks))
+
+    def _cached(self, provider: ModelProvider, prompt: str, action_type: str):
+        if not self.cache:
+            return None
+        cached = self.cache.get(provider.model_name, prompt)
+        if self.metrics:
+            self.metrics.inc("agent_cache_lookups", action_type=action_type,
+                             result="miss" if cached is None else "hit")
+        return cached
+
+    def _store(self, provider: ModelProvider, prompt: str, text: str):
+        if self.cache:
+            self.cache.put(provider.model_name, prompt, text)
+
+    def _record_call(self, prompt: str, text: str, seconds: float, action_type: str,
+                     tier: ModelTier = None):
+        if tier is not None:
+            self.router.record(action_type, tier, seconds, ok=True)
+        if not self.metrics:
+            return
+        self.metrics.observe("agent_llm_request_seconds", seconds, action_type=action_type)
+        self.metrics.inc("agent_llm_prompt_chars", len(prompt), action_type=action_type)
+        self.metrics.inc("agent_llm_prompt_tokens", estimate_tokens(prompt), action_type=action_type)
+        self.metrics.inc("agent_llm_response_chars", len(text), action_type=action_type)
+        self.metrics.inc("agent_llm_response_tokens", estimate_tokens(text), action_type=action_type)
+
+    def _record_failure(self, action_type: str, tier: ModelTier = None, seconds: float = 0.0):
+        if tier is not None:
+            self.router.record(action_type, tier, seconds, ok=False)
+        if self.metrics:
+            self.metrics.inc("agent_llm_failures", action_type=action_type)
+
+
+class _StreamCollector:
+    # tracks a streamed response: time to first chunk, size, and the chunks
+    # themselves while they are still small enough to cache
+    def __init__(self, keep_chunks: bool):
+        self.chunks = [] if keep_chunks else None
+        self.chars = 0
+        self.ttft = None
+
+    def add(self, chunk: str, start: float, metrics: MetricsRegistry, action_type: str):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - start
+            if metrics:
+                metrics.observe("agent_llm_ttft_seconds", self.ttft, action_type=action_type)
+        self.chars += len(chunk)
+        if self.chunks is not None:
+            self.chunks.append(chunk)
+            if self.chars > MAX_CACHED_STREAM_CHARS:
+                self.chunks = None
@@ -1,163 +1,556 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
 from datetime import datetime
+import asyncio
+import os
+import time
 import uuid
 
-from agent.planner import TaskPlanner
-from agent.executor import ActionExecutor
+from agent.planner import TaskPlanner, AsyncTaskPlanner
+from agent.executor import ActionExecutor, AsyncActionExecutor
 from agent.memory import StateManager
 from agent.tracer import DecisionTracer
+from agent.scheduler import StepScheduler, PlanValidationError, DynamicDag
+from agent.cache import ResponseCache
+from agent.context import ContextBuilder
+from agent.models import ModelProvider, GeminiProvider, ModelClient
+from agent.metrics import MetricsRegistry
+from agent.checkpoint import CheckpointStore, TaskCheckpoint
+from agent.governor import RequestGovernor
+from agent.plan_memo import PlanMemo
+from agent.records import Step, StepResult, TaskRecord
+from agent.blobs import BlobStore
+from agent.routing import ModelRouter, ModelTier
 
 
 class StatefulAgent:
-    def __init__(self, api_key: str = None):
-        self.planner = TaskPlanner(api_key=api_key)
-        self.executor = ActionExecutor(api_key=api_key)
-        self.memory = StateManager()
-        self.tracer = DecisionTracer()
-
+    def __init__(self, api_key: str = None, max_workers: int = 4, max_concurrency: int = 8,
+                 cache: ResponseCache = None, bypass_cache: bool = False,
+                 memory_backend="json", context_budget: int = 6000,
+                 provider: ModelProvider = None, storage_dir: str = "storage",
+                 output_dir: str = "outputs", metrics_port: int = None,
+                 governor: RequestGovernor = None, rpm: float = None, tpm: float = None,
+                 stream_outputs: bool = True, stream_plan: bool = True,
+                 plan_memo: PlanMemo = None, reuse_plans: bool = True,
+                 dedupe_storage: bool = True, batch_steps: bool = False,
+                 model_tiers: List[ModelTier] = None, latency_budget: float = None,
+                 calculation_mode: str = "narrate"):
         self.session_id = str(uuid.uuid4())
+
+        # every component reports into one registry, labelled with the session.
+        # it's written to storage/metrics.prom after each task and can also be scraped
+        self.metrics = MetricsRegistry(default_labels={"session": self.session_id})
+        self.metrics_file = os.path.join(storage_dir, "metrics.prom")
+        if metrics_port:
+            self.metrics.serve(metrics_port)
+
+        # one provider, cache and governor shared by planner and executor,
+        # bypass_cache forces fresh responses. rpm/tpm are the provider quota
+        self.provider = provider or (model_tiers[0].provider if model_tiers else GeminiProvider(api_key=api_key))
+        # with model_tiers (fastest first), every call goes to the tier picked for its
+        # action type, prompt size and what is left of latency_budget seconds per task
+        self.router = ModelRouter(model_tiers, storage_dir=storage_dir,
+                                  metrics=self.metrics) if model_tiers else None
+        self.latency_budget = latency_budget
+        self.cache = cache or ResponseCache(storage_dir=storage_dir, bypass=bypass_cache,
+                                            metrics=self.metrics)
+        self.governor = governor or RequestGovernor(rpm=rpm, tpm=tpm,
+                                                    max_concurrency=max(max_workers, max_concurrency),
+                                                    metrics=self.metrics)
+        # one client for planner, executor and their async versions
+        self.client = ModelClient(self.provider, cache=self.cache, metrics=self.metrics,
+                                  governor=self.governor, router=self.router)
+        self.planner = TaskPlanner(client=self.client)
+        # documents and generated content are written to disk as they stream in
+        # with batch_steps, short analysis and metrics steps that are ready together
+        # go out as one model call. metrics steps work out the standard SaaS metrics
+        # locally, calculation_mode says whether the model still interprets them
+        self.executor = ActionExecutor(output_dir=output_dir, metrics=self.metrics,
+                                       stream=stream_outputs, client=self.client,
+                                       batch_steps=batch_steps, calculation_mode=calculation_mode)
+        # large payloads (model outputs, plans, step contexts) are stored once by hash,
+        # trace and memory records point at them instead of repeating them
+        self.blobs = BlobStore(storage_dir=storage_dir, metrics=self.metrics) if dedupe_storage else None
+        self.memory = StateManager(storage_dir=storage_dir, backend=memory_backend, metrics=self.metrics,
+                                   blobs=self.blobs)
+        self.tracer = DecisionTracer(storage_dir=storage_dir, metrics=self.metrics, blobs=self.blobs)
+        # plan and finished steps of every running task, for resume_task
+        self.checkpoints = CheckpointStore(storage_dir=storage_dir, metrics=self.metrics)
+        self.scheduler = StepScheduler(max_workers=max_workers)
+        # caps how many tokens of task context and earlier results go into each step
+        self.context_builder = ContextBuilder(max_tokens=context_budget)
+
+        # start steps while the plan is still being generated
+        self.stream_plan = stream_plan
+        # plans that worked before are reused for the same (or a nearly identical) task
+        self.plan_memo = plan_memo or PlanMemo(storage_dir=storage_dir, bypass=bypass_cache,
+                                               metrics=self.metrics)
+        self.reuse_plans = reuse_plans
+
+        # async components are only built when arun_task is first used
+        self.max_concurrency = max_concurrency
+        self.async_planner = None
+        self.async_executor = None
+
         self.memory.update_state("session_id", self.session_id)
 
     def run_task(self, task_description: str, context: Dict = None) -> Dict[str, Any]:
-        print(f"\nSTARTING NEW TASK")
+        checkpoint = self._start_task(task_description, context)
+        memo_match = self._recall_plan(task_description, context)
+
+        if memo_match:
+            print("PHASE 1: PLANNING (reused)")
+            plan = self._reuse_plan(task_description, context, memo_match, checkpoint)
+
+            print("\n\nPHASE 2: EXECUTION")
+            results = self._execute_plan(plan, context, checkpoint=checkpoint)
+        elif self.stream_plan:
+            print("PHASE 1+2: PLANNING AND EXECUTION")
+            plan, results = self._plan_and_execute(task_description, context, checkpoint)
+        else:
+            print("PHASE 1: PLANNING")
+            plan = self._plan_task(task_description, context)
+            self._save_plan(checkpoint, task_description, context, plan)
+
+            print("\n\nPHASE 2: EXECUTION")
+            results = self._execute_plan(plan, context, checkpoint=checkpoint)
+
+        print("\n\nPHASE 3: COMPLETION")
+        summary = self._finalize_task(task_description, plan, results, context, memo_match)
+        self._end_run(checkpoint)
+
+        return summary
+
+    def resume_task(self, session_id: str, run_id: str = None) -> Dict[str, Any]:
+        # picks up an interrupted run_task: the saved plan is reused and steps that
+        # already completed (and whose output files still exist) are not run again
+        checkpoint = self.checkpoints.get(session_id, run_id)
+        if checkpoint is None:
+            raise ValueError(f"No unfinished task to resume for session {session_id}")
+        state = checkpoint.load()
+        task_description, context, plan = state["task"], state["context"], state["plan"]
+        prior_results = state["results"]
+
+        self.session_id = session_id
+        self.metrics.default_labels["session"] = session_id
+        self.memory.update_state("session_id", session_id)
+        self.tracer.start_task()
+        if self.router:
+            self.router.start_task(self.latency_budget)
+
+        print(f"\nRESUMING TASK")
         print(f"Task: {task_description}\n")
 
-        self.memory.update_state("current_task", task_description)
-        self.memory.update_state("context", context or {})
+        self.memory.start_run(checkpoint.run_id, task_description, context, plan)
 
         self.tracer.log_decision(
-            step="Task Initiation",
-            action="Received task request",
-            reasoning="User provided a new task to execute",
-            inputs={"task": task_description, "context": context}
+            step="Task Resumption",
+            action="Resumed task from checkpoint",
+            reasoning="Continuing an interrupted task without repeating finished steps",
+            inputs={"task": task_description, "run_id": checkpoint.run_id,
+                    "completed_step_ids": [r.get("step_id") for r in prior_results]}
         )
 
         print("PHASE 1: PLANNING")
-        plan = self._plan_task(task_description, context)
+        if plan is None:
+            # interrupted before the plan was saved. any steps that ran belonged to a
+            # plan we no longer have, so they can't be matched up
+            prior_results = []
+            plan = self._plan_task(task_description, context)
+            self._save_plan(checkpoint, task_description, context, plan)
+        else:
+            print(f"Reusing saved plan with {len(plan.get('steps', []))} steps")
 
         print("\n\nPHASE 2: EXECUTION")
-        results = self._execute_plan(plan, context)
+        results = self._execute_plan(plan, context, prior_results=prior_results, checkpoint=checkpoint)
 
         print("\n\nPHASE 3: COMPLETION")
-        summary = self._finalize_task(task_description, plan, results)
+        summary = self._finalize_task(task_description, plan, results, context)
+        self._end_run(checkpoint)
 
         return summary
 
-    def _plan_task(self, task_description: str, context: Dict = None) -> Dict:
-        relevant_past = self.memory.get_relevant_past_tasks(
-            context.get("task_type", "general") if context else "general"
+    async def arun_task(self, task_description: str, context: Dict = None) -> Dict[str, Any]:
+        # several of these can run on one event loop, they share the agent's
+        # storage and a single semaphore that caps in-flight model calls
+        self._ensure_async_components()
+        checkpoint = self._start_task(task_description, context)
+        memo_match = self._recall_plan(task_description, context)
+
+        if memo_match:
+            print("PHASE 1: PLANNING (reused)")
+            plan = self._reuse_plan(task_description, context, memo_match, checkpoint)
+
+            print("\n\nPHASE 2: EXECUTION")
+            results = await self._aexecute_plan(plan, context, checkpoint=checkpoint)
+        elif self.stream_plan:
+            print("PHASE 1+2: PLANNING AND EXECUTION")
+            plan, results = await self._aplan_and_execute(task_description, context, checkpoint)
+        else:
+            print("PHASE 1: PLANNING")
+            plan = await self._aplan_task(task_description, context)
+            self._save_plan(checkpoint, task_description, context, plan)
+
+            print("\n\nPHASE 2: EXECUTION")
+            results = await self._aexecute_plan(plan, context, checkpoint=checkpoint)
+
+        print("\n\nPHASE 3: COMPLETION")
+        summary = self._finalize_task(task_description, plan, results, context, memo_match)
+        self._end_run(checkpoint)
+
+        return summary
+
+    def _ensure_async_components(self):
+        if self.async_executor is not None:
+            return
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.async_planner = AsyncTaskPlanner(semaphore=semaphore, client=self.client)
+        self.async_executor = AsyncActionExecutor(output_dir=self.executor.output_dir,
+                                                  semaphore=semaphore, metrics=self.metrics,
+                                                  stream=self.executor.stream, client=self.client,
+                                                  batch_steps=self.executor.batcher is not None,
+                                                  calculation_mode=self.executor.calculation_mode)
+
+    def _start_task(self, task_description: str, context: Dict = None) -> TaskCheckpoint:
+        self.tracer.start_task()
+        if self.router:
+            self.router.start_task(self.latency_budget)
+        print(f"\nSTARTING NEW TASK")
+        print(f"Task: {task_description}\n")
+
+        checkpoint = self.checkpoints.begin(self.session_id, task_description, context)
+        self.memory.start_run(checkpoint.run_id, task_description, context)
+
+        self.tracer.log_decision(
+            step="Task Initiation",
+            action="Received task request",
+            reasoning="User provided a new task to execute",
+            inputs={"task": task_description, "context": context}
         )
 
-        past_context = {}
-        if relevant_past:
-            past_context["previous_similar_tasks"] = len(relevant_past)
-            past_context["learned_from_past"] = "Agent has experience with similar tasks"
+        return checkpoint
 
-        full_context = {**(context or {}), **past_context}
+    def _save_plan(self, checkpoint: TaskCheckpoint, task_description: str, context: Dict, plan: Dict):
+        checkpoint.save_task(task_description, context, plan)
+        self.memory.update_run(checkpoint.run_id, plan=plan, pending_steps=plan.get("steps", []))
 
-        print("Analyzing task and creating execution plan...")
+    def _end_run(self, checkpoint: TaskCheckpoint):
+        checkpoint.finish()
+        self.memory.end_run(checkpoint.run_id)
 
-        plan = self.planner.decompose_task(task_description, full_context)
+    def _recall_plan(self, task_description: str, context: Dict = None) -> Optional[Dict]:
+        if not self.reuse_plans:
+            return None
+        task_type = (context or {}).get("task_type", "general")
+        return self.plan_memo.lookup(task_description, task_type, context)
+
+    def _reuse_plan(self, task_description: str, context: Dict, memo_match: Dict,
+                    checkpoint: TaskCheckpoint) -> Dict:
+        plan = memo_match["plan"]
+        print(f"Reusing a stored plan ({memo_match['match']} match, "
+              f"similarity {memo_match['similarity']:.2f}), skipping the planning call")
 
         self.tracer.log_decision(
             step="Planning",
-            action="Task decomposition",
-            reasoning="Breaking down complex task into manageable steps for systematic execution",
-            inputs={"task": task_description, "context": full_context},
+            action="Reused stored plan",
+            reasoning=f"A plan for a {memo_match['match']} match of this task has worked before "
+                      f"(similarity {memo_match['similarity']:.2f})",
+            inputs={"task": task_description, "memo_entry": memo_match["entry_id"]},
             outputs={"plan": plan}
         )
+        self._record_plan(task_description, context or {}, plan, trace=False)
+        self._save_plan(checkpoint, task_description, context, plan)
+        return plan
 
-        self.memory.update_state("plan", plan)
-        self.memory.update_state("pending_steps", plan.get("steps", []))
+    def _plan_task(self, task_description: str, context: Dict = None) -> Dict:
+        full_context = self._planning_context(task_description, context)
 
-        print(f"\nGoal: {plan.get('goal', 'N/A')}")
-        print(f"\nPlanned {len(plan.get('steps', []))} steps:")
-        for step in plan.get("steps", []):
-            print(f"  {step['id']}. {step['action']}")
+        print("Analyzing task and creating execution plan...")
+
+        start = time.perf_counter()
+        plan = self.planner.decompose_task(task_description, full_context)
+        self.metrics.observe("agent_planning_seconds", time.perf_counter() - start)
+        self._record_plan(task_description, full_context, plan)
+
+        return plan
+
+    async def _aplan_task(self, task_description: str, context: Dict = None) -> Dict:
+        full_context = self._planning_context(task_description, context)
+
+        print("Analyzing task and creating execution plan...")
+
+        start = time.perf_counter()
+        plan = await self.async_planner.adecompose_task(task_description, full_context)
+        self.metrics.observe("agent_planning_seconds", time.perf_counter() - start)
+        self._record_plan(task_description, full_context, plan)
+
+        return plan
+
+    def _plan_and_execute(self, task_description: str, context: Dict,
+                          checkpoint: TaskCheckpoint) -> Tuple[Dict, List[Dict]]:
+        # the plan is streamed and each step starts once its dependencies are done,
+        # so the first steps run while later ones are still being planned
+        run = _StreamedRun(self, task_description, context, checkpoint)
+        plan_stream = self.planner.stream_plan(task_description, run.full_context)
+        run.plan_stream = plan_stream
+
+        events = self.scheduler.run_dynamic(plan_stream, run.prepare, self.executor.execute_step,
+                                            on_step=run.on_step, on_end=run.on_end,
+                                            on_stall=run.on_stall)
+        for step, result, error in events:
+            run.on_result(step, result, error)
+
+        return plan_stream.plan, run.results
+
+    async def _aplan_and_execute(self, task_description: str, context: Dict,
+                                 checkpoint: TaskCheckpoint) -> Tuple[Dict, List[Dict]]:
+        run = _StreamedRun(self, task_description, context, checkpoint)
+        plan_stream = self.async_planner.astream_plan(task_description, run.full_context)
+        run.plan_stream = plan_stream
+
+        steps = plan_stream.__aiter__()
+        next_step = asyncio.ensure_future(steps.__anext__())
+        running = set()
+        dag = DynamicDag()
+
+        def dispatch(step):
+            exec_context = run.prepare(step)
+            running.add(asyncio.ensure_future(self._arun_step(step, exec_context)))
+
+        while next_step is not None or running or dag.pending():
+            if next_step is None and not running:
+                run.on_stall(dag.pending())
+                dispatch(dag.force_next())
+                continue
+
+            waiting = running | ({next_step} if next_step is not None else set())
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future is next_step:
+                    try:
+                        step = future.result()
+                    except StopAsyncIteration:
+                        next_step = None
+                        run.on_end()
+                        continue
+                    run.on_step(step)
+                    dag.add(step)
+                    next_step = asyncio.ensure_future(steps.__anext__())
+                else:
+                    running.discard(future)
+                    step, result, error = future.result()
+                    dag.finish(step.get("id"))
+                    run.on_result(step, result, error)
+
+            for step in dag.take_ready():
+                dispatch(step)
+
+        return plan_stream.plan, run.results
+
+    def _planning_context(self, task_description: str, context: Dict = None) -> Dict:
+        task_type = context.get("task_type", "general") if context else "general"
+        # counted and ranked from the similarity index, past tasks aren't loaded for this
+        previous = self.memory.count_past_tasks(task_type)
+
+        past_context = {}
+        if previous:
+            past_context["previous_similar_tasks"] = previous
+            past_context["learned_from_past"] = "Agent has experience with similar tasks"
+            similar = self.memory.find_similar_tasks(task_description, k=3, task_type=task_type)
+            if similar:
+                past_context["relevant_past_tasks"] = [{
+                    "task": task["task"],
+                    "goal": (task.get("plan") or {}).get("goal"),
+                    "steps": [step.get("action") for step in (task.get("plan") or {}).get("steps", [])],
+                    "success_rate": task.get("success_rate"),
+                    "similarity": task["similarity"]
+                } for task in similar]
+
+        return {**(context or {}), **past_context}
+
+    def _record_plan(self, task_description: str, full_context: Dict, plan: Dict,
+                     announce: bool = True, trace: bool = True):
+        if trace:
+            self.tracer.log_decision(
+                step="Planning",
+                action="Task decomposition",
+                reasoning="Breaking down complex task into manageable steps for systematic execution",
+                inputs={"task": task_description, "context": full_context},
+                outputs={"plan": plan}
+            )
+
+        if announce:
+            print(f"\nGoal: {plan.get('goal', 'N/A')}")
+            print(f"\nPlanned {len(plan.get('steps', []))} steps:")
+            for step in plan.get("steps", []):
+                print(f"  {step['id']}. {step['action']}")
 
         decision = f"Created execution plan with {len(plan.get('steps', []))} steps"
         reasoning = "Task decomposition allows for systematic execution and progress tracking"
         self.memory.record_decision(decision, reasoning, {"plan": plan})
 
-        return plan
-
-    def _execute_plan(self, plan: Dict, context: Dict = None) -> List[Dict]:
-        steps = plan.get("steps", [])
-        results = []
-        completed = []
+    def _execute_plan(self, plan: Dict, context: Dict = None, prior_results: List[Dict] = None,
+                      checkpoint: TaskCheckpoint = None) -> List[StepResult]:
+        steps = self._plan_steps(plan)
+        results, completed = self._restore_progress(steps, prior_results)
+        numbers = {step.get("id"): i for i, step in enumerate(steps, 1)}
 
-        print(f"\nExecuting {len(steps)} planned steps...\n")
+        print(f"\nExecuting {len(steps) - len(completed)} planned steps...\n")
 
-        for i, step in enumerate(steps, 1):
-            print(f"\nStep {i}/{len(steps)}: {step['action']}")
-            print(f"Description: {step['description']}")
+        levels = self._schedule_steps(steps, completed)
+        if len(levels) < len(steps) - len(completed):
+            print(f"Scheduled into {len(levels)} levels (up to {self.scheduler.max_workers} steps in parallel)")
 
-            dependencies = step.get("dependencies", [])
-            if dependencies:
-                print(f"Dependencies: {dependencies}")
+        def prepare(step):
+            return self._start_step(step, numbers[step.get("id")], len(steps),
+                                    context, results, completed)
 
-                dep_results = {r["step_id"]: r for r in results if r["step_id"] in dependencies}
-                exec_context = {
-                    **(context or {}),
-                    "dependency_results": dep_results,
-                    "previous_steps": completed
-                }
+        for step, result, error in self.scheduler.run(levels, prepare, self.executor.execute_step):
+            i = numbers[step.get("id")]
+            if error is None:
+                self._record_step_result(step, i, result, steps, results, completed, checkpoint)
             else:
-                exec_context = {
-                    **(context or {}),
-                    "previous_steps": completed
-                }
+                self._record_step_error(step, i, error, results)
+
+        return results
+
+    async def _aexecute_plan(self, plan: Dict, context: Dict = None, prior_results: List[Dict] = None,
+                             checkpoint: TaskCheckpoint = None) -> List[StepResult]:
+        steps = self._plan_steps(plan)
+        results, completed = self._restore_progress(steps, prior_results)
+        numbers = {step.get("id"): i for i, step in enumerate(steps, 1)}
+
+        print(f"\nExecuting {len(steps) - len(completed)} planned steps...\n")
+
+        for level in self._schedule_steps(steps, completed):
+            pending = []
+            for step in level:
+                exec_context = self._start_step(step, numbers[step.get("id")], len(steps),
+                                                context, results, completed)
+                pending.append(self._arun_step(step, exec_context))
+
+            for outcome in asyncio.as_completed(pending):
+                step, result, error = await outcome
+                i = numbers[step.get("id")]
+                if error is None:
+                    self._record_step_result(step, i, result, steps, results, completed, checkpoint)
+                else:
+                    self._record_step_error(step, i, error, results)
+
+        return results
 
+    async def _arun_step(self, step: Dict, exec_context: Dict):
+        try:
+            return step, await self.async_executor.aexecute_step(step, exec_context), None
+        except Exception as e:
+            return step, None, e
+
+    def _plan_steps(self, plan: Dict) -> List[Step]:
+        # plans from a checkpoint or the plan memo come back with plain dict steps
+        steps = plan["steps"] = [Step.from_dict(s) for s in plan.get("steps", [])]
+        return steps
+
+    def _restore_progress(self, steps: List[Step], prior_results: List[Dict] = None):
+        # results carried over from a checkpoint, and the plan steps they finished
+        results = [StepResult.from_dict(r) for r in (prior_results or [])
+                   if r.get("status") == "completed"]
+        done_ids = {r.get("step_id") for r in results}
+        completed = [s for s in steps if s.get("id") in done_ids]
+        if completed:
+            print(f"Skipping {len(completed)} steps completed before the interruption")
+        return results, completed
+
+    def _schedule_steps(self, steps: List[Dict], completed: List[Dict] = None) -> List[List[Dict]]:
+        try:
+            levels = self.scheduler.build_levels(steps)
+        except PlanValidationError as e:
+            # a broken dependency graph shouldn't stop the task, just run it in order
+            print(f"Plan dependencies invalid ({str(e)}), running steps sequentially")
             self.tracer.log_decision(
-                step=f"Execution - Step {i}",
-                action=step['action'],
-                reasoning=f"Executing planned step to achieve: {step.get('expected_output', 'step completion')}",
-                inputs={"step": step, "context": exec_context}
+                step="Scheduling",
+                action="Fallback to sequential execution",
+                reasoning=f"Plan dependency graph is invalid: {str(e)}",
+                inputs={"step_ids": [s.get("id") for s in steps]}
             )
+            levels = [[step] for step in steps]
 
-            try:
-                result = self.executor.execute_step(step, exec_context)
-                results.append(result)
-                completed.append(step)
-
-                self.memory.update_state("completed_steps", completed)
-                pending = [s for s in steps if s not in completed]
-                self.memory.update_state("pending_steps", pending)
-
-                print(f"Status: {result['status']}")
-                if result.get('result', {}).get('type'):
-                    print(f"Output type: {result['result']['type']}")
-
-                self.tracer.log_decision(
-                    step=f"Execution Result - Step {i}",
-                    action="Step completed successfully",
-                    reasoning=f"Step produced expected output: {step.get('expected_output')}",
-                    outputs=result
-                )
-
-            except Exception as e:
-                error_result = {
-                    "step_id": step.get("id"),
-                    "action": step.get("action"),
-                    "status": "failed",
-                    "error": str(e),
-                    "timestamp": datetime.now().isoformat()
-                }
-                results.append(error_result)
-
-                print(f"Status: failed")
-                print(f"Error: {str(e)}")
-
-                self.tracer.log_decision(
-                    step=f"Execution Error - Step {i}",
-                    action="Step failed",
-                    reasoning=f"Encountered error during execution: {str(e)}",
-                    outputs=error_result
-                )
+        # the graph is built from the whole plan so dependencies on finished steps resolve
+        done_ids = {s.get("id") for s in completed or []}
+        levels = [[s for s in level if s.get("id") not in done_ids] for level in levels]
+        return [level for level in levels if level]
 
-        return results
+    def _start_step(self, step: Dict, i: int, total: Optional[int], context: Dict,
+                    results: List[Dict], completed: List[Dict]) -> Dict:
+        # total is None while the plan is still streaming
+        print(f"\nStep {i}/{total or '?'}: {step['action']}")
+        print(f"Description: {step['description']}")
+
+        dependencies = step.get("dependencies", [])
+        if dependencies:
+            print(f"Dependencies: {dependencies}")
+
+        exec_context, context_report = self.context_builder.build(step, context, results, completed)
+        if context_report["trimmed_tokens"] > 0:
+            print(f"Context trimmed by ~{context_report['trimmed_tokens']} tokens "
+                  f"({context_report['bytes_before']} -> {context_report['bytes_after']} bytes)")
+
+        self.tracer.log_decision(
+            step=f"Execution - Step {i}",
+            action=step['action'],
+            reasoning=f"Executing planned step to achieve: {step.get('expected_output', 'step completion')}",
+            inputs={"step": step, "context": exec_context, "context_report": context_report}
+        )
+
+        return exec_context
+
+    def _record_step_result(self, step: Dict, i: int, result: Dict, steps: List[Dict],
+                            results: List[Dict], completed: List[Dict],
+                            checkpoint: TaskCheckpoint = None):
+        results.append(result)
+        completed.append(step)
+        order = {s.get("id"): n for n, s in enumerate(steps)}
+        completed.sort(key=lambda s: order[s.get("id")])
 
-    def _finalize_task(self, task_description: str, plan: Dict, results: List[Dict]) -> Dict:
+        if checkpoint:
+            checkpoint.save_step(i, result)
+            done_ids = {s.get("id") for s in completed}
+            pending = [s for s in steps if s.get("id") not in done_ids]
+            self.memory.update_run(checkpoint.run_id, completed_steps=completed, pending_steps=pending)
+
+        print(f"Step {i} status: {result['status']}")
+        if result.get('result', {}).get('type'):
+            print(f"Output type: {result['result']['type']}")
+        if result.get('result', {}).get('time_to_first_token') is not None:
+            print(f"Time to first token: {result['result']['time_to_first_token']:.2f}s")
+
+        self.tracer.log_decision(
+            step=f"Execution Result - Step {i}",
+            action="Step completed successfully",
+            reasoning=f"Step produced expected output: {step.get('expected_output')}",
+            outputs=result
+        )
+
+    def _record_step_error(self, step: Dict, i: int, error: Exception, results: List[Dict]):
+        error_result = StepResult(
+            step_id=step.get("id"),
+            action=step.get("action"),
+            status="failed",
+            error=str(error),
+            timestamp=datetime.now().isoformat()
+        )
+        results.append(error_result)
+
+        print(f"Step {i} status: failed")
+        print(f"Error: {str(error)}")
+
+        self.tracer.log_decision(
+            step=f"Execution Error - Step {i}",
+            action="Step failed",
+            reasoning=f"Encountered error during execution: {str(error)}",
+            outputs=error_result
+        )
+
+    def _finalize_task(self, task_description: str, plan: Dict, results: List[Dict],
+                       context: Dict = None, memo_match: Dict = None) -> Dict:
         successful = [r for r in results if r.get("status") == "completed"]
         failed = [r for r in results if r.get("status") == "failed"]
 
@@ -166,16 +559,17 @@ class StatefulAgent:
         print(f"  Successful: {len(successful)}")
         print(f"  Failed: {len(failed)}")
 
-        task_record = {
-            "task": task_description,
-            "type": self.memory.get_state("context").get("task_type", "general"),
-            "plan": plan,
-            "results": results,
-            "success_rate": len(successful) / len(results) if results else 0,
-            "session_id": self.session_id
-        }
+        task_record = TaskRecord(
+            task=task_description,
+            type=(context or {}).get("task_type", "general"),
+            plan=plan,
+            results=results,
+            success_rate=len(successful) / len(results) if results else 0,
+            session_id=self.session_id
+        )
 
         self.memory.add_completed_task(task_record)
+        self._update_plan_memo(task_description, context, plan, task_record["success_rate"], memo_match)
 
         self.tracer.log_decision(
             step="Task Completion",
@@ -186,6 +580,12 @@ class StatefulAgent:
                 "success_rate": task_record["success_rate"]
             }
         )
+        self.memory.flush()
+        self.plan_memo.flush()
+        if self.router:
+            self.router.flush()
+        self.tracer.flush()
+        self.metrics.write_textfile(self.metrics_file)
 
         summary = {
             "task": task_description,
@@ -194,12 +594,29 @@ class StatefulAgent:
             "successful_steps": len(successful),
             "failed_steps": len(failed),
             "success_rate": task_record["success_rate"],
-            "results": results,
-            "decision_trace": self.tracer.get_trace()
+            # plain dicts from here on, callers serialize the summary as they like
+            "results": [result.to_dict() for result in results],
+            # only this task's decisions, the full history stays in get_decision_trace
+            "decision_trace": [entry.to_dict() for entry in self.tracer.task_entries()]
         }
 
         return summary
 
+    def _update_plan_memo(self, task_description: str, context: Dict, plan: Dict,
+                          success_rate: float, memo_match: Dict = None):
+        if memo_match is None:
+            self.plan_memo.store(task_description, (context or {}).get("task_type", "general"),
+                                 context, plan, success_rate)
+            return
+        if not self.plan_memo.record_outcome(memo_match["entry_id"], success_rate):
+            print("Reused plan is no longer reliable, it will be planned fresh next time")
+            self.tracer.log_decision(
+                step="Plan Memo",
+                action="Invalidated stored plan",
+                reasoning=f"Recent reuses averaged below {self.plan_memo.min_success_rate:.0%} success",
+                inputs={"memo_entry": memo_match["entry_id"], "success_rate": success_rate}
+            )
+
     def get_decision_trace(self) -> str:
         return self.tracer.explain_decision_path()
 
@@ -209,7 +626,83 @@ class StatefulAgent:
 
     def start_new_session(self):
         self.session_id = str(uuid.uuid4())
+        self.metrics.default_labels["session"] = self.session_id
         self.memory.clear_session()
         self.tracer.clear_trace()
         self.memory.update_state("session_id", self.session_id)
         print(f"\nNew session started: {self.session_id[:8]}...")
+
+
+class _StreamedRun:
+    # bookkeeping for one task whose plan is streamed. the scheduler (or the async
+    # loop) calls these as steps arrive, start and finish
+    def __init__(self, agent: StatefulAgent, task_description: str, context: Dict,
+                 checkpoint: TaskCheckpoint):
+        self.agent = agent
+        self.task_description = task_description
+        self.context = context
+        self.checkpoint = checkpoint
+        self.full_context = agent._planning_context(task_description, context)
+        self.plan_stream = None
+
+        self.steps = []
+        self.numbers = {}
+        self.results = []
+        self.completed = []
+        self.total = None
+        self.start = time.perf_counter()
+
+        print("Analyzing task and creating execution plan...")
+
+    def on_step(self, step: Dict):
+        self.steps.append(step)
+        self.numbers[step.get("id")] = len(self.steps)
+        print(f"\nPlanned step {len(self.steps)}: {step['action']}")
+
+    def on_end(self):
+        plan = self.plan_stream.plan
+        self.total = len(self.steps)
+        self.agent.metrics.observe("agent_planning_seconds", time.perf_counter() - self.start)
+        print(f"\nGoal: {plan.get('goal', 'N/A')}")
+        print(f"Plan complete: {self.total} steps")
+        self.agent._record_plan(self.task_description, self.full_context, plan, announce=False)
+        self.agent._save_plan(self.checkpoint, self.task_description, self.context, plan)
+
+    def on_stall(self, stalled: List[Dict]):
+        # the finished plan has a cycle or a dependency on a step that doesn't exist
+        print(f"Plan dependencies invalid, running steps {[s.get('id') for s in stalled]} in order")
+        self.agent.tracer.log_decision(
+            step="Scheduling",
+            action="Fallback to sequential execution",
+            reasoning="Plan dependency graph is invalid: some steps can never become ready",
+            inputs={"step_ids": [s.get("id") for s in stalled]}
+        )
+
+    def prepare(self, step: Dict) -> Dict:
+        # only the step's own ancestors go into its context. which unrelated steps
+        # happen to be done depends on timing, and would make prompts uncacheable
+        ancestors = self._ancestors(step)
+        completed = [s for s in self.completed if s.get("id") in ancestors]
+        results = [r for r in self.results if r.get("step_id") in ancestors]
+        return self.agent._start_step(step, self.numbers[step.get("id")], self.total,
+                                      self.context, results, completed)
+
+    def on_result(self, step: Dict, result: Dict, error: Exception):
+        i = self.numbers[step.get("id")]
+        if error is None:
+            self.agent._record_step_result(step, i, result, self.steps, self.results,
+                                           self.completed, self.checkpoint)
+        else:
+            self.agent._record_step_error(step, i, error, self.results)
+
+    def _ancestors(self, step: Dict) -> set:
+        by_id = {s.get("id"): s for s in self.steps}
+        seen = set()
+        frontier = list(step.get("dependencies", []))
+        while frontier:
+            step_id = frontier.pop()
+            if step_id in seen or step_id not in by_id:
+                continue
+            seen.add(step_id)
+            frontier.extend(by_id[step_id].get("dependencies", []))
+        return seen
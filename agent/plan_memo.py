@@ -0,0 +1,236 @@
+import copy
+import hashlib
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Dict, List, Any, Optional
+
+from agent.journal import Journal
+from agent.metrics import MetricsRegistry
+
+
+_WORD = re.compile(r"[a-z0-9]+")
+_NUMBER = re.compile(r"^\d+$")
+_STOPWORDS = {"a", "an", "the", "and", "or", "for", "of", "to", "in", "on", "with", "our",
+              "this", "that", "is", "are", "be", "by", "as", "it", "we", "new"}
+# plan fields that are prose and can carry context values
+_TEXT_FIELDS = ("goal", "success_criteria", "action", "description", "expected_output")
+
+
+def _default_memo() -> Dict:
+    return {"entries": {}}
+
+
+def _words(task_description: str) -> List[str]:
+    return [word for word in _WORD.findall(task_description.lower()) if word not in _STOPWORDS]
+
+
+def task_tokens(task_description: str) -> List[str]:
+    # lowercase words without stopwords, numbers collapsed so tasks that only
+    # differ in their figures still match as near
+    return ["#" if _NUMBER.match(word) else word for word in _words(task_description)]
+
+
+def task_numbers(task_description: str) -> List[str]:
+    return [word for word in _words(task_description) if _NUMBER.match(word)]
+
+
+def fingerprint(task_type: str, task_description: str) -> str:
+    # numbers are kept, an exact match must not come back with stale figures
+    normalized = " ".join(_words(task_description))
+    return hashlib.sha256(f"{task_type}\n{normalized}".encode("utf-8")).hexdigest()[:16]
+
+
+def jaccard(a: List[str], b: List[str]) -> float:
+    a, b = set(a), set(b)
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class PlanMemo:
+    # past plans keyed by task type and a normalized fingerprint of the task text.
+    # a lookup returns a stored plan for the same task, or one whose words overlap
+    # by at least near_threshold (Jaccard), with old context values swapped for the
+    # new ones. plans are only stored when they went well, and are dropped again
+    # once their recent reuses average below min_success_rate
+    def __init__(self, storage_dir: str = "storage", near_threshold: float = 0.85,
+                 min_success_rate: float = 0.8, window: int = 5, max_entries: int = 500,
+                 bypass: bool = False, metrics: MetricsRegistry = None):
+        self.memo_file = os.path.join(storage_dir, "plan_memo.json")
+        self.near_threshold = near_threshold
+        self.min_success_rate = min_success_rate
+        # how many recent reuses the success rate is averaged over
+        self.window = window
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.metrics = metrics
+
+        self.journal = Journal(self.memo_file, _default_memo, metrics=metrics, store="plan_memo")
+        self._memo = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    @property
+    def memo(self) -> Dict:
+        # read on the first lookup rather than at startup
+        if self._memo is None:
+            with self._load_lock:
+                if self._memo is None:
+                    self._memo = self.journal.load()
+        return self._memo
+
+    def lookup(self, task_description: str, task_type: str, context: Dict = None) -> Optional[Dict]:
+        # returns {"entry_id", "match", "similarity", "plan"} or None
+        if self.bypass:
+            return None
+        entry_id = fingerprint(task_type, task_description)
+        tokens = task_tokens(task_description)
+        numbers = task_numbers(task_description)
+
+        with self._lock:
+            entries = self.memo["entries"]
+            match, similarity = "exact", 1.0
+            entry = entries.get(entry_id)
+            if entry is None:
+                match, similarity = "near", 0.0
+                for candidate_id, candidate in entries.items():
+                    if candidate["task_type"] != task_type:
+                        continue
+                    score = jaccard(tokens, candidate["tokens"])
+                    # the stored plan's figures have to pair up with the new ones to be swapped
+                    if (score >= self.near_threshold and score > similarity
+                            and len(task_numbers(candidate["task"])) == len(numbers)):
+                        entry_id, entry, similarity = candidate_id, candidate, score
+            if entry is not None:
+                entry = self._update(entry_id, {"hits": entry.get("hits", 0) + 1,
+                                                "last_used": datetime.now().isoformat()})
+
+        self._record_lookup(match if entry else "miss")
+        if entry is None:
+            return None
+        replacements = {} if match == "exact" else self._number_replacements(task_numbers(entry["task"]), numbers)
+        return {
+            "entry_id": entry_id,
+            "match": match,
+            "similarity": similarity,
+            "plan": self.reparameterize(entry["plan"], entry.get("context") or {}, context or {},
+                                        replacements)
+        }
+
+    def store(self, task_description: str, task_type: str, context: Dict, plan: Dict,
+              success_rate: float) -> Optional[str]:
+        if self.bypass or success_rate < self.min_success_rate or not plan.get("steps"):
+            return None
+        entry_id = fingerprint(task_type, task_description)
+        entry = {
+            "task": task_description,
+            "task_type": task_type,
+            "tokens": sorted(set(task_tokens(task_description))),
+            "context": context or {},
+            "plan": plan,
+            "success_rate": success_rate,
+            "reuse_rates": [],
+            "hits": 0,
+            "created_at": datetime.now().isoformat(),
+            "last_used": datetime.now().isoformat()
+        }
+        with self._lock:
+            self._put(entry_id, entry)
+            self._evict()
+        return entry_id
+
+    def record_outcome(self, entry_id: str, success_rate: float) -> bool:
+        # returns False when the entry was invalidated
+        with self._lock:
+            entry = self.memo["entries"].get(entry_id)
+            if entry is None:
+                return False
+            rates = (entry.get("reuse_rates", []) + [success_rate])[-self.window:]
+            if sum(rates) / len(rates) < self.min_success_rate:
+                self._delete(entry_id)
+                return False
+            self._update(entry_id, {"reuse_rates": rates})
+            return True
+
+    def invalidate(self, entry_id: str):
+        with self._lock:
+            self._delete(entry_id)
+
+    def flush(self):
+        self.journal.close()
+
+    def reparameterize(self, plan: Dict, old_context: Dict, new_context: Dict,
+                       replacements: Dict[str, str] = None) -> Dict:
+        # replace values of the stored task's context with the new task's values
+        # wherever they appear word for word in the plan's text, along with any
+        # extra replacements given
+        replacements = dict(replacements or {})
+        old_values, new_values = self._flatten(old_context), self._flatten(new_context)
+        for key, old in old_values.items():
+            new = new_values.get(key)
+            if new is None or new == old or len(str(old)) < 3:
+                continue
+            replacements[str(old)] = str(new)
+
+        plan = copy.deepcopy(plan)
+        if not replacements:
+            return plan
+        pattern = re.compile(r"(?<!\w)(" + "|".join(re.escape(k) for k in
+                                                    sorted(replacements, key=len, reverse=True)) + r")(?!\w)")
+
+        def swap(text):
+            return pattern.sub(lambda m: replacements[m.group(1)], text) if isinstance(text, str) else text
+
+        for field in ("goal", "success_criteria"):
+            plan[field] = swap(plan.get(field))
+        for step in plan.get("steps", []):
+            for field in _TEXT_FIELDS:
+                if field in step:
+                    step[field] = swap(step[field])
+        return plan
+
+    def _number_replacements(self, old_numbers: List[str], new_numbers: List[str]) -> Dict[str, str]:
+        # figures of the stored task paired with the new task's by position
+        return {old: new for old, new in zip(old_numbers, new_numbers) if old != new}
+
+    def _flatten(self, context: Dict, prefix: str = "") -> Dict[str, Any]:
+        flat = {}
+        for key, value in context.items():
+            if isinstance(value, dict):
+                flat.update(self._flatten(value, f"{prefix}{key}."))
+            elif isinstance(value, (str, int, float)) and not isinstance(value, bool):
+                flat[f"{prefix}{key}"] = value
+        return flat
+
+    def _put(self, entry_id: str, entry: Dict):
+        # caller holds the lock
+        self.memo["entries"][entry_id] = entry
+        self.journal.append({"op": "set_item", "key": "entries", "field": entry_id,
+                             "value": entry}, self.memo)
+
+    def _update(self, entry_id: str, fields: Dict) -> Dict:
+        # caller holds the lock. only the changed fields are journaled, the plan
+        # is written once when the entry is stored
+        entry = {**self.memo["entries"][entry_id], **fields}
+        self.memo["entries"][entry_id] = entry
+        self.journal.append({"op": "update_item", "key": "entries", "field": entry_id,
+                             "value": fields}, self.memo)
+        return entry
+
+    def _delete(self, entry_id: str):
+        self.memo["entries"].pop(entry_id, None)
+        self.journal.append({"op": "del_item", "key": "entries", "field": entry_id}, self.memo)
+
+    def _evict(self):
+        entries = self.memo["entries"]
+        if len(entries) <= self.max_entries:
+            return
+        by_age = sorted(entries, key=lambda k: entries[k].get("last_used", ""))
+        for entry_id in by_age[:len(entries) - self.max_entries]:
+            self._delete(entry_id)
+
+    def _record_lookup(self, result: str):
+        if self.metrics:
+            self.metrics.inc("agent_plan_memo_lookups", result=result)
@@ -1,22 +1,235 @@
-from typing import List, Dict, Any
-import google.generativeai as genai
-import os
+from typing import List, Dict, Any, Iterator, AsyncIterator
+import asyncio
+import json
+import re
+
+from agent.cache import ResponseCache
+from agent.models import ModelProvider, GeminiProvider, ModelClient
+from agent.metrics import MetricsRegistry
+from agent.governor import RequestGovernor
+from agent.records import Step
+
+
+_STEPS_START = re.compile(r'"steps"\s*:\s*\[')
+_GOAL = re.compile(r'"goal"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_CRITERIA = re.compile(r'"success_criteria"\s*:\s*"((?:[^"\\]|\\.)*)"')
+_LIST_ITEM = re.compile(r'^\s*(?:\d+[.)]|[-*])\s+(.+?)\s*$', re.MULTILINE)
+
+
+class StreamingPlanParser:
+    # pulls step objects out of the plan JSON while it is still being generated.
+    # feed() returns the steps completed by each chunk, close() returns the whole
+    # plan, from the complete document whenever it parses. when the JSON is
+    # broken, the steps that did stream are kept, then a numbered list in the
+    # text, and only then the task as a single step
+    def __init__(self, task_description: str = ""):
+        self.task_description = task_description
+        self.text = ""
+        self.steps = []
+
+        self._pos = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._obj_start = None
+        self._array_closed = False
+
+    def feed(self, chunk: str) -> List[Dict]:
+        self.text += chunk
+        if self._array_closed:
+            return []
+        if self._pos is None:
+            match = _STEPS_START.search(self.text)
+            if not match:
+                return []
+            self._pos = match.end()
+
+        emitted = []
+        text = self.text
+        i = self._pos
+        while i < len(text):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == "{":
+                if self._depth == 0:
+                    self._obj_start = i
+                self._depth += 1
+            elif c == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0:
+                    step = self._parse_step(text[self._obj_start:i + 1])
+                    if step:
+                        emitted.append(step)
+            elif c == "]" and self._depth == 0:
+                self._array_closed = True
+                i += 1
+                break
+            i += 1
+        self._pos = i
+        return emitted
+
+    def close(self) -> Dict[str, Any]:
+        plan = self._parse_whole()
+        if plan is not None and plan.get("steps"):
+            # the complete document wins over steps picked out while it was partial
+            streamed, self.steps = self.steps, []
+            for raw in plan["steps"]:
+                if isinstance(raw, dict):
+                    self._add_step(raw)
+            if self.steps:
+                plan["steps"] = list(self.steps)
+                return plan
+            self.steps = streamed
+
+        if not self.steps:
+            self._salvage_list()
+        goal = self._string_field(_GOAL) or self.task_description
+        if not self.steps:
+            # nothing step-like in the response at all
+            self._add_step({"id": 1, "action": "Execute task", "description": self.text,
+                            "expected_output": "Task completion"})
+        return {
+            "goal": goal,
+            "steps": list(self.steps),
+            "success_criteria": self._string_field(_CRITERIA) or "All planned steps completed"
+        }
+
+    def _parse_whole(self):
+        start = self.text.find("{")
+        end = self.text.rfind("}")
+        if start == -1 or end <= start:
+            return None
+        try:
+            plan = json.loads(self.text[start:end + 1])
+            if isinstance(plan, dict) and isinstance(plan.get("steps"), list):
+                return plan
+        except ValueError:
+            pass
+        # prose or another object around the plan: the first complete object that is one
+        decoder = json.JSONDecoder()
+        while start != -1:
+            try:
+                plan = decoder.raw_decode(self.text, start)[0]
+            except ValueError:
+                plan = None
+            if isinstance(plan, dict) and isinstance(plan.get("steps"), list):
+                return plan
+            start = self.text.find("{", start + 1)
+        return None
+
+    def _parse_step(self, raw: str):
+        try:
+            step = json.loads(raw)
+        except ValueError:
+            return None
+        if not isinstance(step, dict):
+            return None
+        return self._add_step(step)
+
+    def _add_step(self, step: Dict) -> Step:
+        step_id = self._as_id(step.get("id"))
+        seen = {s["id"] for s in self.steps}
+        if step_id is None or step_id in seen:
+            step_id = max([s["id"] for s in self.steps if isinstance(s["id"], int)] + [0]) + 1
+
+        dependencies = step.get("dependencies")
+        if not isinstance(dependencies, list):
+            dependencies = []
+
+        action = str(step.get("action") or f"Step {step_id}")
+        normalized = Step(
+            step,
+            id=step_id,
+            action=action,
+            description=str(step.get("description") or action),
+            expected_output=step.get("expected_output") or "Step completion",
+            dependencies=[self._as_id(d) for d in dependencies if self._as_id(d) is not None]
+        )
+        self.steps.append(normalized)
+        return normalized
+
+    def _salvage_list(self):
+        # "1. Do this" / "- Do that" lines, run one after another
+        for item in _LIST_ITEM.findall(self.text):
+            previous = [self.steps[-1]["id"]] if self.steps else []
+            self._add_step({"action": item.strip("*_ "), "dependencies": previous})
+
+    def _string_field(self, pattern):
+        match = pattern.search(self.text)
+        if not match:
+            return None
+        try:
+            return json.loads(f'"{match.group(1)}"')
+        except ValueError:
+            return match.group(1)
+
+    def _as_id(self, value):
+        if isinstance(value, str) and value.strip().isdigit():
+            return int(value)
+        return value
+
+
+class PlanStream:
+    # iterate it (or async-iterate it) for steps as they are planned. once it's
+    # exhausted, plan holds the full plan, including any steps that were only
+    # recovered when the response was complete. a step already handed out keeps
+    # running even if the final parse words it differently
+    def __init__(self, chunks, task_description: str):
+        self.chunks = chunks
+        self.parser = StreamingPlanParser(task_description)
+        self.plan = None
+
+    def __iter__(self) -> Iterator[Dict]:
+        for chunk in self.chunks:
+            yield from self.parser.feed(chunk)
+        yield from self._finish()
+
+    async def __aiter__(self) -> AsyncIterator[Dict]:
+        async for chunk in self.chunks:
+            for step in self.parser.feed(chunk):
+                yield step
+        for step in self._finish():
+            yield step
+
+    def _finish(self) -> List[Dict]:
+        streamed = {step["id"] for step in self.parser.steps}
+        self.plan = self.parser.close()
+        return [step for step in self.plan["steps"] if step["id"] not in streamed]
 
 
 class TaskPlanner:
-    def __init__(self, api_key: str = None):
-        self.api_key = api_key or os.getenv("GEMINI_API_KEY")
-        if not self.api_key:
-            raise ValueError("GEMINI_API_KEY not found")
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel('models/gemini-2.5-flash')
+    # pass client to share one ModelClient (provider, cache, governor) with the executor
+    def __init__(self, api_key: str = None, cache: ResponseCache = None,
+                 provider: ModelProvider = None, metrics: MetricsRegistry = None,
+                 governor: RequestGovernor = None, client: ModelClient = None):
+        self.provider = client.provider if client else provider or GeminiProvider(api_key=api_key)
+        self.client = client or ModelClient(self.provider, cache=cache, metrics=metrics, governor=governor)
 
     def decompose_task(self, task_description: str, context: Dict = None) -> Dict[str, Any]:
+        prompt = self._plan_prompt(task_description, context)
+        return self._parse_plan(self._generate(prompt), task_description)
+
+    def stream_plan(self, task_description: str, context: Dict = None) -> PlanStream:
+        prompt = self._plan_prompt(task_description, context)
+        return PlanStream(self.client.stream(prompt, action_type="plan"), task_description)
+
+    def _generate(self, prompt: str, action_type: str = "plan") -> str:
+        return self.client.generate(prompt, action_type=action_type)
+
+    def _plan_prompt(self, task_description: str, context: Dict = None) -> str:
         context_str = ""
         if context:
             context_str = f"\n\nAdditional context:\n{self._format_context(context)}"
 
-        prompt = f"""You are a task planning assistant. Break down the following task into a clear, executable plan.
+        return f"""You are a task planning assistant. Break down the following task into a clear, executable plan.
 
 Task: {task_description}{context_str}
 
@@ -41,29 +254,12 @@ Format your response as JSON with this structure:
   "success_criteria": "how to know task is complete"
 }}"""
 
-        response = self.model.generate_content(prompt)
-        response_text = response.text
-
-        import json
-        try:
-            # sometimes the model wraps response in code blocks, need to extract
-            if "```json" in response_text:
-                json_str = response_text.split("```json")[1].split("```")[0].strip()
-            elif "```" in response_text:
-                json_str = response_text.split("```")[1].split("```")[0].strip()
-            else:
-                json_str = response_text.strip()
-
-            plan = json.loads(json_str)
-            return plan
-        except json.JSONDecodeError:
-            # fallback if parsing fails
-            return {
-                "goal": task_description,
-                "steps": [{"id": 1, "action": "Execute task", "description": response_text,
-                          "expected_output": "Task completion", "dependencies": []}],
-                "success_criteria": "Task completed"
-            }
+    def _parse_plan(self, response_text: str, task_description: str) -> Dict[str, Any]:
+        # same parser as streaming, fed in one go. it copes with code fences and
+        # salvages what it can from malformed JSON
+        parser = StreamingPlanParser(task_description)
+        parser.feed(response_text)
+        return parser.close()
 
     def _format_context(self, context: Dict) -> str:
         lines = []
@@ -87,10 +283,8 @@ Provide an improved version of this step as JSON:
   "expected_output": "what this produces"
 }}"""
 
-        response = self.model.generate_content(prompt)
-        response_text = response.text
+        response_text = self._generate(prompt, action_type="refine")
 
-        import json
         try:
             if "```json" in response_text:
                 json_str = response_text.split("```json")[1].split("```")[0].strip()
@@ -101,3 +295,25 @@ Provide an improved version of this step as JSON:
             return {**step, **refined}
         except:
             return step
+
+
+class AsyncTaskPlanner(TaskPlanner):
+    def __init__(self, api_key: str = None, semaphore: asyncio.Semaphore = None,
+                 cache: ResponseCache = None, provider: ModelProvider = None,
+                 metrics: MetricsRegistry = None, governor: RequestGovernor = None,
+                 client: ModelClient = None):
+        super().__init__(api_key=api_key, cache=cache, provider=provider, metrics=metrics,
+                         governor=governor, client=client)
+        self.semaphore = semaphore
+
+    async def adecompose_task(self, task_description: str, context: Dict = None) -> Dict[str, Any]:
+        prompt = self._plan_prompt(task_description, context)
+        return self._parse_plan(await self._agenerate(prompt), task_description)
+
+    def astream_plan(self, task_description: str, context: Dict = None) -> PlanStream:
+        prompt = self._plan_prompt(task_description, context)
+        chunks = self.client.astream(prompt, semaphore=self.semaphore, action_type="plan")
+        return PlanStream(chunks, task_description)
+
+    async def _agenerate(self, prompt: str) -> str:
+        return await self.client.agenerate(prompt, semaphore=self.semaphore, action_type="plan")
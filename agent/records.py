@@ -0,0 +1,161 @@
+import json
+from collections.abc import MutableMapping
+from typing import Dict, Any, Iterator
+
+
+_UNSET = object()
+
+
+class Record(MutableMapping):
+    # a fixed set of slotted fields that reads and writes like the dict it
+    # replaces: record["status"], record.get("result"), {**record} and
+    # json.dumps(record, default=to_json) all work. a field that was never set
+    # is simply absent, same as a missing key. keys outside the known fields
+    # (planner steps often carry extras) go to a small overflow dict
+    __slots__ = ("extra",)
+    fields = ()
+    _field_set = frozenset()
+
+    def __init__(self, data: Dict = None, **values):
+        if isinstance(data, Record):
+            data = data.to_dict()
+        if data:
+            values = {**data, **values} if values else data
+        fields = self._field_set
+        extra = None
+        for key, value in values.items():
+            if key in fields:
+                setattr(self, key, value)
+            else:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+        self.extra = extra
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.fields)
+
+    @classmethod
+    def from_dict(cls, data: Dict):
+        # records pass through unchanged, so callers can coerce without copying
+        if isinstance(data, cls):
+            return data
+        return cls(data)
+
+    @classmethod
+    def from_json(cls, line: str):
+        return cls(json.loads(line))
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = {name: value for name in self.fields
+                if (value := getattr(self, name, _UNSET)) is not _UNSET}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def to_json(self) -> str:
+        return _encoder.encode(self.to_dict())
+
+    def __getitem__(self, key: str):
+        if key in self._field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        if key in self._field_set:
+            return getattr(self, key, default)
+        return self.extra.get(key, default) if self.extra else default
+
+    def __contains__(self, key) -> bool:
+        if key in self._field_set:
+            return hasattr(self, key)
+        return bool(self.extra) and key in self.extra
+
+    def __setitem__(self, key: str, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key: str):
+        if key in self._field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        elif self.extra and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    # straight off the slots, nothing is copied. keys(), items() and values()
+    # are MutableMapping's live views on top of these
+    def __iter__(self) -> Iterator[str]:
+        for name in self.fields:
+            if hasattr(self, name):
+                yield name
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self) -> int:
+        count = 0
+        for name in self.fields:
+            if hasattr(self, name):
+                count += 1
+        return count + (len(self.extra) if self.extra else 0)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+def to_json(obj):
+    # default= hook for json.dumps, so records nested in plain dicts serialize
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# json.dumps builds a new encoder whenever it gets keyword arguments
+_encoder = json.JSONEncoder(default=to_json)
+
+
+def dumps(obj) -> str:
+    # json.dumps(obj, default=to_json) without the per-call encoder, for hot paths
+    return _encoder.encode(obj)
+
+
+def to_plain(obj):
+    # records anywhere inside obj turned back into dicts, for callers that
+    # expect plain JSON types (task summaries, batch output)
+    if isinstance(obj, Record):
+        obj = obj.to_dict()
+    if isinstance(obj, dict):
+        return {k: to_plain(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [to_plain(v) for v in obj]
+    return obj
+
+
+class Step(Record):
+    __slots__ = fields = ("id", "action", "description", "dependencies", "expected_output")
+
+
+class StepResult(Record):
+    __slots__ = fields = ("step_id", "action", "action_type", "status", "result", "error", "timestamp")
+
+
+class TraceEntry(Record):
+    __slots__ = fields = ("timestamp", "step", "action", "reasoning", "inputs", "outputs")
+
+
+class TaskRecord(Record):
+    __slots__ = fields = ("task_id", "task", "type", "plan", "results", "success_rate",
+                          "session_id", "completed_at")
@@ -0,0 +1,176 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Any
+
+from agent.metrics import MetricsRegistry, estimate_tokens
+
+
+# which tier each call prefers. "fast" and "strong" mean the first and last
+# configured tier unless a tier has that name. short answers and bookkeeping
+# calls go fast, plans and long written outputs go strong
+DEFAULT_ROUTES = {
+    "plan": "strong",
+    "refine": "fast",
+    "create_document": "strong",
+    "generate_content": "strong",
+    "research": "strong",
+    "analyze_data": "fast",
+    "calculate_metrics": "fast",
+    "generic": "fast",
+    "batch": "fast"
+}
+
+# the latency deadline of the task a call is made for. it travels with the task
+# instead of living on the router, so tasks running side by side on one agent
+# (arun_task on one loop, or the scheduler's threads) each keep their own budget
+_task_deadline = contextvars.ContextVar("task_deadline", default=None)
+
+
+class ModelTier:
+    # one model the router can send calls to. tiers are given fastest and
+    # cheapest first. prompts over max_prompt_tokens go to a later tier
+    def __init__(self, name: str, provider, max_prompt_tokens: int = None):
+        self.name = name
+        self.provider = provider
+        self.max_prompt_tokens = max_prompt_tokens
+
+    def fits(self, tokens: int) -> bool:
+        return self.max_prompt_tokens is None or tokens <= self.max_prompt_tokens
+
+
+class ModelRouter:
+    # picks a tier per model call from the action type, the prompt size and what
+    # is left of the task's latency budget, and learns from how each route (action
+    # type, tier) did. a route whose recent failure rate passes failure_threshold
+    # is skipped for the next tier up, with one call in probe_every still let
+    # through so it can recover. with a budget, a call whose tier is expected to
+    # take longer than the time left drops to the fastest tier expected to make it.
+    # latency and failure rate are moving averages, kept in storage/routing.json
+    def __init__(self, tiers: List[ModelTier], routes: Dict[str, str] = None,
+                 storage_dir: str = "storage", failure_threshold: float = 0.3,
+                 min_samples: int = 5, probe_every: int = 10, smoothing: float = 0.2,
+                 metrics: MetricsRegistry = None):
+        if not tiers:
+            raise ValueError("ModelRouter needs at least one tier")
+        self.tiers = tiers
+        self.routes = {**DEFAULT_ROUTES, **(routes or {})}
+        self.stats_file = os.path.join(storage_dir, "routing.json")
+        self.failure_threshold = failure_threshold
+        self.min_samples = min_samples
+        self.probe_every = probe_every
+        self.smoothing = smoothing
+        self.metrics = metrics
+
+        self._index = {tier.name: i for i, tier in enumerate(tiers)}
+        self._lock = threading.Lock()
+        self._dirty = False
+        os.makedirs(storage_dir, exist_ok=True)
+        self.stats = self._load()
+
+    def start_task(self, latency_budget: float = None):
+        # the budget covers the whole task, planning included. it holds for calls
+        # made from the current context and from tasks and threads started in it
+        _task_deadline.set(time.monotonic() + latency_budget if latency_budget else None)
+
+    def choose(self, action_type: str, prompt: str) -> ModelTier:
+        tokens = estimate_tokens(prompt)
+        index = self._preferred(action_type)
+        last = len(self.tiers) - 1
+        deadline = _task_deadline.get()
+
+        with self._lock:
+            while index < last and (not self.tiers[index].fits(tokens)
+                                    or self._unreliable(action_type, index)):
+                index += 1
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                while (index > 0 and self._expected_seconds(action_type, index) > remaining
+                       and self.tiers[index - 1].fits(tokens)):
+                    index -= 1
+        return self.tiers[index]
+
+    def record(self, action_type: str, tier: ModelTier, seconds: float, ok: bool):
+        # only calls that reached a model are recorded, a choice answered from the
+        # cache doesn't count towards the next probe
+        with self._lock:
+            for index in range(self._preferred(action_type), self._index[tier.name] + 1):
+                passed = self.stats.get(self._key(action_type, self.tiers[index].name))
+                if passed and self._failing(passed):
+                    passed["skipped"] = passed.get("skipped", 0) + 1
+            stats = self.stats.setdefault(self._key(action_type, tier.name),
+                                          {"calls": 0, "failures": 0, "failure_rate": 0.0, "seconds": None})
+            stats["calls"] += 1
+            stats["failures"] += 0 if ok else 1
+            stats["failure_rate"] += self.smoothing * ((0.0 if ok else 1.0) - stats["failure_rate"])
+            if ok:
+                # failures are often fast, only successful calls say how long a call takes
+                stats["seconds"] = seconds if stats["seconds"] is None else \
+                    stats["seconds"] + self.smoothing * (seconds - stats["seconds"])
+            self._dirty = True
+
+        if self.metrics:
+            self.metrics.inc("agent_route_calls", action_type=action_type, tier=tier.name,
+                             result="ok" if ok else "failed")
+            if ok:
+                self.metrics.observe("agent_route_seconds", seconds, action_type=action_type, tier=tier.name)
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {key: dict(stats) for key, stats in self.stats.items()}
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self.stats, indent=2)
+            self._dirty = False
+        tmp_path = self.stats_file + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.stats_file)
+        if self.metrics:
+            self.metrics.inc("agent_storage_bytes_written", len(data), store="routing")
+
+    def _preferred(self, action_type: str) -> int:
+        name = self.routes.get(action_type, self.routes["generic"])
+        if name in self._index:
+            return self._index[name]
+        return len(self.tiers) - 1 if name == "strong" else 0
+
+    def _unreliable(self, action_type: str, index: int) -> bool:
+        # caller holds the lock
+        stats = self.stats.get(self._key(action_type, self.tiers[index].name))
+        if not stats or not self._failing(stats):
+            return False
+        # let the odd call through, otherwise a route that recovered would never be seen to
+        return (stats.get("skipped", 0) + 1) % self.probe_every != 0
+
+    def _failing(self, stats: Dict[str, Any]) -> bool:
+        return stats["calls"] >= self.min_samples and stats["failure_rate"] > self.failure_threshold
+
+    def _expected_seconds(self, action_type: str, index: int) -> float:
+        # caller holds the lock. a tier never timed for this action type is judged
+        # by its other routes, and one never timed at all is assumed to make it
+        name = self.tiers[index].name
+        stats = self.stats.get(self._key(action_type, name))
+        if stats and stats["seconds"] is not None:
+            return stats["seconds"]
+        timed = [s["seconds"] for key, s in self.stats.items()
+                 if key.endswith(f"|{name}") and s["seconds"] is not None]
+        return sum(timed) / len(timed) if timed else 0.0
+
+    def _key(self, action_type: str, tier_name: str) -> str:
+        return f"{action_type}|{tier_name}"
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        if not os.path.exists(self.stats_file):
+            return {}
+        try:
+            with open(self.stats_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
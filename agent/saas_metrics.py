@@ -0,0 +1,199 @@
+import math
+from typing import Dict, List, Any, Callable, Tuple
+
+import numpy as np
+
+
+# user_data keys as they show up in task contexts -> (input name, scale).
+# counts like "active_users" or "current_active_users" are left out on purpose:
+# they're often total users (larger than MAU), and taking them for DAU gives
+# impossible stickiness. daily metrics only use an explicit DAU
+INPUT_ALIASES = {
+    "dau": ("dau", 1.0),
+    "daily_active_users": ("dau", 1.0),
+    "wau": ("wau", 1.0),
+    "weekly_active_users": ("wau", 1.0),
+    "mau": ("mau", 1.0),
+    "monthly_active_users": ("mau", 1.0),
+    "paying_users": ("customers", 1.0),
+    "customers": ("customers", 1.0),
+    "churn_rate": ("churn", 1.0),
+    "monthly_churn_rate": ("churn", 1.0),
+    "churn_rate_percent": ("churn", 0.01),
+    "arpu": ("arpu", 1.0),
+    "avg_revenue_per_user": ("arpu", 1.0),
+    "gross_margin": ("gross_margin", 1.0),
+    "gross_margin_percent": ("gross_margin", 0.01),
+    "cac": ("cac", 1.0),
+    "customer_acquisition_cost": ("cac", 1.0),
+    "avg_session_duration_minutes": ("session_minutes", 1.0),
+    "session_minutes": ("session_minutes", 1.0)
+}
+# used when a row doesn't have the input: revenue is over active users unless
+# paying users are given, and LTV is revenue LTV unless a margin is given
+INPUT_DEFAULTS = {"customers": "mau", "gross_margin": 1.0}
+
+
+class MetricFormula:
+    __slots__ = ("name", "inputs", "fn", "unit", "description", "bounds")
+
+    def __init__(self, name: str, inputs: Tuple[str, ...], fn: Callable, unit: str,
+                 description: str, bounds: Tuple[float, float] = None):
+        self.name = name
+        # input names or metrics registered before this one
+        self.inputs = inputs
+        self.fn = fn
+        self.unit = unit
+        self.description = description
+        # values outside are computed but flagged
+        self.bounds = bounds
+
+
+# evaluated in registration order, so a formula can use any metric above it
+FORMULAS: Dict[str, MetricFormula] = {}
+
+
+def formula(name: str, inputs: Tuple[str, ...], unit: str, description: str,
+            bounds: Tuple[float, float] = None):
+    def register(fn: Callable) -> Callable:
+        FORMULAS[name] = MetricFormula(name, inputs, fn, unit, description, bounds)
+        return fn
+    return register
+
+
+@formula("stickiness", ("dau", "mau"), "ratio", "DAU / MAU", bounds=(0.0, 1.0))
+def _stickiness(dau, mau):
+    return dau / mau
+
+
+@formula("weekly_stickiness", ("dau", "wau"), "ratio", "DAU / WAU", bounds=(0.0, 1.0))
+def _weekly_stickiness(dau, wau):
+    return dau / wau
+
+
+@formula("wau_mau_ratio", ("wau", "mau"), "ratio", "WAU / MAU", bounds=(0.0, 1.0))
+def _wau_mau_ratio(wau, mau):
+    return wau / mau
+
+
+@formula("retention_rate", ("churn",), "ratio", "1 - monthly churn", bounds=(0.0, 1.0))
+def _retention_rate(churn):
+    return 1.0 - churn
+
+
+@formula("churned_users_per_month", ("mau", "churn"), "users", "MAU x monthly churn")
+def _churned_users(mau, churn):
+    return mau * churn
+
+
+@formula("mrr", ("customers", "arpu"), "currency", "paying users (or MAU) x ARPU")
+def _mrr(customers, arpu):
+    return customers * arpu
+
+
+@formula("arr", ("mrr",), "currency", "MRR x 12")
+def _arr(mrr):
+    return mrr * 12.0
+
+
+@formula("customer_lifetime_months", ("churn",), "months", "1 / monthly churn")
+def _lifetime(churn):
+    return 1.0 / churn
+
+
+@formula("ltv", ("arpu", "gross_margin", "customer_lifetime_months"), "currency",
+         "ARPU x gross margin x lifetime")
+def _ltv(arpu, gross_margin, lifetime):
+    return arpu * gross_margin * lifetime
+
+
+@formula("ltv_cac_ratio", ("ltv", "cac"), "ratio", "LTV / CAC")
+def _ltv_cac(ltv, cac):
+    return ltv / cac
+
+
+@formula("cac_payback_months", ("cac", "arpu", "gross_margin"), "months", "CAC / (ARPU x gross margin)")
+def _cac_payback(cac, arpu, gross_margin):
+    return cac / (arpu * gross_margin)
+
+
+@formula("daily_engagement_minutes", ("dau", "session_minutes"), "minutes", "DAU x session length")
+def _engagement(dau, session_minutes):
+    return dau * session_minutes
+
+
+class SaaSMetricsEngine:
+    # computes every registered formula for many rows (tasks, cohorts) at once:
+    # rows become one float64 column per input and each formula runs once over
+    # the columns. a metric whose inputs a row lacks, or that divides by zero,
+    # is None for that row. results are rounded to `digits` so they compare
+    # equal across runs
+    def __init__(self, formulas: Dict[str, MetricFormula] = None, digits: int = 4):
+        self.formulas = formulas if formulas is not None else FORMULAS
+        self.digits = digits
+
+    def compute(self, data: Dict[str, Any]) -> Dict[str, float]:
+        return self.compute_many([data])[0]
+
+    def compute_many(self, rows: List[Dict[str, Any]]) -> List[Dict[str, float]]:
+        columns = self.compute_columns(rows)
+        results = [{} for _ in rows]
+        for name, values in columns.items():
+            for result, value in zip(results, np.round(values, self.digits).tolist()):
+                # NaN is the only value not equal to itself
+                if value == value:
+                    result[name] = value
+        return results
+
+    def compute_columns(self, rows: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+        # metric name -> values per row, NaN where it couldn't be computed
+        values = self._inputs(rows)
+        metrics = {}
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for name, spec in self.formulas.items():
+                args = [values.get(i) for i in spec.inputs]
+                if any(a is None for a in args):
+                    continue
+                column = np.asarray(spec.fn(*args), dtype=np.float64)
+                column[~np.isfinite(column)] = np.nan
+                values[name] = metrics[name] = column
+        return metrics
+
+    def warnings(self, metrics: Dict[str, float]) -> List[str]:
+        # metrics outside their expected range, usually a sign of inconsistent input
+        found = []
+        for name, value in metrics.items():
+            spec = self.formulas.get(name)
+            if spec and spec.bounds and not spec.bounds[0] <= value <= spec.bounds[1]:
+                found.append(f"{name} is {value}, expected between {spec.bounds[0]} and {spec.bounds[1]} "
+                             f"({spec.description})")
+        return found
+
+    def describe(self, metrics: Dict[str, float]) -> str:
+        lines = [f"- {name}: {value} {self.formulas[name].unit} ({self.formulas[name].description})"
+                 for name, value in metrics.items()]
+        return "\n".join(lines)
+
+    def _inputs(self, rows: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+        # filled as lists, setting numpy elements one at a time is much slower
+        lists = {}
+        for i, row in enumerate(rows):
+            for key, value in row.items():
+                alias = INPUT_ALIASES.get(key)
+                if alias is None or isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name, scale = alias
+                if name not in lists:
+                    lists[name] = [math.nan] * len(rows)
+                lists[name][i] = value * scale
+        columns = {name: np.array(values, dtype=np.float64) for name, values in lists.items()}
+
+        for name, default in INPUT_DEFAULTS.items():
+            fallback = columns.get(default) if isinstance(default, str) else np.full(len(rows), default)
+            if fallback is None:
+                continue
+            if name in columns:
+                columns[name] = np.where(np.isnan(columns[name]), fallback, columns[name])
+            else:
+                columns[name] = fallback.copy()
+        return columns
@@ -0,0 +1,177 @@
+import contextvars
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Any, Callable, Iterable, Iterator, Tuple
+
+
+class PlanValidationError(ValueError):
+    pass
+
+
+class DynamicDag:
+    # dependency tracking for a plan that is still arriving. a step is ready once
+    # every step it depends on has finished, whether it succeeded or not
+    def __init__(self):
+        self.steps = []
+        self.dispatched = set()
+        self.finished = set()
+        self.ended = False
+
+    def add(self, step: Dict):
+        self.steps.append(step)
+
+    def finish(self, step_id):
+        self.finished.add(step_id)
+
+    def take_ready(self) -> List[Dict]:
+        ready = [step for step in self.steps
+                 if step.get("id") not in self.dispatched
+                 and all(d in self.finished for d in step.get("dependencies", []))]
+        self.dispatched.update(step.get("id") for step in ready)
+        return ready
+
+    def pending(self) -> List[Dict]:
+        return [step for step in self.steps if step.get("id") not in self.dispatched]
+
+    def force_next(self) -> Dict:
+        # the plan is complete but nothing can run: a cycle or an unknown
+        # dependency. release the earliest blocked step and carry on in plan order
+        step = self.pending()[0]
+        self.dispatched.add(step.get("id"))
+        return step
+
+
+class StepScheduler:
+    # runs plan steps as a DAG, independent steps go out concurrently
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max(1, max_workers)
+
+    def validate(self, steps: List[Dict]):
+        ids = [step.get("id") for step in steps]
+        if len(set(ids)) != len(ids):
+            raise PlanValidationError(f"Duplicate step ids in plan: {ids}")
+
+        known = set(ids)
+        for step in steps:
+            missing = [d for d in step.get("dependencies", []) if d not in known]
+            if missing:
+                raise PlanValidationError(
+                    f"Step {step.get('id')} depends on unknown steps: {missing}"
+                )
+
+    def build_levels(self, steps: List[Dict]) -> List[List[Dict]]:
+        self.validate(steps)
+
+        remaining = {step.get("id"): step for step in steps}
+        done = set()
+        levels = []
+
+        while remaining:
+            # a step is ready once everything it depends on is in an earlier level
+            ready = [step for step in remaining.values()
+                     if all(d in done for d in step.get("dependencies", []))]
+            if not ready:
+                raise PlanValidationError(
+                    f"Dependency cycle between steps: {sorted(remaining, key=str)}"
+                )
+            levels.append(ready)
+            for step in ready:
+                done.add(step.get("id"))
+                del remaining[step.get("id")]
+
+        return levels
+
+    def run(self, levels: List[List[Dict]], prepare: Callable[[Dict], Any],
+            execute: Callable[[Dict, Any], Any]) -> Iterator[Tuple[Dict, Any, Exception]]:
+        # yields (step, result, error) in completion order, one level at a time.
+        # prepare() runs on the caller's thread right before a step is submitted and
+        # results are consumed there too, so trace and memory updates stay serial.
+        # only execute() runs on the pool
+        if self.max_workers == 1:
+            for level in levels:
+                for step in level:
+                    yield self._call(step, prepare(step), execute)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for level in levels:
+                futures = [self._submit(pool, step, prepare(step), execute)
+                           for step in level]
+                for future in as_completed(futures):
+                    yield future.result()
+
+    def run_dynamic(self, source: Iterable[Dict], prepare: Callable[[Dict], Any],
+                    execute: Callable[[Dict, Any], Any],
+                    on_step: Callable[[Dict], None] = None,
+                    on_end: Callable[[], None] = None,
+                    on_stall: Callable[[List[Dict]], None] = None) -> Iterator[Tuple[Dict, Any, Exception]]:
+        # like run(), but steps come from source while it is still producing them
+        # (a plan being streamed) and each one goes out as soon as its dependencies
+        # are done. source is drained on a background thread; on_step, on_end,
+        # on_stall and prepare all run on the caller's thread
+        events = queue.Queue()
+
+        def produce():
+            try:
+                for step in source:
+                    events.put(("step", step))
+                events.put(("end", None))
+            except BaseException as e:
+                events.put(("error", e))
+
+        threading.Thread(target=contextvars.copy_context().run, args=(produce,), daemon=True).start()
+
+        dag = DynamicDag()
+        running = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            def submit(step):
+                nonlocal running
+                future = self._submit(pool, step, prepare(step), execute)
+                # the future itself is queued so anything that escaped _call is
+                # re-raised here rather than lost in the callback
+                future.add_done_callback(lambda f: events.put(("done", f)))
+                running += 1
+
+            while True:
+                if dag.ended and running == 0:
+                    stalled = dag.pending()
+                    if not stalled:
+                        return
+                    if on_stall:
+                        on_stall(stalled)
+                    submit(dag.force_next())
+                    continue
+
+                kind, value = events.get()
+                if kind == "step":
+                    if on_step:
+                        on_step(value)
+                    dag.add(value)
+                elif kind == "end":
+                    dag.ended = True
+                    if on_end:
+                        on_end()
+                elif kind == "error":
+                    raise value
+                else:
+                    running -= 1
+                    outcome = value.result()
+                    dag.finish(outcome[0].get("id"))
+                    yield outcome
+
+                for step in dag.take_ready():
+                    submit(step)
+
+    def _submit(self, pool: ThreadPoolExecutor, step: Dict, payload: Any,
+                execute: Callable[[Dict, Any], Any]):
+        # pool threads don't inherit the caller's context variables (the task's
+        # latency budget), so each step runs in its own copy of them
+        return pool.submit(contextvars.copy_context().run, self._call, step, payload, execute)
+
+    def _call(self, step: Dict, payload: Any,
+              execute: Callable[[Dict, Any], Any]) -> Tuple[Dict, Any, Exception]:
+        try:
+            return step, execute(step, payload), None
+        except Exception as e:
+            return step, None, e
@@ -0,0 +1,343 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, Callable, Optional
+
+from agent.records import TraceEntry, dumps
+
+
+# job states, the last three are final
+QUEUED, RUNNING, COMPLETED, PARTIAL, FAILED = "queued", "running", "completed", "partial", "failed"
+_FINAL = {COMPLETED, PARTIAL, FAILED}
+
+
+class Job:
+    # one submitted task. events are kept so a client that connects late still
+    # gets the whole progress stream from the start
+    def __init__(self, task: str, context: Dict):
+        self.id = uuid.uuid4().hex
+        self.task = task
+        self.context = context
+        self.status = QUEUED
+        self.created_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.worker = None
+        self.session_id = None
+        self.summary = None
+        self.error = None
+
+        self.events = []
+        self._changed = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.status in _FINAL
+
+    def publish(self, kind: str, data: Dict):
+        with self._changed:
+            self.events.append((kind, data))
+            self._changed.notify_all()
+
+    def on_trace(self, entry: TraceEntry):
+        self.publish("trace", entry.to_dict())
+
+    def wait_events(self, cursor: int, timeout: float):
+        # events after cursor, waiting up to timeout for the first one
+        with self._changed:
+            if cursor >= len(self.events) and not self.done:
+                self._changed.wait(timeout)
+            return self.events[cursor:]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "task": self.task,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "worker": self.worker,
+            "session_id": self.session_id,
+            "result": self.summary,
+            "error": self.error
+        }
+
+
+class _ThreadStdout:
+    # agents print as they go, from their worker and step threads. sys.stdout is
+    # shared by every thread, so only the main thread still writes to the terminal
+    def __init__(self, stream, log):
+        self.stream = stream
+        self.log = log
+
+    def _target(self):
+        return self.stream if threading.current_thread() is threading.main_thread() else self.log
+
+    def write(self, text: str) -> int:
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class JobServer:
+    # a local HTTP front end for the agent. tasks are queued and run by a fixed pool
+    # of worker threads, each with its own StatefulAgent on a storage shard under
+    # server_dir (like BatchRunner's). when queue_size jobs are already waiting,
+    # new ones get 429 so callers back off instead of piling up work.
+    #   POST /jobs             {"task": "...", "context": {...}} -> 202 {"id": ...}
+    #   GET  /jobs/<id>        status, and the task summary once finished
+    #   GET  /jobs/<id>/events server-sent events: every trace entry, then the result
+    #   GET  /jobs, /health
+    def __init__(self, workers: int = 2, queue_size: int = 16, server_dir: str = "server_runs",
+                 agent_kwargs: Dict = None, provider_factory: Callable = None,
+                 keep_jobs: int = 1000, keepalive: float = 15.0):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.server_dir = server_dir
+        self.agent_kwargs = agent_kwargs or {}
+        # called once per worker, agents don't share a provider
+        self.provider_factory = provider_factory
+        # finished jobs kept for GET, oldest dropped first
+        self.keep_jobs = keep_jobs
+        self.keepalive = keepalive
+
+        self.jobs = OrderedDict()
+        self.stats = {"accepted": 0, "rejected": 0, "completed": 0, "partial": 0, "failed": 0}
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._threads = []
+        self._log = None
+        self._server = None
+        self._stopping = False
+        self._startup_errors = []
+
+    def start(self, port: int = 8080, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        os.makedirs(self.server_dir, exist_ok=True)
+        self._log = open(os.path.join(self.server_dir, "agent.log"), 'a', encoding='utf-8', buffering=1)
+        if isinstance(sys.stdout, _ThreadStdout):
+            sys.stdout.log = self._log
+        else:
+            sys.stdout = _ThreadStdout(sys.stdout, self._log)
+
+        ready = []
+        for worker in range(self.workers):
+            started = threading.Event()
+            thread = threading.Thread(target=self._work, args=(worker, started), daemon=True,
+                                      name=f"agent-worker-{worker}")
+            thread.start()
+            self._threads.append(thread)
+            ready.append(started)
+        for started in ready:
+            started.wait()
+        if self._startup_errors:
+            # e.g. no API key, better to fail now than accept jobs nobody runs
+            self.stop()
+            raise self._startup_errors[0]
+
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def stop(self, wait: bool = True):
+        # queued jobs are still run, new ones are turned away with 503
+        self._stopping = True
+        for thread in self._threads:
+            if thread.is_alive():
+                self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if isinstance(sys.stdout, _ThreadStdout) and wait:
+            sys.stdout = sys.stdout.stream
+            self._log.close()
+
+    def submit(self, task: str, context: Dict = None) -> Optional[Job]:
+        # None when the queue is full
+        job = Job(task, context or {})
+        with self._lock:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                self.stats["rejected"] += 1
+                return None
+            self.jobs[job.id] = job
+            self.stats["accepted"] += 1
+            self._prune()
+        return job
+
+    def get_job(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def health(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"status": "stopping" if self._stopping else "ok", "workers": self.workers,
+                    "busy": self._busy, "queued": self._queue.qsize(),
+                    "queue_size": self.queue_size, **self.stats}
+
+    def _work(self, worker: int, started: threading.Event):
+        from agent.orchestrator import StatefulAgent
+
+        shard_dir = os.path.join(self.server_dir, f"worker_{worker:02d}")
+        os.makedirs(shard_dir, exist_ok=True)
+        try:
+            agent = StatefulAgent(provider=self.provider_factory() if self.provider_factory else None,
+                                  storage_dir=os.path.join(shard_dir, "storage"),
+                                  output_dir=os.path.join(shard_dir, "outputs"),
+                                  **self.agent_kwargs)
+        except Exception as e:
+            self._startup_errors.append(e)
+            return
+        finally:
+            started.set()
+
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            with self._lock:
+                self._busy += 1
+            try:
+                self._run_job(agent, worker, job)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+
+    def _run_job(self, agent, worker: int, job: Job):
+        job.worker = worker
+        job.session_id = agent.session_id
+        job.started_at = datetime.now().isoformat()
+        job.status = RUNNING
+        job.publish("status", {"status": RUNNING, "worker": worker})
+
+        start = time.perf_counter()
+        agent.tracer.add_listener(job.on_trace)
+        try:
+            summary = agent.run_task(job.task, job.context)
+        except Exception as e:
+            job.error = str(e)
+            status = FAILED
+        else:
+            # the decision trace is streamed as events and stays in the worker's storage
+            job.summary = {k: v for k, v in summary.items() if k != "decision_trace"}
+            job.summary["seconds"] = time.perf_counter() - start
+            status = COMPLETED if summary["failed_steps"] == 0 else PARTIAL
+        finally:
+            agent.tracer.remove_listener(job.on_trace)
+
+        job.finished_at = datetime.now().isoformat()
+        with self._lock:
+            self.stats[status] += 1
+        job.publish("result", {"status": status, "result": job.summary, "error": job.error})
+        # set last, so a stream that sees a final status has every event
+        with job._changed:
+            job.status = status
+            job._changed.notify_all()
+
+    def _prune(self):
+        # caller holds the lock
+        excess = len(self.jobs) - self.keep_jobs
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.done][:max(excess, 0)]:
+            del self.jobs[job_id]
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.rstrip("/") != "/jobs":
+                    return self._send(404, {"error": "not found"})
+                if server._stopping:
+                    return self._send(503, {"error": "server is shutting down"})
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                    spec = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    return self._send(400, {"error": "body must be JSON"})
+                if not isinstance(spec, dict):
+                    spec = {}
+                task = spec.get("task") or spec.get("task_description")
+                context = spec.get("context") or {}
+                if not isinstance(task, str) or not isinstance(context, dict):
+                    return self._send(400, {"error": "expected {\"task\": str, \"context\": object}"})
+
+                job = server.submit(task, context)
+                if job is None:
+                    return self._send(429, {"error": "job queue is full"}, {"Retry-After": "1"})
+                self._send(202, {"id": job.id, "status": job.status,
+                                 "url": f"/jobs/{job.id}", "events": f"/jobs/{job.id}/events"},
+                           {"Location": f"/jobs/{job.id}"})
+
+            def do_GET(self):
+                parts = [p for p in self.path.split("?")[0].split("/") if p]
+                if parts == ["health"]:
+                    return self._send(200, server.health())
+                if parts == ["jobs"]:
+                    with server._lock:
+                        jobs = [{"id": j.id, "status": j.status, "task": j.task}
+                                for j in server.jobs.values()]
+                    return self._send(200, {"jobs": jobs})
+                if len(parts) in (2, 3) and parts[0] == "jobs":
+                    job = server.get_job(parts[1])
+                    if job is None:
+                        return self._send(404, {"error": "unknown job"})
+                    if len(parts) == 2:
+                        return self._send(200, job.to_dict())
+                    if parts[2] == "events":
+                        return self._stream(job)
+                self._send(404, {"error": "not found"})
+
+            def _stream(self, job: Job):
+                # no Content-Length: the body ends when the connection closes
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                cursor = 0
+                try:
+                    while True:
+                        events = job.wait_events(cursor, server.keepalive)
+                        if events:
+                            for kind, data in events:
+                                self.wfile.write(f"event: {kind}\ndata: {dumps(data)}\n\n".encode("utf-8"))
+                            cursor += len(events)
+                        elif job.done:
+                            break
+                        else:
+                            self.wfile.write(b": keepalive\n\n")
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def _send(self, code: int, body: Dict, headers: Dict = None):
+                data = dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
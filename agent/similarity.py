@@ -0,0 +1,178 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections.abc import Mapping
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from agent.metrics import MetricsRegistry
+
+
+_WORD = re.compile(r"[a-z0-9]+")
+_STOPWORDS = {"a", "an", "the", "and", "or", "for", "of", "to", "in", "on", "with", "our",
+              "this", "that", "is", "are", "be", "by", "as", "it", "we", "from", "into"}
+
+
+def task_text(record: Dict) -> str:
+    # what a past task is matched on: its description, goal and step actions
+    plan = record.get("plan") or {}
+    actions = [step.get("action", "") for step in plan.get("steps", []) if isinstance(step, Mapping)]
+    return "\n".join([record.get("task", ""), plan.get("goal") or ""] + actions)
+
+
+class SimilarityIndex:
+    # hashed word unigram + bigram vectors, L2 normalized, searched by cosine.
+    # everything is local: rows are appended to vectors.f32 and rows.jsonl under
+    # storage/similarity/ and the whole matrix is loaded on start. at dim=256 a
+    # 100k task index is 100 MB and a search is one matrix-vector product
+    def __init__(self, storage_dir: str = "storage", dim: int = 256, metrics: MetricsRegistry = None):
+        self.dim = dim
+        self.metrics = metrics
+        self.index_dir = os.path.join(storage_dir, "similarity")
+        self.vectors_path = os.path.join(self.index_dir, "vectors.f32")
+        self.rows_path = os.path.join(self.index_dir, "rows.jsonl")
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        self.ids = []
+        self.type_codes = {}
+        self._types = np.zeros(0, dtype=np.int32)
+        self._matrix = np.zeros((0, dim), dtype=np.float32)
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def vectorize(self, text: str) -> np.ndarray:
+        words = [w for w in _WORD.findall(text.lower()) if w not in _STOPWORDS]
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if not features:
+            return vector
+        # not crc32: it's linear, so "x" and "w x" land in related buckets
+        hashes = np.array([int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+                           for f in features], dtype=np.uint64)
+        # the top bit picks the sign, so colliding features tend to cancel out
+        signs = np.where(hashes >> np.uint64(63), -1.0, 1.0).astype(np.float32)
+        np.add.at(vector, (hashes % self.dim).astype(np.int64), signs)
+        # sublinear term frequency
+        vector = np.sign(vector) * np.log1p(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def add(self, task_id: int, text: str, task_type: str = None):
+        vector = self.vectorize(text)
+        with self._lock:
+            code = self._type_code(task_type)
+            self._append_rows(vector[None, :], np.array([code], dtype=np.int32))
+            self.ids.append(task_id)
+            row = json.dumps({"id": task_id, "type": task_type}) + "\n"
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vector.tobytes())
+            with open(self.rows_path, 'a', encoding='utf-8') as f:
+                f.write(row)
+        self._count_bytes(vector.nbytes + len(row))
+
+    def add_many(self, items: List[Tuple[int, str, str]]):
+        # (task_id, text, task_type), written in one go for backfills
+        if not items:
+            return
+        vectors = np.stack([self.vectorize(text) for _, text, _ in items])
+        with self._lock:
+            codes = np.array([self._type_code(t) for _, _, t in items], dtype=np.int32)
+            self._append_rows(vectors, codes)
+            self.ids.extend(task_id for task_id, _, _ in items)
+            data = vectors.astype(np.float32).tobytes()
+            rows = "".join(json.dumps({"id": task_id, "type": task_type}) + "\n"
+                           for task_id, _, task_type in items)
+            with open(self.vectors_path, 'ab') as f:
+                f.write(data)
+            with open(self.rows_path, 'a', encoding='utf-8') as f:
+                f.write(rows)
+        self._count_bytes(len(data) + len(rows))
+
+    def search(self, text: str, k: int = 5, task_type: str = None,
+               min_score: float = 0.0) -> List[Tuple[int, float]]:
+        # [(task_id, cosine)] best first
+        query = self.vectorize(text)
+        with self._lock:
+            n = self._size
+            if n == 0 or not query.any():
+                return []
+            scores = self._matrix[:n] @ query
+            if task_type is not None:
+                code = self.type_codes.get(task_type)
+                if code is None:
+                    return []
+                scores = np.where(self._types[:n] == code, scores, -np.inf)
+            ids = self.ids
+
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(ids[i], float(scores[i])) for i in top
+                if np.isfinite(scores[i]) and scores[i] >= min_score]
+
+    def count(self, task_type: str = None) -> int:
+        with self._lock:
+            if task_type is None:
+                return self._size
+            code = self.type_codes.get(task_type)
+            if code is None:
+                return 0
+            return int(np.count_nonzero(self._types[:self._size] == code))
+
+    def _count_bytes(self, size: int):
+        if self.metrics:
+            self.metrics.inc("agent_storage_bytes_written", size, store="similarity")
+
+    def _type_code(self, task_type: str) -> int:
+        # caller holds the lock
+        return self.type_codes.setdefault(task_type, len(self.type_codes))
+
+    def _append_rows(self, vectors: np.ndarray, codes: np.ndarray):
+        # caller holds the lock. capacity doubles so inserts stay amortized O(1)
+        needed = self._size + len(vectors)
+        if needed > len(self._matrix):
+            capacity = max(needed, 2 * len(self._matrix), 1024)
+            matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+            matrix[:self._size] = self._matrix[:self._size]
+            types = np.zeros(capacity, dtype=np.int32)
+            types[:self._size] = self._types[:self._size]
+            self._matrix, self._types = matrix, types
+        self._matrix[self._size:needed] = vectors
+        self._types[self._size:needed] = codes
+        self._size = needed
+
+    def _load(self):
+        if not (os.path.exists(self.vectors_path) and os.path.exists(self.rows_path)):
+            return
+        rows = []
+        torn = False
+        with open(self.rows_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # a torn last line from a crash is dropped along with its vector
+                if not line.endswith("\n"):
+                    torn = True
+                    break
+                rows.append(json.loads(line))
+        # whole vectors only, a partly written last one is dropped too
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self.vectors_path)
+        vectors = np.fromfile(self.vectors_path, dtype=np.float32, count=size // row_bytes * self.dim)
+        n = min(len(rows), len(vectors) // self.dim)
+        if torn or n < len(rows) or size != n * row_bytes:
+            # cut both files back to the rows they agree on so appends line up again
+            with open(self.rows_path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(r) + "\n" for r in rows[:n])
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(n * row_bytes)
+        if n == 0:
+            return
+        codes = np.array([self._type_code(r["type"]) for r in rows[:n]], dtype=np.int32)
+        self._append_rows(vectors[:n * self.dim].reshape(n, self.dim), codes)
+        self.ids = [r["id"] for r in rows[:n]]
@@ -0,0 +1,375 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Any, Optional
+
+from agent.journal import Journal
+from agent.metrics import MetricsRegistry
+from agent.records import TaskRecord, StepResult, to_json
+
+
+def _default_memory() -> Dict:
+    return {
+        "past_tasks": [],
+        "learned_patterns": {},
+        "user_preferences": {},
+        "decisions": []
+    }
+
+
+def _task_record(data: Dict) -> TaskRecord:
+    task = TaskRecord.from_dict(data)
+    if task.get("results"):
+        task["results"] = [StepResult.from_dict(r) for r in task["results"]]
+    return task
+
+
+def _summary(task: TaskRecord) -> TaskRecord:
+    # a task without its step results, what task queries return
+    return TaskRecord({k: v for k, v in task.items() if k != "results"})
+
+
+class MemoryBackend:
+    # long term memory storage behind StateManager. times are ISO strings
+    def add_task(self, record: Dict) -> int:
+        raise NotImplementedError
+
+    def query_tasks(self, task_type: str = None, session_id: str = None,
+                    since: str = None, until: str = None, limit: int = None,
+                    include_results: bool = False) -> List[Dict]:
+        raise NotImplementedError
+
+    def load_task_results(self, task_id: int) -> List[Dict]:
+        raise NotImplementedError
+
+    def get_tasks(self, task_ids: List[int]) -> List[Dict]:
+        # summaries (no step results) in the order asked for, unknown ids skipped
+        raise NotImplementedError
+
+    def add_decision(self, record: Dict):
+        raise NotImplementedError
+
+    def query_decisions(self, since: str = None, until: str = None,
+                        limit: int = None) -> List[Dict]:
+        raise NotImplementedError
+
+    def set_preference(self, key: str, value: Any):
+        raise NotImplementedError
+
+    def get_preference(self, key: str) -> Optional[Any]:
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+
+class JsonMemoryBackend(MemoryBackend):
+    # the original long_term_memory.json layout, held in memory and journaled
+    def __init__(self, storage_dir: str = "storage", fsync: str = "interval",
+                 compact_every: int = 200, metrics: MetricsRegistry = None):
+        self.memory_file = os.path.join(storage_dir, "long_term_memory.json")
+        self.journal = Journal(self.memory_file, _default_memory, fsync=fsync,
+                               compact_every=compact_every, metrics=metrics, store="memory")
+        self.long_term = self.journal.load()
+        self.long_term["past_tasks"] = [_task_record(t) for t in self.long_term["past_tasks"]]
+
+    def add_task(self, record: Dict) -> int:
+        record = TaskRecord(record, task_id=len(self.long_term["past_tasks"]) + 1)
+        self.long_term["past_tasks"].append(record)
+        self.journal.append({"op": "append", "key": "past_tasks", "value": record}, self.long_term)
+        return record["task_id"]
+
+    def query_tasks(self, task_type: str = None, session_id: str = None,
+                    since: str = None, until: str = None, limit: int = None,
+                    include_results: bool = False) -> List[Dict]:
+        matches = []
+        # newest first, same as the sqlite backend
+        for task in reversed(self.long_term["past_tasks"]):
+            if task_type is not None and task.get("type") != task_type:
+                continue
+            if session_id is not None and task.get("session_id") != session_id:
+                continue
+            completed_at = task.get("completed_at", "")
+            if since is not None and completed_at < since:
+                continue
+            if until is not None and completed_at > until:
+                continue
+            matches.append(task if include_results else _summary(task))
+            if limit is not None and len(matches) >= limit:
+                break
+        return matches
+
+    def load_task_results(self, task_id: int) -> List[Dict]:
+        for task in self.long_term["past_tasks"]:
+            if task.get("task_id") == task_id:
+                return task.get("results", [])
+        return []
+
+    def get_tasks(self, task_ids: List[int]) -> List[Dict]:
+        past = self.long_term["past_tasks"]
+        tasks = []
+        for task_id in task_ids:
+            # task_id is position + 1, older records without one are found by scanning
+            task = past[task_id - 1] if 0 < task_id <= len(past) else None
+            if task is None or task.get("task_id", task_id) != task_id:
+                task = next((t for t in past if t.get("task_id") == task_id), None)
+            if task is not None:
+                tasks.append(_summary(task))
+        return tasks
+
+    def add_decision(self, record: Dict):
+        self.long_term["decisions"].append(record)
+        self.journal.append({"op": "append", "key": "decisions", "value": record}, self.long_term)
+
+    def query_decisions(self, since: str = None, until: str = None,
+                        limit: int = None) -> List[Dict]:
+        matches = [d for d in reversed(self.long_term["decisions"])
+                   if (since is None or d.get("timestamp", "") >= since)
+                   and (until is None or d.get("timestamp", "") <= until)]
+        return matches[:limit] if limit is not None else matches
+
+    def set_preference(self, key: str, value: Any):
+        self.long_term["user_preferences"][key] = value
+        self.journal.append({"op": "set_item", "key": "user_preferences",
+                             "field": key, "value": value}, self.long_term)
+
+    def get_preference(self, key: str) -> Optional[Any]:
+        return self.long_term["user_preferences"].get(key)
+
+    def save(self):
+        self.journal.snapshot(self.long_term)
+
+    def flush(self):
+        self.journal.close()
+
+
+_TASK_COLUMNS = ("task", "type", "plan", "success_rate", "session_id", "completed_at")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task TEXT,
+    type TEXT,
+    plan TEXT,
+    success_rate REAL,
+    session_id TEXT,
+    completed_at TEXT,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_tasks_type_time ON tasks (type, completed_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_session ON tasks (session_id, completed_at);
+CREATE INDEX IF NOT EXISTS idx_tasks_time ON tasks (completed_at);
+
+CREATE TABLE IF NOT EXISTS step_results (
+    task_id INTEGER NOT NULL REFERENCES tasks (id),
+    position INTEGER NOT NULL,
+    step_id TEXT,
+    status TEXT,
+    body TEXT,
+    PRIMARY KEY (task_id, position)
+);
+
+CREATE TABLE IF NOT EXISTS decisions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT,
+    decision TEXT,
+    reasoning TEXT,
+    context TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_decisions_time ON decisions (timestamp);
+
+CREATE TABLE IF NOT EXISTS preferences (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class SQLiteMemoryBackend(MemoryBackend):
+    # tasks, step results, decisions and preferences in indexed tables. task queries
+    # only read the summary columns, step result bodies load on request
+    def __init__(self, storage_dir: str = "storage", db_name: str = "long_term_memory.db",
+                 metrics: MetricsRegistry = None):
+        self.db_path = os.path.join(storage_dir, db_name)
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+
+        legacy = Journal(os.path.join(storage_dir, "long_term_memory.json"), _default_memory)
+        has_legacy = os.path.exists(legacy.snapshot_path) or os.path.exists(legacy.journal_path)
+        if has_legacy and self._is_empty():
+            self._import_legacy(legacy)
+
+    def add_task(self, record: Dict) -> int:
+        start = time.perf_counter()
+        with self._lock, self.conn:
+            task_id = self._insert_task(record)
+        self._record_write(start, record)
+        return task_id
+
+    def query_tasks(self, task_type: str = None, session_id: str = None,
+                    since: str = None, until: str = None, limit: int = None,
+                    include_results: bool = False) -> List[Dict]:
+        clauses, params = [], []
+        if task_type is not None:
+            clauses.append("type = ?")
+            params.append(task_type)
+        if session_id is not None:
+            clauses.append("session_id = ?")
+            params.append(session_id)
+        if since is not None:
+            clauses.append("completed_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("completed_at <= ?")
+            params.append(until)
+
+        sql = "SELECT * FROM tasks"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY completed_at DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+
+        tasks = [self._task_from_row(row) for row in rows]
+        if include_results:
+            for task in tasks:
+                task["results"] = self.load_task_results(task["task_id"])
+        return tasks
+
+    def get_tasks(self, task_ids: List[int]) -> List[Dict]:
+        if not task_ids:
+            return []
+        placeholders = ",".join("?" * len(task_ids))
+        with self._lock:
+            rows = self.conn.execute(f"SELECT * FROM tasks WHERE id IN ({placeholders})",
+                                     list(task_ids)).fetchall()
+        by_id = {row["id"]: self._task_from_row(row) for row in rows}
+        return [by_id[task_id] for task_id in task_ids if task_id in by_id]
+
+    def load_task_results(self, task_id: int) -> List[Dict]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT body FROM step_results WHERE task_id = ? ORDER BY position",
+                (task_id,)
+            ).fetchall()
+        return [StepResult.from_json(row["body"]) for row in rows]
+
+    def add_decision(self, record: Dict):
+        start = time.perf_counter()
+        with self._lock, self.conn:
+            self._insert_decision(record)
+        self._record_write(start, record)
+
+    def query_decisions(self, since: str = None, until: str = None,
+                        limit: int = None) -> List[Dict]:
+        clauses, params = [], []
+        if since is not None:
+            clauses.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("timestamp <= ?")
+            params.append(until)
+
+        sql = "SELECT * FROM decisions"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY timestamp DESC, id DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [{
+            "timestamp": row["timestamp"],
+            "decision": row["decision"],
+            "reasoning": row["reasoning"],
+            "context": json.loads(row["context"])
+        } for row in rows]
+
+    def set_preference(self, key: str, value: Any):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO preferences (key, value) VALUES (?, ?)",
+                              (key, json.dumps(value)))
+
+    def get_preference(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM preferences WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["value"]) if row else None
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _record_write(self, start: float, record: Dict):
+        if not self.metrics:
+            return
+        self.metrics.observe("agent_storage_save_seconds", time.perf_counter() - start, store="memory")
+        # payload size, the page-level bytes sqlite writes aren't visible from here
+        self.metrics.inc("agent_storage_bytes_written", len(json.dumps(record, default=to_json)), store="memory")
+
+    def _insert_task(self, record: Dict) -> int:
+        extra = {k: v for k, v in record.items()
+                 if k not in _TASK_COLUMNS and k not in ("results", "task_id")}
+        cursor = self.conn.execute(
+            "INSERT INTO tasks (task, type, plan, success_rate, session_id, completed_at, extra) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (record.get("task"), record.get("type"), json.dumps(record.get("plan"), default=to_json),
+             record.get("success_rate"), record.get("session_id"), record.get("completed_at"),
+             json.dumps(extra, default=to_json))
+        )
+        task_id = cursor.lastrowid
+        self.conn.executemany(
+            "INSERT INTO step_results (task_id, position, step_id, status, body) VALUES (?, ?, ?, ?, ?)",
+            [(task_id, i, str(r.get("step_id")), r.get("status"), json.dumps(r, default=to_json))
+             for i, r in enumerate(record.get("results", []))]
+        )
+        return task_id
+
+    def _insert_decision(self, record: Dict):
+        self.conn.execute(
+            "INSERT INTO decisions (timestamp, decision, reasoning, context) VALUES (?, ?, ?, ?)",
+            (record.get("timestamp"), record.get("decision"), record.get("reasoning"),
+             json.dumps(record.get("context"), default=to_json))
+        )
+
+    def _task_from_row(self, row: sqlite3.Row) -> TaskRecord:
+        return TaskRecord(
+            json.loads(row["extra"] or "{}"),
+            task_id=row["id"],
+            task=row["task"],
+            type=row["type"],
+            plan=json.loads(row["plan"]) if row["plan"] else None,
+            success_rate=row["success_rate"],
+            session_id=row["session_id"],
+            completed_at=row["completed_at"]
+        )
+
+    def _is_empty(self) -> bool:
+        with self._lock:
+            tasks = self.conn.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+            decisions = self.conn.execute("SELECT COUNT(*) FROM decisions").fetchone()[0]
+        return tasks == 0 and decisions == 0
+
+    def _import_legacy(self, journal: Journal):
+        # one-off copy of an existing JSON memory (plus its journal) into the database
+        legacy = journal.load()
+        with self._lock, self.conn:
+            for record in legacy.get("past_tasks", []):
+                self._insert_task(record)
+            for record in legacy.get("decisions", []):
+                self._insert_decision(record)
+            for key, value in legacy.get("user_preferences", {}).items():
+                self.conn.execute("INSERT OR REPLACE INTO preferences (key, value) VALUES (?, ?)",
+                                  (key, json.dumps(value)))
@@ -1,72 +1,208 @@
+import contextvars
 import json
 import os
+import threading
+import time
+from collections import deque
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Iterator, Callable
+
+from agent.metrics import MetricsRegistry
+from agent.records import TraceEntry
+from agent.blobs import BlobStore, BLOB_KEY
+
+# entries logged since the current task started, for its summary. a context
+# variable, so concurrent tasks on one tracer each collect only their own
+_task_entries = contextvars.ContextVar("task_trace_entries", default=None)
 
 
 class DecisionTracer:
-    def __init__(self, storage_dir="storage"):
+    # decisions are appended to decision_trace.jsonl through a small buffer that is
+    # flushed by entry count, byte size or age, and at the end of every task.
+    # when the file grows past max_file_bytes it is rotated to decision_trace.<n>.jsonl.
+    # with a blob store, large inputs and outputs are written there once and the
+    # trace keeps references, loaded again when the trace is read
+    def __init__(self, storage_dir="storage", flush_entries: int = 50,
+                 flush_bytes: int = 256 * 1024, flush_interval: float = 2.0,
+                 max_file_bytes: int = 50 * 1024 * 1024, metrics: MetricsRegistry = None,
+                 blobs: BlobStore = None):
         self.storage_dir = storage_dir
-        self.trace_file = os.path.join(storage_dir, "decision_trace.json")
-        self.current_trace = []
-        self.load_trace()
+        self.trace_file = os.path.join(storage_dir, "decision_trace.jsonl")
+        self.flush_entries = flush_entries
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_file_bytes = max_file_bytes
+        self.metrics = metrics
+        self.blobs = blobs
 
-    def load_trace(self):
-        if os.path.exists(self.trace_file):
-            with open(self.trace_file, 'r') as f:
-                data = json.load(f)
-                self.current_trace = data.get("trace", [])
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._last_flush = time.time()
+        self._lock = threading.Lock()
+        # called with every entry as it is logged, e.g. to stream progress to a client
+        self._listeners = []
 
-    def save_trace(self):
-        with open(self.trace_file, 'w') as f:
-            json.dump({"trace": self.current_trace}, f, indent=2)
+        os.makedirs(storage_dir, exist_ok=True)
+        self._migrate_legacy_trace()
 
     def log_decision(self, step: str, action: str, reasoning: str,
-                     inputs: Optional[Dict] = None, outputs: Optional[Dict] = None):
-        entry = {
-            "timestamp": datetime.now().isoformat(),
-            "step": step,
-            "action": action,
-            "reasoning": reasoning,
-            "inputs": inputs or {},
-            "outputs": outputs or {}
-        }
-        self.current_trace.append(entry)
-        self.save_trace()
+                     inputs: Optional[Dict] = None, outputs: Optional[Dict] = None) -> TraceEntry:
+        inputs, outputs = inputs or {}, outputs or {}
+        task_entries = _task_entries.get()
+        if self.blobs:
+            stored_inputs, stored_outputs = self.blobs.externalize(inputs), self.blobs.externalize(outputs)
+        else:
+            stored_inputs, stored_outputs = inputs, outputs
+        entry = TraceEntry(
+            timestamp=datetime.now().isoformat(),
+            step=step,
+            action=action,
+            reasoning=reasoning,
+            inputs=stored_inputs,
+            outputs=stored_outputs
+        )
+        line = entry.to_json() + "\n"
+        if task_entries is not None:
+            # the task's own copy keeps the full values, nothing to resolve later
+            task_entries.append(entry if stored_inputs is inputs and stored_outputs is outputs
+                                else TraceEntry(entry, inputs=inputs, outputs=outputs))
+
+        with self._lock:
+            self._buffer.append(line)
+            self._buffer_bytes += len(line)
+            if (len(self._buffer) >= self.flush_entries
+                    or self._buffer_bytes >= self.flush_bytes
+                    or time.time() - self._last_flush >= self.flush_interval):
+                self._flush()
+        for listener in self._listeners:
+            listener(entry)
         return entry
 
-    def get_trace(self) -> List[Dict]:
-        return self.current_trace
+    def add_listener(self, listener: Callable[[TraceEntry], None]):
+        # listeners run on the logging thread and must not block. large inputs and
+        # outputs reach them as blob references
+        with self._lock:
+            self._listeners = self._listeners + [listener]
 
-    def get_recent_decisions(self, n: int = 5) -> List[Dict]:
-        return self.current_trace[-n:] if len(self.current_trace) >= n else self.current_trace
+    def remove_listener(self, listener: Callable[[TraceEntry], None]):
+        with self._lock:
+            self._listeners = [l for l in self._listeners if l != listener]
 
-    def explain_decision_path(self) -> str:
-        if not self.current_trace:
-            return "No decisions recorded yet."
+    def start_task(self):
+        # entries logged from here on, in this context and the step threads it
+        # starts, are collected for task_entries
+        _task_entries.set([])
+
+    def task_entries(self) -> List[TraceEntry]:
+        return list(_task_entries.get() or [])
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def save_trace(self):
+        self.flush()
+
+    def iter_trace(self, resolve: bool = True) -> Iterator[TraceEntry]:
+        # oldest first: rotated files, the live file, then whatever is still buffered.
+        # resolve=False leaves blob references in place
+        with self._lock:
+            pending = list(self._buffer)
+        for path in self._rotated_files() + [self.trace_file]:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        yield self._decode(line, resolve)
+        for line in pending:
+            yield self._decode(line, resolve)
 
-        explanation = "Decision Path:\n"
-        explanation += "=" * 50 + "\n\n"
+    def get_trace(self) -> List[TraceEntry]:
+        return list(self.iter_trace())
 
-        for i, entry in enumerate(self.current_trace, 1):
-            explanation += f"Step {i}: {entry['step']}\n"
-            explanation += f"  Action: {entry['action']}\n"
-            explanation += f"  Reasoning: {entry['reasoning']}\n"
+    def get_recent_decisions(self, n: int = 5) -> List[TraceEntry]:
+        return list(deque(self.iter_trace(), maxlen=n))
+
+    def explain_decision_path(self) -> str:
+        parts = []
+
+        for i, entry in enumerate(self.iter_trace(), 1):
+            parts.append(f"Step {i}: {entry['step']}\n")
+            parts.append(f"  Action: {entry['action']}\n")
+            parts.append(f"  Reasoning: {entry['reasoning']}\n")
             if entry.get('inputs'):
-                explanation += f"  Inputs: {json.dumps(entry['inputs'], indent=4)}\n"
+                parts.append(f"  Inputs: {json.dumps(entry['inputs'], indent=4)}\n")
             if entry.get('outputs'):
-                explanation += f"  Outputs: {json.dumps(entry['outputs'], indent=4)}\n"
-            explanation += "\n"
+                parts.append(f"  Outputs: {json.dumps(entry['outputs'], indent=4)}\n")
+            parts.append("\n")
 
-        return explanation
+        if not parts:
+            return "No decisions recorded yet."
+
+        return "Decision Path:\n" + "=" * 50 + "\n\n" + "".join(parts)
 
     def clear_trace(self):
-        self.current_trace = []
-        self.save_trace()
+        with self._lock:
+            self._buffer = []
+            self._buffer_bytes = 0
+            for path in self._rotated_files() + [self.trace_file]:
+                if os.path.exists(path):
+                    os.remove(path)
 
     def export_trace(self, filepath: str):
-        with open(filepath, 'w') as f:
-            json.dump({
-                "exported_at": datetime.now().isoformat(),
-                "trace": self.current_trace
-            }, f, indent=2)
+        # written entry by entry so the export never holds the whole trace in memory
+        self.flush()
+        with open(filepath, 'w', encoding='utf-8') as f:
+            f.write('{\n  "exported_at": %s,\n  "trace": [' % json.dumps(datetime.now().isoformat()))
+            for i, entry in enumerate(self.iter_trace()):
+                f.write(",\n    " if i else "\n    ")
+                f.write(entry.to_json())
+            f.write("\n  ]\n}\n")
+
+    def _decode(self, line: str, resolve: bool) -> TraceEntry:
+        entry = TraceEntry.from_json(line)
+        if resolve and self.blobs and BLOB_KEY in line:
+            entry.inputs = self.blobs.resolve(entry.inputs)
+            entry.outputs = self.blobs.resolve(entry.outputs)
+        return entry
+
+    def _flush(self):
+        # caller holds the lock
+        self._last_flush = time.time()
+        if not self._buffer:
+            return
+        start = time.perf_counter()
+        with open(self.trace_file, 'a', encoding='utf-8') as f:
+            f.write("".join(self._buffer))
+            size = f.tell()
+        if self.metrics:
+            self.metrics.observe("agent_storage_save_seconds", time.perf_counter() - start, store="trace")
+            self.metrics.inc("agent_storage_bytes_written", self._buffer_bytes, store="trace")
+        self._buffer = []
+        self._buffer_bytes = 0
+
+        if size >= self.max_file_bytes:
+            rotated = os.path.join(self.storage_dir,
+                                   f"decision_trace.{len(self._rotated_files()) + 1}.jsonl")
+            os.replace(self.trace_file, rotated)
+
+    def _rotated_files(self) -> List[str]:
+        numbered = []
+        for name in os.listdir(self.storage_dir):
+            parts = name.split(".")
+            if len(parts) == 3 and parts[0] == "decision_trace" and parts[1].isdigit() and parts[2] == "jsonl":
+                numbered.append((int(parts[1]), os.path.join(self.storage_dir, name)))
+        return [path for _, path in sorted(numbered)]
+
+    def _migrate_legacy_trace(self):
+        # older versions kept the whole trace in one decision_trace.json document
+        legacy_file = os.path.join(self.storage_dir, "decision_trace.json")
+        if not os.path.exists(legacy_file) or os.path.exists(self.trace_file):
+            return
+        with open(legacy_file, 'r') as f:
+            entries = json.load(f).get("trace", [])
+        with open(self.trace_file, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(legacy_file, legacy_file + ".migrated")
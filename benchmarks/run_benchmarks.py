@@ -0,0 +1,329 @@
+"""Benchmarks for the planner -> executor -> memory -> tracer pipeline.
+
+Every case runs in its own process against the stub model and a throwaway
+storage directory, so peak RSS and bytes written belong to that case alone.
+
+    python -m benchmarks.run_benchmarks
+    python -m benchmarks.run_benchmarks --cases pipeline --plan-width 6 --output results.json
+    python -m benchmarks.run_benchmarks --compare baseline.json --threshold 0.2
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, List, Callable, Tuple
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def dir_bytes(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def storage_bytes(metrics) -> int:
+    # every byte the storage layers wrote, counted where they write it. unlike the
+    # directory size it isn't reduced by compaction, truncation or eviction
+    return int(metrics.total("agent_storage_bytes_written")) if metrics else 0
+
+
+def summarize(name: str, latencies: List[float], elapsed: float, workdir: str,
+              bytes_written: int = 0, extra: Dict = None) -> Dict:
+    return {
+        "case": name,
+        "operations": len(latencies),
+        "elapsed_seconds": elapsed,
+        "throughput_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "peak_rss_mb": peak_rss_mb(),
+        "bytes_written": bytes_written,
+        # what is left on disk at the end, prefilled data included
+        "disk_bytes": dir_bytes(workdir),
+        **(extra or {})
+    }
+
+
+def timed(fn: Callable, count: int) -> Tuple[List[float], float]:
+    latencies = []
+    start = time.perf_counter()
+    for i in range(count):
+        t0 = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - t0)
+    return latencies, time.perf_counter() - start
+
+
+def bench_pipeline(args, workdir: str) -> Dict:
+    from agent.orchestrator import StatefulAgent
+    from agent.models import StubProvider
+
+    provider = StubProvider(latency=("fixed", args.model_latency), output_chars=args.output_chars,
+                            plan_width=args.plan_width, plan_depth=args.plan_depth, seed=0)
+    agent = StatefulAgent(provider=provider, max_workers=args.workers, bypass_cache=True,
+                          storage_dir=os.path.join(workdir, "storage"),
+                          output_dir=os.path.join(workdir, "outputs"))
+
+    def run(i):
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent.run_task(f"Benchmark task {i}", {"task_type": "benchmark",
+                                                   "user_data": {"active_users": 1000 + i}})
+
+    latencies, elapsed = timed(run, args.tasks)
+    agent.memory.flush()
+    steps = 1 + args.plan_width * args.plan_depth
+    return summarize("pipeline", latencies, elapsed, workdir, storage_bytes(agent.metrics), {
+        "steps_per_task": steps,
+        "steps_per_second": steps * len(latencies) / elapsed if elapsed else 0.0,
+        "model_calls": provider.calls
+    })
+
+
+def bench_memory_save(args, workdir: str) -> Dict:
+    from agent.memory import StateManager
+    from agent.metrics import MetricsRegistry
+
+    metrics = MetricsRegistry()
+    memory = StateManager(storage_dir=workdir, backend=args.memory_backend, metrics=metrics)
+    record = {"task": "Prefilled task", "type": "benchmark", "success_rate": 1.0,
+              "plan": {"goal": "g", "steps": [{"id": 1, "action": "a"}]},
+              "results": [{"step_id": 1, "status": "completed", "result": {"output": "x" * args.output_chars}}]}
+    for i in range(args.past_tasks):
+        memory.add_completed_task({**record, "session_id": f"prefill-{i}"})
+    memory.flush()
+    prefill_bytes = storage_bytes(metrics)
+
+    def save(i):
+        memory.update_state("completed_steps", [{"id": i}])
+        memory.add_completed_task({**record, "session_id": f"bench-{i}"})
+
+    latencies, elapsed = timed(save, args.saves)
+    memory.flush()
+    return summarize("memory_save", latencies, elapsed, workdir, storage_bytes(metrics) - prefill_bytes,
+                     {"past_tasks": args.past_tasks, "backend": args.memory_backend})
+
+
+def bench_tracer_log(args, workdir: str) -> Dict:
+    from agent.tracer import DecisionTracer
+    from agent.metrics import MetricsRegistry
+
+    metrics = MetricsRegistry()
+    tracer = DecisionTracer(storage_dir=workdir, metrics=metrics)
+    payload = {"step": {"id": 1, "action": "Benchmark"}, "context": {"note": "x" * 200}}
+
+    def log(i):
+        tracer.log_decision(step=f"Execution - Step {i}", action="Benchmark",
+                            reasoning="Benchmark entry", inputs=payload)
+
+    latencies, elapsed = timed(log, args.trace_entries)
+    tracer.flush()
+    return summarize("tracer_log", latencies, elapsed, workdir, storage_bytes(metrics),
+                     {"entries": args.trace_entries})
+
+
+def bench_explain(args, workdir: str) -> Dict:
+    from agent.tracer import DecisionTracer
+
+    tracer = DecisionTracer(storage_dir=workdir)
+    for i in range(args.trace_entries):
+        tracer.log_decision(step=f"Execution - Step {i}", action="Benchmark",
+                            reasoning="Benchmark entry", inputs={"i": i})
+    tracer.flush()
+
+    sizes = []
+    latencies, elapsed = timed(lambda i: sizes.append(len(tracer.explain_decision_path())), args.repeat)
+    # read only, nothing is written while it is measured
+    return summarize("explain", latencies, elapsed, workdir, extra={
+        "entries": args.trace_entries,
+        "explanation_chars": sizes[-1] if sizes else 0
+    })
+
+
+_STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+from agent import StatefulAgent
+from agent.models import StubProvider
+imported = time.perf_counter()
+StatefulAgent(provider=StubProvider(), storage_dir=sys.argv[1], output_dir=sys.argv[2])
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def bench_startup(args, workdir: str) -> Dict:
+    from agent.memory import StateManager
+
+    # startup against a populated storage directory, each run in a fresh interpreter
+    storage_dir = os.path.join(workdir, "storage")
+    memory = StateManager(storage_dir=storage_dir)
+    record = {"task": "Prefilled task", "type": "benchmark", "success_rate": 1.0,
+              "plan": {"goal": "g", "steps": [{"id": 1, "action": "a"}]}, "results": []}
+    for i in range(args.past_tasks):
+        memory.add_completed_task({**record, "session_id": f"prefill-{i}"})
+    memory.flush()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")]))}
+    imports, constructs = [], []
+
+    def start(i):
+        out = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT, storage_dir, os.path.join(workdir, "outputs")],
+                             env=env, capture_output=True, text=True, check=True).stdout
+        imported, constructed = map(float, out.split())
+        imports.append(imported)
+        constructs.append(constructed)
+
+    latencies, elapsed = timed(start, args.repeat)
+    return summarize("startup", latencies, elapsed, workdir, extra={
+        "past_tasks": args.past_tasks,
+        "import_p50_ms": percentile(imports, 50) * 1000,
+        "construct_p50_ms": percentile(constructs, 50) * 1000
+    })
+
+
+def bench_saas_metrics(args, workdir: str) -> Dict:
+    from agent.saas_metrics import SaaSMetricsEngine
+
+    engine = SaaSMetricsEngine()
+    rows = [{"daily_active_users": 1000 + i, "monthly_active_users": 4000 + i,
+             "churn_rate_percent": 2 + i % 5, "arpu": 25.0, "cac": 120.0}
+            for i in range(args.metric_rows)]
+
+    counts = []
+    latencies, elapsed = timed(lambda i: counts.append(sum(map(len, engine.compute_many(rows)))), args.repeat)
+    return summarize("saas_metrics", latencies, elapsed, workdir, extra={
+        "rows": args.metric_rows,
+        "metrics_per_row": counts[-1] / args.metric_rows if counts and args.metric_rows else 0,
+        "rows_per_second": args.metric_rows * len(latencies) / elapsed if elapsed else 0.0
+    })
+
+
+CASES = {
+    "pipeline": bench_pipeline,
+    "memory_save": bench_memory_save,
+    "tracer_log": bench_tracer_log,
+    "explain": bench_explain,
+    "startup": bench_startup,
+    "saas_metrics": bench_saas_metrics
+}
+
+
+def run_case(name: str, args) -> Dict:
+    workdir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+    try:
+        return CASES[name](args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_isolated(name: str, args) -> Dict:
+    # a fresh interpreter per case keeps peak RSS from leaking between cases
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(1) as pool:
+        return pool.apply(run_case, (name, args))
+
+
+def compare(results: List[Dict], baseline_path: str, threshold: float) -> List[str]:
+    with open(baseline_path, 'r') as f:
+        baseline = {r["case"]: r for r in json.load(f)["results"]}
+
+    regressions = []
+    for result in results:
+        before = baseline.get(result["case"])
+        if not before:
+            continue
+        for metric in ("latency_p50_ms", "latency_p99_ms", "peak_rss_mb", "bytes_written"):
+            if before[metric] and result[metric] > before[metric] * (1 + threshold):
+                regressions.append(f"{result['case']}.{metric}: {before[metric]:.2f} -> {result[metric]:.2f}")
+        if result["throughput_per_second"] < before["throughput_per_second"] * (1 - threshold):
+            regressions.append(f"{result['case']}.throughput_per_second: "
+                               f"{before['throughput_per_second']:.2f} -> {result['throughput_per_second']:.2f}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the agent pipeline against the stub model")
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=list(CASES))
+    parser.add_argument("--tasks", type=int, default=20, help="tasks run through the pipeline")
+    parser.add_argument("--plan-width", type=int, default=4, help="parallel steps per plan layer")
+    parser.add_argument("--plan-depth", type=int, default=2, help="layers after the root step")
+    parser.add_argument("--output-chars", type=int, default=2000, help="size of each model output")
+    parser.add_argument("--model-latency", type=float, default=0.0, help="stub latency per call, seconds")
+    parser.add_argument("--workers", type=int, default=4, help="scheduler max_workers")
+    parser.add_argument("--past-tasks", type=int, default=10000, help="tasks preloaded into memory")
+    parser.add_argument("--saves", type=int, default=200, help="memory saves measured")
+    parser.add_argument("--memory-backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--trace-entries", type=int, default=100000)
+    parser.add_argument("--metric-rows", type=int, default=100000, help="rows per saas_metrics computation")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="explain_decision_path runs, interpreter starts and saas_metrics computations")
+    parser.add_argument("--output", help="write machine-readable results to this JSON file")
+    parser.add_argument("--compare", help="baseline results JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative regression")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    results = []
+    for name in args.cases:
+        print(f"Running {name}...", file=sys.stderr)
+        result = run_isolated(name, args)
+        results.append(result)
+        print(f"  {result['throughput_per_second']:.1f} ops/s, p50 {result['latency_p50_ms']:.2f} ms, "
+              f"p99 {result['latency_p99_ms']:.2f} ms, peak RSS {result['peak_rss_mb']:.1f} MB, "
+              f"{result['bytes_written']} bytes written", file=sys.stderr)
+
+    report = {
+        "generated_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "results": results
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
+import argparse
 import os
 import sys
+import time
 from datetime import datetime
+from functools import partial
 
 from agent.orchestrator import StatefulAgent
+from agent.models import GeminiProvider, StubProvider, DEFAULT_MODEL
+from agent.routing import ModelTier
 from use_cases.saas_launch import run_saas_dashboard_launch
-from use_cases.investor_update import run_investor_update
 
 
 def print_banner():
@@ -28,15 +32,226 @@ def get_api_key():
     return api_key
 
 
+def stub_provider():
+    return StubProvider(latency=("lognormal", 0.5, 0.4), seed=0)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Stateful execution agent")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="ignore cached model responses and fetch fresh output")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="write documents only once the whole response has arrived")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve OpenMetrics on this localhost port while the agent runs")
+    parser.add_argument("--resume", metavar="SESSION_ID",
+                        help="finish an interrupted task from its checkpoint instead of starting a new one")
+    parser.add_argument("--batch", metavar="TASKS_JSONL",
+                        help="run every task spec in this JSONL file across a process pool")
+    parser.add_argument("--batch-output", default="batch_runs/results.jsonl",
+                        help="where batch results are written, one line per task in input order")
+    parser.add_argument("--workers", type=int,
+                        help="batch worker processes (default: number of CPUs), or job server workers (default: 2)")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="run a local HTTP job server on this port instead of the demo task")
+    parser.add_argument("--queue-size", type=int, default=16,
+                        help="jobs the server holds before answering 429")
+    parser.add_argument("--rpm", type=float, help="model requests per minute allowed by your quota")
+    parser.add_argument("--tpm", type=float, help="model tokens per minute allowed by your quota")
+    parser.add_argument("--micro-batch", action="store_true",
+                        help="send short analysis and metrics steps that are ready together as one model call")
+    parser.add_argument("--metrics-mode", choices=("model", "narrate", "fast"), default="narrate",
+                        help="metrics steps: the model calculates (model), metrics are calculated locally "
+                             "and the model interprets them (narrate), or no model call at all (fast)")
+    parser.add_argument("--fast-model", metavar="MODEL",
+                        help="route short steps (metrics, analysis, refinements) to this cheaper, faster model")
+    parser.add_argument("--strong-model", metavar="MODEL",
+                        help="route plans and long written outputs to this stronger model")
+    parser.add_argument("--latency-budget", type=float, metavar="SECONDS",
+                        help="with model tiers, move calls to faster tiers when a task is running out of time")
+    parser.add_argument("--stub", action="store_true",
+                        help="use the offline stub model instead of Gemini (no API key needed)")
+    parser.add_argument("--record", metavar="CASSETTE",
+                        help="save every model prompt/response pair with timings to this file (.gz to compress)")
+    parser.add_argument("--replay", metavar="CASSETTE",
+                        help="answer model calls from a recorded cassette instead of calling the model")
+    parser.add_argument("--replay-latency", type=float, default=0.0, metavar="SCALE",
+                        help="sleep the recorded latencies times SCALE while replaying (1.0 = original timing)")
+    parser.add_argument("--replay-loose", action="store_true",
+                        help="answer prompts missing from the cassette with the next unused recording")
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     print_banner()
 
-    api_key = get_api_key()
-    agent = StatefulAgent(api_key=api_key)
+    if args.batch:
+        run_batch(args)
+        return
+    if args.serve:
+        run_server(args)
+        return
+
+    # cassettes, batches and the server are imported only when asked for, a
+    # plain run doesn't pay for them at startup
+    if args.replay:
+        from agent.cassette import ReplayProvider
+        provider = ReplayProvider(args.replay, latency_scale=args.replay_latency,
+                                  strict=not args.replay_loose)
+    elif args.stub:
+        provider = stub_provider()
+    else:
+        provider = None
+    if args.record:
+        if provider is None:
+            provider = GeminiProvider(api_key=get_api_key())
+        from agent.cassette import RecordingProvider
+        provider = RecordingProvider(provider, args.record)
+
+    tiers = build_model_tiers(args)
+    if tiers and (args.record or args.replay):
+        print("--fast-model/--strong-model can't be combined with --record or --replay")
+        return
+
+    # cached responses and memoized plans would skip the model, so every call
+    # goes through when recording or replaying
+    bypass_cache = args.no_cache or bool(args.record or args.replay)
+    if provider or tiers:
+        agent = StatefulAgent(provider=provider, bypass_cache=bypass_cache,
+                              metrics_port=args.metrics_port, rpm=args.rpm, tpm=args.tpm,
+                              stream_outputs=not args.no_stream, batch_steps=args.micro_batch,
+                              model_tiers=tiers, latency_budget=args.latency_budget,
+                              calculation_mode=args.metrics_mode)
+    else:
+        api_key = get_api_key()
+        agent = StatefulAgent(api_key=api_key, bypass_cache=bypass_cache,
+                              metrics_port=args.metrics_port, rpm=args.rpm, tpm=args.tpm,
+                              stream_outputs=not args.no_stream, batch_steps=args.micro_batch,
+                              calculation_mode=args.metrics_mode)
+
+    if args.resume:
+        agent.resume_task(args.resume)
+        return
 
     print(f"Agent initialized. Session ID: {agent.session_id[:8]}...\n")
 
-    run_saas_dashboard_launch(agent)
+    try:
+        run_saas_dashboard_launch(agent)
+    except KeyboardInterrupt:
+        print(f"\n\nResume with: python main.py --resume {agent.session_id}")
+        raise
+    finally:
+        if args.record:
+            print(f"Recorded {provider.calls} model calls to {args.record}")
+        if args.replay:
+            print(f"Replay: {provider.get_stats()}")
+
+
+def run_batch(args):
+    from agent.batch import BatchRunner, load_task_specs
+
+    specs = load_task_specs(args.batch)
+    if not specs:
+        print(f"No tasks found in {args.batch}")
+        return
+
+    provider_factory = worker_provider_factory(args)
+    if provider_factory is False:
+        return
+
+    workers = min(args.workers or os.cpu_count() or 1, len(specs))
+    # the quota is shared, so each worker's governor gets its slice
+    runner = BatchRunner(workers=workers,
+                         batch_dir=os.path.dirname(args.batch_output) or ".",
+                         agent_kwargs={"bypass_cache": args.no_cache or bool(args.replay),
+                                       "stream_outputs": not args.no_stream,
+                                       "batch_steps": args.micro_batch,
+                                       "calculation_mode": args.metrics_mode,
+                                       "rpm": args.rpm / workers if args.rpm else None,
+                                       "tpm": args.tpm / workers if args.tpm else None},
+                         provider_factory=provider_factory)
+    print(f"Running {len(specs)} tasks on {workers} workers...")
+    summary = runner.run(specs, args.batch_output)
+
+    print(f"\nBATCH SUMMARY")
+    print(f"Tasks: {summary['total_tasks']} in {summary['elapsed_seconds']:.1f}s "
+          f"({summary['tasks_per_second']:.2f}/s)")
+    print(f"By status: {summary['by_status']}")
+    print(f"Mean success rate: {summary['mean_success_rate']*100:.1f}%")
+    print(f"Results: {args.batch_output}")
+
+
+# stub tiers answer faster the cheaper they are, median seconds per call
+STUB_TIER_LATENCY = {"fast": 0.2, "standard": 0.5, "strong": 1.0}
+
+
+def build_model_tiers(args):
+    # the default model between --fast-model and --strong-model, fastest first
+    if not (args.fast_model or args.strong_model):
+        return None
+    api_key = None if args.stub else get_api_key()
+    tiers = []
+    for tier, model_name in (("fast", args.fast_model), ("standard", DEFAULT_MODEL),
+                             ("strong", args.strong_model)):
+        if not model_name:
+            continue
+        if args.stub:
+            provider = StubProvider(model_name=model_name, latency=("lognormal", STUB_TIER_LATENCY[tier], 0.4),
+                                    seed=0)
+        else:
+            provider = GeminiProvider(api_key=api_key, model_name=model_name)
+        tiers.append(ModelTier(tier, provider))
+    return tiers
+
+
+def worker_provider_factory(args):
+    # what batch and server workers build their provider with, False if the
+    # options don't work with several workers
+    if args.record:
+        # workers would interleave writes to one file
+        print("--record can't be combined with --batch or --serve")
+        return False
+    if args.replay:
+        from agent.cassette import ReplayProvider
+        return partial(ReplayProvider, args.replay, latency_scale=args.replay_latency,
+                       strict=not args.replay_loose)
+    if args.stub:
+        return stub_provider
+    if args.serve and not os.getenv("GEMINI_API_KEY"):
+        # a server has nobody to type the key in
+        print("GEMINI_API_KEY not found. Set it in the environment, or use --stub.")
+        return False
+    # workers read the key from the environment
+    os.environ["GEMINI_API_KEY"] = get_api_key()
+    return None
+
+
+def run_server(args):
+    from agent.server import JobServer
+
+    provider_factory = worker_provider_factory(args)
+    if provider_factory is False:
+        return
+
+    workers = args.workers or 2
+    server = JobServer(workers=workers, queue_size=args.queue_size,
+                       agent_kwargs={"bypass_cache": args.no_cache or bool(args.replay),
+                                     "stream_outputs": not args.no_stream,
+                                     "batch_steps": args.micro_batch,
+                                     "calculation_mode": args.metrics_mode,
+                                     "rpm": args.rpm / workers if args.rpm else None,
+                                     "tpm": args.tpm / workers if args.tpm else None},
+                       provider_factory=provider_factory)
+    server.start(args.serve)
+    print(f"Serving jobs on http://127.0.0.1:{args.serve} with {workers} workers "
+          f"(agent output in {server.server_dir}/agent.log)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print("\nFinishing queued jobs...")
+        server.stop()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,6 @@
 from use_cases.saas_launch import run_saas_dashboard_launch, run_custom_saas_launch
-from use_cases.investor_update import run_investor_update, run_custom_investor_update
 
 __all__ = [
     'run_saas_dashboard_launch',
-    'run_custom_saas_launch',
-    'run_investor_update',
-    'run_custom_investor_update'
+    'run_custom_saas_launch'
 ]